@@ -0,0 +1,171 @@
+"""
+Corpus benchmark: packs the carts of the corpus with fixed seeds, algorithms
+and zopfli levels, and records how the best size develops as a function of
+wall-clock time and steps, the steps per second and the peak memory usage.
+
+Usage:
+    python benchmarks/corpus.py run -o results.json [options] [carts...]
+    python benchmarks/corpus.py compare baseline.json results.json
+
+The comparison lists, for each run, the final size of the baseline, the
+difference of the final sizes, the difference of the sizes after the same
+time (the shorter of the two runs), the steps per second and its ratio to the
+baseline, and how long each run took to reach the final size of the baseline.
+
+Each cart is packed in its own pakettic process, with --stats-json, so the
+numbers are the same that pakettic --stats reports. Linux / macOS only, as
+the peak memory usage is measured with os.wait4.
+"""
+import argparse
+import bisect
+import glob
+import json
+import math
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark pakettic on the corpus')
+    subparsers = argparser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help='pack the carts and save the results as JSON')
+    run.add_argument('carts', nargs='*', help='carts to pack. default: all .lua files in corpus/ and examples/')
+    run.add_argument('-o', '--output', required=True, help='JSON file for the results')
+    run.add_argument('-a', '--algorithms', default='dlas', help='comma-separated list of algorithms. default: %(default)s')
+    run.add_argument('-z', '--zopfli-levels', default='0', help='comma-separated list of zopfli levels. default: %(default)s')
+    run.add_argument('--seeds', default='0', help='comma-separated list of seeds. default: %(default)s')
+    run.add_argument('-s', '--steps', type=int, default=2000, help='steps per run. default: %(default)d')
+    run.add_argument('-P', '--processes', type=int, default=1, help='pakettic processes per run. default: %(default)d')
+    run.add_argument('-x', '--extra', default='', help='extra arguments passed to pakettic, e.g. -x="--batch 4"')
+    compare = subparsers.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline', help='JSON file of the baseline run')
+    compare.add_argument('results', help='JSON file of the run compared to the baseline')
+    args = argparser.parse_args()
+    if args.command == 'run':
+        _run(args)
+    else:
+        _compare(args.baseline, args.results)
+
+
+def _run(args):
+    carts = args.carts or sorted(glob.glob(os.path.join(_ROOT, 'corpus', '**', '*.lua'), recursive=True) +
+                                 glob.glob(os.path.join(_ROOT, 'examples', '*.lua')))
+    extra = shlex.split(args.extra)
+    config = {
+        'algorithms': args.algorithms.split(','),
+        'zopfli_levels': [int(z) for z in args.zopfli_levels.split(',')],
+        'seeds': [int(s) for s in args.seeds.split(',')],
+        'steps': args.steps,
+        'processes': args.processes,
+        'extra': extra,
+        'python': sys.version,
+        'platform': platform.platform(),
+        'commit': _git_commit(),
+    }
+    runs = []
+    for cart in carts:
+        for algorithm in config['algorithms']:
+            for level in config['zopfli_levels']:
+                for seed in config['seeds']:
+                    run = _pack(cart, algorithm, level, seed, args.steps, args.processes, extra)
+                    runs.append(run)
+                    size = run.get('size', run.get('error'))
+                    print(f"{os.path.relpath(cart, _ROOT)} -a{algorithm} -z{level} --seed {seed}: {size} "
+                          f"({run.get('steps_per_second', 0):.1f} steps/s)", file=sys.stderr)
+                    with open(args.output, 'w') as file:  # save after each run, so a long benchmark can be inspected midway
+                        json.dump({'config': config, 'runs': runs}, file, indent=1)
+
+
+def _pack(cart: str, algorithm: str, level: int, seed: int, steps: int, processes: int, extra: list) -> dict:
+    """Packs one cart in a pakettic process and returns the results of the run"""
+    run = {'cart': os.path.relpath(cart, _ROOT), 'algorithm': algorithm, 'zopfli_level': level, 'seed': seed}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stats_path = os.path.join(tmpdir, 'stats.json')
+        cmd = [sys.executable, '-m', 'pakettic', cart, '-o', os.path.join(tmpdir, 'packed.tic'),
+               '-a', algorithm, f'-z{level}', '--seed', str(seed), '-s', str(steps), '-P', str(processes),
+               '--stats-json', stats_path] + extra
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = proc.stderr.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        run['total_seconds'] = time.perf_counter() - start
+        run['peak_rss_kb'] = rusage.ru_maxrss if sys.platform != 'darwin' else rusage.ru_maxrss // 1024
+        if proc.returncode != 0 or not os.path.exists(stats_path):
+            run['error'] = stderr.decode(errors='replace').strip().splitlines()[-1:] or [f'exit code {proc.returncode}']
+            return run
+        with open(stats_path) as file:
+            report = next(iter(json.load(file).values()))
+    run.update({
+        'size': report['best'][-1][2] if len(report['best']) > 0 else None,
+        'wall': report['wall'],
+        'steps': report['steps'],
+        'steps_per_second': report['steps_per_second'],
+        'utilisation': report['utilisation'],
+        'cache_hits': report['cache']['hits'] / max(report['cache']['hits'] + report['cache']['misses'], 1) if 'cache' in report else None,
+        'screened': report['screen']['screened'] / max(sum(report['screen'].values()), 1) if 'screen' in report else None,
+        'curve': report['best'],  # [seconds, steps, size] of every new best
+    })
+    return run
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def _size_at(curve: list, seconds: float) -> float:
+    """The best size found within seconds, from a curve of [seconds, steps, size]"""
+    i = bisect.bisect_right([c[0] for c in curve], seconds)
+    return curve[i - 1][2] if i > 0 else math.inf
+
+
+def _time_to(curve: list, size: int) -> float:
+    """How many seconds it took to reach size, inf if never"""
+    return next((c[0] for c in curve if c[2] <= size), math.inf)
+
+
+def _compare(baseline_path: str, results_path: str):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    with open(results_path) as file:
+        results = json.load(file)
+
+    def _key(run):
+        return run['cart'], run['algorithm'], run['zopfli_level'], run['seed']
+    base_runs = {_key(r): r for r in baseline['runs'] if 'error' not in r}
+    print(f"{'cart':<40} {'base':>5} {'final':>6} {'@time':>6} {'steps/s':>8} {'speedup':>7} {'to base size':>13}")
+    totals = [0, 0, 0]
+    speedups = []
+    for run in results['runs']:
+        base = base_runs.get(_key(run))
+        if base is None or 'error' in run:
+            continue
+        # the sizes both runs had reached after the same time, i.e. bytes per CPU-second
+        t = min(base['wall'], run['wall'])
+        at_time = _size_at(run['curve'], t) - _size_at(base['curve'], t)
+        speedup = run['steps_per_second'] / base['steps_per_second'] if base['steps_per_second'] > 0 else math.nan
+        speedups.append(speedup)
+        totals[0] += base['size']
+        totals[1] += run['size'] - base['size']
+        totals[2] += at_time
+        name = f"{run['cart']} -a{run['algorithm']} -z{run['zopfli_level']} s{run['seed']}"
+        print(f"{name[-40:]:<40} {base['size']:>5} {run['size'] - base['size']:>+6} {at_time:>+6} {run['steps_per_second']:>8.1f} "
+              f"{speedup:>6.2f}x {_time_to(run['curve'], base['size']):>6.1f}/{_time_to(base['curve'], base['size']):.1f}s")
+    logs = [math.log(s) for s in speedups if s > 0]
+    if len(logs) > 0:
+        geomean = math.exp(sum(logs) / len(logs))
+        print(f"{'total (speedup: geometric mean)':<40} {totals[0]:>5} {totals[1]:>+6} {totals[2]:>+6} {'':>8} {geomean:>6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Micro-benchmarks: times the stages of pakettic in isolation on real carts, so
+that a regression in any single stage is visible. The stages are parsing,
+converting loads to functions, the initial minification, mutating, printing
+(from scratch and incrementally), pickling the abstract syntax tree,
+compressing with zopfli at each of the compression levels and reading and
+writing each of the cart formats.
+
+Usage:
+    python benchmarks/micro.py [options] [carts...]
+    python benchmarks/micro.py -o results.json [options] [carts...]
+    python benchmarks/micro.py --baseline baseline.json [options] [carts...]
+
+Each benchmark is run a few times as a warmup, then timed in a number of
+repetitions. Each repetition runs the benchmark in a loop, long enough that
+the timer resolution does not matter (see timeit.Timer.autorange). The table
+lists the minimum, median, mean and standard deviation of the time per call
+over the repetitions. With --baseline, the median is also compared to the
+median of the same benchmark in a previously saved result file.
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import timeit
+import types
+import zlib
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+from pakettic import ast, main as pakettic_main, optimize, parser, printer, ticfile  # noqa: E402
+
+_DEFAULT_CARTS = ['examples/stars.lua', 'examples/fish.lua', 'examples/raymarcher.lua', 'corpus/gasman/gasman-aquarium.lua']
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Micro-benchmarks of the stages of pakettic')
+    argparser.add_argument('carts', nargs='*', help=f"carts to benchmark. default: {' '.join(_DEFAULT_CARTS)}")
+    argparser.add_argument('-b', '--benchmarks', help='comma-separated list of benchmarks to run, e.g. parse,format. default: all')
+    argparser.add_argument('-z', '--zopfli-levels', default=','.join(str(i) for i in range(len(pakettic_main._ZOPFLI_LEVELS))),
+                           help='comma-separated list of zopfli levels for the compress benchmarks. default: %(default)s')
+    argparser.add_argument('-w', '--warmup', type=int, default=1, help='warmup calls before timing. default: %(default)d')
+    argparser.add_argument('-r', '--repeat', type=int, default=5, help='timed repetitions. default: %(default)d')
+    argparser.add_argument('-n', '--number', type=int, help='calls per repetition. default: enough to take 0.2 s')
+    argparser.add_argument('-o', '--output', help='save the results to this JSON file')
+    argparser.add_argument('--baseline', help='compare the medians to the results in this JSON file')
+    args = argparser.parse_args()
+    carts = args.carts or [os.path.join(_ROOT, c) for c in _DEFAULT_CARTS]
+    selected = None if args.benchmarks is None else set(args.benchmarks.split(','))
+    levels = [int(z) for z in args.zopfli_levels.split(',')]
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = {(r['cart'], r['benchmark']): r for r in json.load(file)['results']}
+
+    print(f"{'cart':<28} {'benchmark':<16} {'calls':>6} {'min ms':>10} {'median ms':>10} {'mean ms':>10} {'stdev ms':>9}" +
+          (f" {'vs base':>8}" if len(baseline) > 0 else ''))
+    results = []
+    for cart in carts:
+        name = os.path.relpath(os.path.abspath(cart), _ROOT)
+        for benchmark, func in _benchmarks(cart, levels):
+            if selected is not None and benchmark.split('-')[0] not in selected and benchmark not in selected:
+                continue
+            result = _measure(func, args.warmup, args.repeat, args.number)
+            result.update({'cart': name, 'benchmark': benchmark})
+            results.append(result)
+            line = (f"{name[-28:]:<28} {benchmark:<16} {result['number']:>6} {result['min'] * 1000:>10.3f} "
+                    f"{result['median'] * 1000:>10.3f} {result['mean'] * 1000:>10.3f} {result['stdev'] * 1000:>9.3f}")
+            base = baseline.get((name, benchmark))
+            if base is not None:
+                line += f" {result['median'] / base['median']:>7.2f}x"
+            print(line, flush=True)
+    if args.output is not None:
+        config = {'warmup': args.warmup, 'repeat': args.repeat, 'number': args.number, 'python': sys.version,
+                  'platform': platform.platform(), 'commit': _git_commit()}
+        with open(args.output, 'w') as file:
+            json.dump({'config': config, 'results': results}, file, indent=1)
+
+
+def _benchmarks(cart: str, levels: list[int]):
+    """
+    Yields (name, function) for each benchmark of a cart. The inputs of each
+    stage are prepared from the outputs of the previous stages, so that only
+    the stage itself is timed.
+    """
+    with open(cart, 'rb') as file:
+        cart_bytes = file.read()
+    read_cart = ticfile.read(cart)
+    code = read_cart.code.decode('latin-1')
+    data = read_cart.data
+    yield 'parse', lambda: parser.parse_string(code)
+    root = parser.parse_string(code)
+    yield 'loads_to_funcs', lambda: optimize.loads_to_funcs(root)
+    root = optimize.loads_to_funcs(root)
+    yield 'minify', lambda: optimize.minify(root)
+    root = ast.Hint(optimize.minify(root))
+    yield 'format', lambda: printer.format(root)
+    yield 'pickle', lambda: pickle.loads(pickle.dumps(root))
+    # mutate keeps mutating the same state, like the optimization does; the
+    # warmup builds the mutation index
+    state = (pickle.loads(pickle.dumps(root)), None)
+    rand = random.Random(0)
+    yield 'mutate', lambda: optimize.mutate(state, rand)
+    # format_cached mutates and prints with the caches of the printer, like
+    # a step of the optimization does, so compare it to mutate
+    yield 'format_cached', lambda: (optimize.mutate(state, rand), printer.format_bytes(state[0], cached=True))
+    packed = printer.format(root).encode('latin-1')
+    for level in levels:
+        zopfli_args = pakettic_main._ZOPFLI_LEVELS[level]
+        yield f'compress-z{level}', lambda zopfli_args=zopfli_args: _compress(packed, zopfli_args)
+    # the writers compress with zlib, so that they time the cart layout and
+    # not the compression, which is timed by compress above
+    writers = {
+        'lua': ticfile.write_lua(data),
+        'tic': ticfile.write_tic(data, False, _compress_zlib),
+        'unc': ticfile.write_tic(data, False, None),
+        'png': ticfile.write_png(data, False, _compress_zlib),
+    }
+    for fmt, writer in writers.items():
+        yield f'write-{fmt}', lambda writer=writer: writer(packed)[1](io.BytesIO())
+    if cart.endswith('.lua'):
+        yield 'read-lua', lambda: ticfile.read_lua(io.StringIO(cart_bytes.decode('latin-1')))
+    for fmt, reader in (('tic', ticfile.read_tic), ('unc', ticfile.read_tic), ('png', ticfile.read_png)):
+        file = io.BytesIO()
+        writers[fmt](packed)[1](file)
+        written = file.getvalue()
+        yield f'read-{fmt}', lambda reader=reader, written=written: reader(io.BytesIO(written))
+
+
+def _compress(code: bytes, zopfli_args: dict) -> bytes:
+    pakettic_main.args = types.SimpleNamespace(**zopfli_args)
+    return pakettic_main._compress(code)
+
+
+def _compress_zlib(code: bytes) -> bytes:
+    return zlib.compress(code, 9)
+
+
+def _measure(func, warmup: int, repeat: int, number: int) -> dict:
+    """Times func and returns the statistics of the time per call, in seconds"""
+    for _ in range(warmup):
+        func()
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'number': number,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'times': times,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,171 @@
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import MISSING, dataclass, field, fields
+from operator import attrgetter
+from typing import Any, Optional
 
 
+def _node(cls=None, **kwargs):
+    """
+    Makes a class a dataclass with a slot for each of its fields, like
+    dataclass(slots=True) does starting from Python 3.10
+    """
+    def wrap(cls):
+        cls = dataclass(cls, **kwargs)
+        names = tuple(f.name for f in fields(cls) if f.name in cls.__dict__.get('__annotations__', {}))
+        namespace = {k: v for k, v in cls.__dict__.items() if k not in names and k != '__dict__' and k != '__weakref__'}
+        namespace['__slots__'] = names
+        namespace['__init__'] = _init(cls)
+        args = tuple(f.name for f in fields(cls) if f.init)
+        if len(args) == 0:
+            namespace['_args'] = staticmethod(lambda node: ())
+        elif len(args) == 1:
+            namespace['_args'] = staticmethod(lambda node: (getattr(node, args[0]),))
+        else:
+            namespace['_args'] = staticmethod(attrgetter(*args))
+        return type(cls)(cls.__name__, cls.__bases__, namespace)
+    return wrap if cls is None else wrap(cls)
+
+
+def _init(cls):
+    """
+    Returns a constructor for a dataclass that also sets the fields that are not
+    its arguments. The constructor of dataclass leaves them to class
+    attributes, which slots do not allow, unless slots=True.
+    """
+    params, lines, namespace = ['self'], [], {}
+    for f in fields(cls):
+        if f.init and f.default is MISSING:
+            params.append(f.name)
+        elif f.init:
+            params.append(f'{f.name}=_{f.name}')
+        namespace[f'_{f.name}'] = f.default
+        lines.append(f'    self.{f.name} = {f.name if f.init else "_" + f.name}\n')
+    exec(f"def __init__({', '.join(params)}):\n" + (''.join(lines) or '    pass\n'), namespace)
+    return namespace['__init__']
+
+
+@_node
 class Node:
     """Represents a node in the abstract syntax tree"""
-    @property
-    def precedence(self):
-        return 0
-    original = None
-    # TODO: If we typehint this as "Node", get_type_hints(ast.Ellipsis()), get_type_hints(ast.Break()) and
+    # There are lots of nodes and they get pickled on every step, so they have
+    # slots instead of a __dict__. These fields are not arguments of the
+    # constructors, which set them to None.
+    # TODO: If we typehint original as "Node", get_type_hints(ast.Ellipsis()), get_type_hints(ast.Break()) and
     # get_type_hints(ast.Nil()) crash in optimize.apply_trans, because it uses type hints to figure out
     # which children should the transformation be applied progressively. At the moment, it's not an issue
     # if the apply_trans does not get applied to "original" attributes, as it is currently used only to
     # transform loads to funcs, and at that point, there should be no originals.
+    original: Any = field(default=None, init=False, repr=False, compare=False)  # the node this node replaced, e.g. the expression a constant was folded from
+    measured: Optional[dict] = field(default=None, init=False, repr=False, compare=False)  # cache of printer.measure, reset when the subtree changes
+    printed: Optional[dict] = field(default=None, init=False, repr=False, compare=False)  # cache of printer.format(cached=True), reset when the subtree changes
 
+    @property
+    def precedence(self):
+        return 0
+
+    def __reduce__(self):
+        # a node is pickled as a call to its constructor, which is smaller and
+        # faster to load than a dictionary of its attributes. The caches of the
+        # printer are cheap to rebuild, but would bloat the pickles a lot.
+        if self.original is None:
+            return type(self), self._args(self)
+        return type(self), self._args(self), {'original': self.original}
+
+    def __setstate__(self, state):
+        # also loads the pickles of older versions, which are not created by
+        # calling the constructor and have all the attributes in the state
+        self.original = self.measured = self.printed = None
+        for name, value in state.items():
+            setattr(self, name, value)
 
-@dataclass
+
+@_node
 class Name(Node):
     """Represents an variable identifier in the abstract syntax tree"""
     id: str
 
 
-@dataclass
+@_node
 class Block(Node):
     """Represents list of statements in the abstract syntax tree"""
     stats: list[Node]
 
 
-@dataclass
+@_node
 class Return(Node):
     """Represents a return statement in the abstract syntax tree"""
     exps: list[Node]
 
 
-@dataclass
+@_node
 class Do(Node):
     """Represents a 'do...end' in the abstract syntax tree"""
     block: Block
 
 
-@dataclass
+@_node
 class Assign(Node):
     """Represents an assignment in the abstract syntax tree"""
     targets: list[Node]
     values: list[Node]
 
 
-@dataclass
+@_node
 class Label(Node):
     """Represents a '::label::' in the abstract syntax tree"""
     name: str
 
 
-@dataclass
+@_node
 class Break(Node):
     """Represents a 'break' in the abstract syntax tree"""
     pass
 
 
-@dataclass
+@_node
 class LiteralString(Node):
     """Represents a string literal in the abstract syntax tree"""
     value: str
 
 
-@dataclass
+@_node
 class Goto(Node):
     """Represents a 'goto target' in the abstract syntax tree"""
     target: str
 
 
-@dataclass
+@_node
 class Boolean(Node):
     """Represents a boolean literal in the abstract syntax tree"""
     value: bool
 
 
-@dataclass
+@_node
 class Ellipsis(Node):
     """Represents an ellipsis (...) in the abstract syntax tree"""
     pass
 
 
-@dataclass
+@_node
 class Nil(Node):
     """Represents a nil literal the abstract syntax tree"""
     pass
 
 
-@dataclass
+@_node
 class While(Node):
     """Represents a while loop in the abstract syntax tree"""
     condition: Node
     block: Block
 
 
-@dataclass
+@_node
 class Repeat(Node):
     """Represents a repeat-until loop in the abstract syntax tree"""
     condition: Node
     block: Block
 
 
-@dataclass
+@_node
 class ForRange(Node):
     """Represents a ranged for loop in the abstract syntax tree"""
     var: Node
@@ -112,7 +175,7 @@ class ForRange(Node):
     body: Block
 
 
-@dataclass
+@_node
 class ForIn(Node):
     """Represents a for-in loop in the abstract syntax tree"""
     names: list[Name]
@@ -120,14 +183,14 @@ class ForIn(Node):
     body: Block
 
 
-@dataclass
+@_node
 class Local(Node):
     """Represents a local assignment in the abstract syntax tree"""
     targets: list[Name]
     values: Optional[list[Node]]
 
 
-@dataclass
+@_node
 class Func(Node):
     """Represents a function definition the abstract syntax tree"""
     args: list[Name]
@@ -135,7 +198,7 @@ class Func(Node):
     oneline: bool = True
 
 
-@dataclass
+@_node
 class LocalFunc(Node):
     """Represents a local function definition the abstract syntax tree (e.g. local function f() end)"""
     name: Name
@@ -143,47 +206,47 @@ class LocalFunc(Node):
     body: Block
 
 
-@dataclass
+@_node
 class Index(Node):
     """Represents an indexing (obj[item]) the abstract syntax tree"""
     obj: Node
     item: Node
 
 
-@dataclass
+@_node
 class Table(Node):
     """Represents a table definition the abstract syntax tree"""
     fields: list[Node]
 
 
-@dataclass
+@_node
 class ExpressionField(Node):
     """Represents a field with an expression as its key in the inside a table definition"""
     value: Node
     key: Node = None
 
 
-@dataclass
+@_node
 class NamedField(Node):
     """Represents a field with an name as its key in the inside a table definition"""
     value: Node
-    key: Node = str
+    key: str
 
 
-@dataclass
+@_node
 class Field(Node):
     """Represents a field with just a value, no key, inside the inside a table definition"""
     value: Node
 
 
-@dataclass
+@_node
 class Call(Node):
     """Represents a call in the abstract syntax tree"""
     func: Node
     args: list[Node]
 
 
-@dataclass
+@_node
 class MethodCall(Node):
     """Represents a method call ('obj:method(args)') in the abstract syntax tree"""
     value: Node
@@ -191,7 +254,7 @@ class MethodCall(Node):
     args: list[Node]
 
 
-@dataclass
+@_node
 class If(Node):
     """Represents an if statement in the abstract syntax tree"""
     test: Node
@@ -199,7 +262,7 @@ class If(Node):
     orelse: Block
 
 
-@dataclass
+@_node
 class BinOp(Node):
     """Represents a binary operator in the abstract syntax tree"""
     left: Node
@@ -211,7 +274,7 @@ class BinOp(Node):
         return _precedence[self.op]
 
 
-@dataclass
+@_node
 class Hint(Node):
     """A node containing hints for printing. Does not reflect actual code."""
     block: Block
@@ -234,7 +297,7 @@ _precedence = \
     dict.fromkeys(['or'], 12)
 
 
-@dataclass
+@_node
 class UnaryOp(Node):
     """Represents an unary operator in the abstract syntax tree"""
     op: str
@@ -245,19 +308,13 @@ class UnaryOp(Node):
         return 2
 
 
-@dataclass(init=False)
+@_node
 class Numeral(Node):
     """Represents a numeral literal in the abstract syntax tree"""
-    whole: int
-    fractional: int
-    exponent: int
-    hex: bool
-
-    def __init__(self, whole=0, fractional=0, exponent=0, hex=False):
-        self.whole = whole
-        self.fractional = fractional
-        self.exponent = exponent
-        self.hex = hex
+    whole: int = 0
+    fractional: int = 0
+    exponent: int = 0
+    hex: bool = False
 
     def __repr__(self):
         if self.whole == 0 and self.fractional > 0:
@@ -276,7 +333,7 @@ class Numeral(Node):
             return float.fromhex(r) if self.hex else float(r)
 
 
-@dataclass
+@_node
 class Alt(Node):
     """
     Represents a list of alternative expressions in the abstract syntax tree.
@@ -290,7 +347,7 @@ class Alt(Node):
         return self.alts[0].precedence
 
 
-@dataclass
+@_node
 class Perm(Node):
     """
     Represents a list of statements that can be freely reordered in the abstract syntax tree.
@@ -298,3 +355,31 @@ class Perm(Node):
     """
     stats: list[Node]
     allow_reorder: bool = True
+
+
+# The leaves that repeat a lot in the code and have nothing to mutate are
+# shared by all the trees; see shared
+_LEAVES = {Nil: Nil(), Break: Break(), Ellipsis: Ellipsis()}
+_BOOLEANS = (Boolean(False), Boolean(True))
+_NUMERALS = (tuple(Numeral(i) for i in range(256)), tuple(Numeral(i, hex=True) for i in range(256)))
+
+
+def shared(node: Node) -> Node:
+    """
+    Returns the shared instance equal to a leaf node, if the node is nil, a
+    boolean, break, an ellipsis or a small integer numeral, otherwise the node
+    itself. Sharing them saves memory and makes the pickles smaller, but the
+    shared instances must never be mutated; replace them with new nodes.
+        Parameters:
+            node (Node): Node to share
+        Returns:
+            node (Node): The shared instance or the node itself
+    """
+    t = type(node)
+    if t is Numeral:
+        if node.fractional == 0 and node.exponent == 0 and 0 <= node.whole < 256:
+            return _NUMERALS[node.hex][node.whole]
+        return node
+    if t is Boolean:
+        return _BOOLEANS[bool(node.value)]
+    return _LEAVES.get(t, node)
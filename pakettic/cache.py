@@ -0,0 +1,134 @@
+import ctypes
+import hashlib
+import multiprocessing
+import os
+from typing import Optional
+
+
+def digest(*parts: bytes) -> int:
+    """Returns a non-zero 64-bit hash of the concatenation of the parts"""
+    h = hashlib.blake2b(digest_size=8)
+    for p in parts:
+        h.update(p)
+    return int.from_bytes(h.digest(), 'little') or 1
+
+
+class CostCache:
+    """
+    Least-recently-used cache from 64-bit keys to integer costs, shared by all
+    the processes of a pool. The table lives in shared memory, so that looking
+    up a key does not need any IPC. The table is set-associative: a key can be
+    stored only in one of the `ways` entries of its set, and the least recently
+    used entry of the set is evicted when the set is full.
+
+    The cache must be created before the pool and passed to the pool processes
+    e.g. in the initializer arguments.
+    """
+
+    def __init__(self, size: int, ways: int = 4):
+        self.ways = ways
+        self.sets = max(size // ways, 1)
+        n = self.sets * ways
+        self.keys = multiprocessing.RawArray('Q', n)  # 0 = empty entry
+        self.values = multiprocessing.RawArray('q', n)
+        self.stamps = multiprocessing.RawArray('Q', n)
+        self.counters = multiprocessing.RawArray('Q', 3)  # hits, misses, clock
+        self.lock = multiprocessing.Lock()
+
+    @property
+    def hits(self) -> int:
+        return self.counters[0]
+
+    @property
+    def misses(self) -> int:
+        return self.counters[1]
+
+    def get(self, key: int) -> Optional[int]:
+        """Returns the cost stored for key, or None if the key is not in the cache"""
+        start = key % self.sets * self.ways
+        with self.lock:
+            for i in range(start, start + self.ways):
+                if self.keys[i] == key:
+                    self.counters[0] += 1
+                    self.counters[2] += 1
+                    self.stamps[i] = self.counters[2]
+                    return self.values[i]
+            self.counters[1] += 1
+        return None
+
+    def put(self, key: int, value: int):
+        """Stores the cost of key, evicting the least recently used entry of the set if needed"""
+        start = key % self.sets * self.ways
+        with self.lock:
+            victim = start
+            for i in range(start, start + self.ways):
+                if self.keys[i] == key or self.keys[i] == 0:
+                    victim = i
+                    break
+                if self.stamps[i] < self.stamps[victim]:
+                    victim = i
+            self.counters[2] += 1
+            self.keys[victim] = key
+            self.values[victim] = value
+            self.stamps[victim] = self.counters[2]
+
+    def clear(self):
+        """Removes all the entries and zeroes the hit and miss counts"""
+        with self.lock:
+            for array in (self.keys, self.values, self.stamps, self.counters):
+                ctypes.memset(array, 0, ctypes.sizeof(array))
+
+
+class DiskCache:
+    """
+    Least-recently-used cache from string keys to byte strings, kept as files
+    in a directory so that it persists between runs, e.g. to skip parsing a
+    cart that has not changed. When the files take more than max_bytes, the
+    least recently used files are removed. Failing to read or write the cache
+    is not an error; the cache just misses.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Returns the data stored for key, or None if the key is not in the cache"""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)  # the modification time tells which files were used least recently
+        except OSError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Stores the data of key, evicting the least recently used files if needed"""
+        path = os.path.join(self.directory, key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)  # so that a concurrent or interrupted run never sees a partial file
+            self._evict()
+        except OSError:
+            pass
+
+    def _evict(self):
+        files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # removed by another process
+                pass
+            total -= size
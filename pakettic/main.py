@@ -1,9 +1,13 @@
 from cmath import inf
 import argparse
 import io
+import json
+import multiprocessing
 import pickle
+import queue
 import struct
-from typing import Callable
+from dataclasses import dataclass
+from typing import Callable, Optional
 from pakettic import ast
 from glob import glob
 import os
@@ -14,7 +18,7 @@ import zopfli
 import time
 import datetime
 
-from pakettic import parser, printer, optimize, ticfile
+from pakettic import cache, parser, printer, optimize, stats, ticfile
 import tqdm
 
 
@@ -68,7 +72,7 @@ def _check_positive(value):
 def main():
     global args
     """Main entrypoint for the command line program"""
-    sys.setrecursionlimit(100000)  # TODO: find out why the parser recurses so heavily and reduce that
+    sys.setrecursionlimit(100000)  # the syntax tree is printed and pickled recursively, and long chains of operators make it deep
 
     version = pkg_resources.get_distribution('pakettic').version
     argparser = argparse.ArgumentParser(
@@ -108,10 +112,18 @@ def main():
                           default="dlas")
     optgroup.add_argument('-s', '--steps', type=int, default=10000, metavar='int',
                           help='number of steps in the optimization algorithm. 0 = iterate forever (intermediate results saved). default: %(default)d')
+    optgroup.add_argument('--time-limit', type=float, default=0, metavar='float',
+                          help='stop after this many seconds per cart, even if --steps are not done. simulated annealing cools down in this time. 0 = no limit. default: %(default).0f')
+    optgroup.add_argument('--stall-steps', type=int, default=0, metavar='int',
+                          help='stop when the best solution has not improved in this many steps. 0 = never. default: %(default)d')
+    optgroup.add_argument('--stall-seconds', type=float, default=0, metavar='float',
+                          help='stop when the best solution has not improved in this many seconds. 0 = never. default: %(default).0f')
     optgroup.add_argument('-q', '--queue-length', type=_check_positive, default=12, metavar='int',
                           help='number of parallel jobs in queue. to use all CPUs, this should be >= number of logical processors. too long queue slows down convergence. default: %(default)d')
     optgroup.add_argument('-P', '--processes', type=_check_positive, default=None, metavar='int',
-                          help='number of parallel processes. 1 = no parallel processing. defaults to number of available logical processors.')
+                          help='number of parallel processes. 1 = no parallel processing. defaults to number of available logical processors, or 1 per cart with --jobs.')
+    optgroup.add_argument('-j', '--jobs', type=_check_positive, default=1, metavar='int',
+                          help='number of carts optimized concurrently, each in its own process with --processes processes. to keep all CPUs busy with many small carts, set this to the number of logical processors. default: %(default)d')
     optgroup.add_argument('-H', '--lahc-history', type=int, default=500, metavar='int',
                           help='history length in late acceptance hill climbing. default: %(default)d')
     optgroup.add_argument('-D', '--dlas-history', type=int, default=5, metavar='int',
@@ -128,6 +140,32 @@ def main():
                           help='used with --target-size to indicate that the size should be reached exactly')
     optgroup.add_argument('--seed', type=int, default=0, metavar='int',
                           help='random seed. default: %(default)d')
+    optgroup.add_argument('-I', '--islands', action='store_const', const=True, default=False,
+                          help='island mode: each process runs its own optimization for --steps steps, and the processes exchange their best solutions every --migrate steps. scales better to many processes. --queue-length is ignored.')
+    optgroup.add_argument('--migrate', type=int, default=500, metavar='int',
+                          help='in island mode, how often (in steps) islands migrate to the best solution of all islands. 0 = never. default: %(default)d')
+    optgroup.add_argument('--checkpoint', type=float, default=0, metavar='float',
+                          help='save the state of the optimization every this many seconds to <output>.checkpoint, so that it can be continued with --resume. 0 = no checkpoints. default: %(default).0f')
+    optgroup.add_argument('--resume', action='store_const', const=True, default=False,
+                          help='continue the optimization from <output>.checkpoint, if it exists. with -P1, continues exactly from where the checkpoint was saved')
+    optgroup.add_argument('--batch', type=_check_positive, default=1, metavar='int',
+                          help='number of mutations each process tries per task, returning the first that could be accepted or the best of them. default: %(default)d')
+    optgroup.add_argument('--adaptive', action=argparse.BooleanOptionalAction, default=False,
+                          help='choose the kinds of mutations adaptively, favouring the kinds that have recently improved the solution. default: %(default)s')
+    optgroup.add_argument('--screen', action=argparse.BooleanOptionalAction, default=True,
+                          help='compress candidates first with zlib, and with zopfli only if the zlib estimate is close to being accepted. default: %(default)s')
+    optgroup.add_argument('--screen-margin', type=int, default=2, metavar='int',
+                          help='how many bytes, on top of the smallest zopfli vs. zlib difference seen so far, the zlib estimate may be above the acceptance threshold before the candidate is screened out. default: %(default)d')
+    optgroup.add_argument('--stats', action='store_const', const=True, default=False,
+                          help='collect timings of the phases of the optimization and report them after each cart')
+    optgroup.add_argument('--stats-json', metavar='str',
+                          help='collect timings of the phases of the optimization and save them to this JSON file, keyed by the input file')
+    optgroup.add_argument('--cache-size', type=int, default=65536, metavar='int',
+                          help='number of compressed sizes cached, so that candidates printing to the same code are not recompressed. 0 = no cache. default: %(default)d')
+    optgroup.add_argument('--parse-cache-size', type=int, default=64, metavar='int',
+                          help='megabytes of parsed and minified code cached on disk, so that unchanged carts are not parsed again. 0 = no cache. default: %(default)d')
+    optgroup.add_argument('--parse-cache-dir', default=_default_parse_cache_dir(), metavar='str',
+                          help='directory of the parse cache. default: %(default)s')
     zopfligroup = argparser.add_argument_group('optional arguments for tuning zopfli')
     zopfligroup.add_argument('-z', '--zopfli-level', type=_parse_zopfli_level, default=_ZOPFLI_LEVELS[0], metavar='int',
                              help='generic compression level for zopfli, 0-5. default: 0')
@@ -139,6 +177,12 @@ def main():
                              help='maximum number of block splittings in zopfli (0: infinite). default: based on compression level')
     args = argparser.parse_args()
 
+    if args.islands and (args.checkpoint > 0 or args.resume):
+        argparser.error('checkpoints are not supported in the island mode')
+
+    if args.jobs > 1 and args.processes is None:
+        args.processes = 1
+
     if args.split is None:
         args.split = args.zopfli_level["split"]
     if args.split_max is None:
@@ -173,49 +217,233 @@ def main():
     if len(input) == 0:
         sys.exit('No input files found.')
     input = sorted(input)  # sort the input files so corpus will be reported in same order
-    filepbar = tqdm.tqdm(input, leave=False, smoothing=0.02)
+    filepbar = tqdm.tqdm(total=len(input), leave=False, smoothing=0.02)
     error = False
     total_original_size = 0
     total_minified_size = 0
     total_optimized_size = 0
     total_start_time = time.time()
     maxpathlen = max(len(p) for p in input)
-    for input_filepath in filepbar:
-        cart_start_time = time.time()
-        _, filename = os.path.split(os.path.splitext(input_filepath)[0])
-        if os.path.isdir(args.output):
-            if args.output_format == 'lua':
-                ext = '.lua'
-            else:
-                ext = '.tic'
-            output_filepath = os.path.join(
-                args.output, filename + '.packed' + ext)
-        else:
-            output_filepath = args.output
-        original_size = os.path.getsize(input_filepath)
-        try:
-            minified_size, optimized_size = _process_file(input_filepath, output_filepath, filepbar)
-        except KeyboardInterrupt:
+    if args.jobs > 1:
+        results = _process_concurrently(input, filepbar)
+    else:
+        results = _process_sequentially(input, filepbar)
+    for input_filepath, result, seconds in results:
+        if result is None:
             error = True
             filepbar.write(f"Interrupt processing {input_filepath}")
-            break
+            continue
+        if isinstance(result, _Failed):
+            error = True
+            filepbar.write(f"Failed processing {input_filepath}: the process exited with code {result.exitcode}")
+            continue
+        minified_size, optimized_size, extra, report = result
+        if report is not None and args.stats_json is not None:
+            _write_stats_json(args.stats_json, input_filepath, report)
+        original_size = os.path.getsize(input_filepath)
         total_original_size += original_size
         total_optimized_size += optimized_size
         total_minified_size += minified_size
-        cart_time_str = '.'.join(str(datetime.timedelta(seconds=int(time.time() - cart_start_time))).split(':'))
-        filepbar.write(f"{input_filepath.ljust(maxpathlen)} Time:{cart_time_str} Orig:{original_size:<5} Min:{minified_size:<5} Pack:{optimized_size:<5}")
+        cart_time_str = '.'.join(str(datetime.timedelta(seconds=int(seconds))).split(':'))
+        filepbar.write(f"{input_filepath.ljust(maxpathlen)} Time:{cart_time_str} Orig:{original_size:<5} Min:{minified_size:<5} Pack:{optimized_size:<5}{extra}")
+    filepbar.close()
     if len(input) > 1:
         total_time_str = str(datetime.timedelta(seconds=int(time.time() - total_start_time)))
         print("-" * 80 + f"\n{'Totals'.ljust(maxpathlen)} Time:{total_time_str} Orig:{total_original_size:<5} Min:{total_minified_size:<5} Pack:{total_optimized_size:<5}")
     sys.exit(1 if error else 0)
 
 
-def _process_file(input_path, output_filepath, pbar) -> tuple[int, int]:
+def _output_filepath(input_filepath: str) -> str:
+    if os.path.isdir(args.output):
+        _, filename = os.path.split(os.path.splitext(input_filepath)[0])
+        ext = '.lua' if args.output_format == 'lua' else '.tic'
+        return os.path.join(args.output, filename + '.packed' + ext)
+    return args.output
+
+
+def _process_sequentially(input: list[str], pbar):
+    """
+    Optimizes the carts one after another, yielding (input_filepath, result,
+    seconds) for each, where result is None if the user interrupted it
+    """
+    _create_shared()
+    # the pool processes are started only once and reused for all the carts
+    workers = None
+    if args.processes != 1 and not args.islands:
+        workers = optimize.Workers(args.processes or os.cpu_count(), _initializer, (args, costs, screen, stats.current))
+    try:
+        for input_filepath in input:
+            start_time = time.time()
+            try:
+                result = _process_file(input_filepath, _output_filepath(input_filepath), pbar, workers)
+            except KeyboardInterrupt:
+                yield input_filepath, None, time.time() - start_time
+                return
+            pbar.update()
+            yield input_filepath, result, time.time() - start_time
+    finally:
+        if workers is not None:
+            workers.terminate()
+
+
+def _process_concurrently(input: list[str], pbar):
+    """
+    Optimizes up to --jobs carts at the same time, each in its own process, and
+    yields (input_filepath, result, seconds) for each cart in the order of the
+    input, like _process_sequentially. When the user interrupts, the carts
+    being optimized are interrupted too. If the process of a cart dies without
+    reporting, e.g. killed when out of memory, its result is a _Failed.
+    """
+    results = multiprocessing.Queue()
+    # start the largest carts first, so that the batch does not end with one
+    # big cart running alone while the other processors are idle
+    pending = sorted(range(len(input)), key=lambda i: os.path.getsize(input[i]), reverse=True)
+    running = {}
+    done = {}
+    next_index = 0
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < args.jobs:
+                i = pending.pop(0)
+                running[i] = multiprocessing.Process(target=_process_job, args=(args, i, input[i], _output_filepath(input[i]), results))
+                running[i].start()
+            try:
+                message = _next_message(results, running)
+            except KeyboardInterrupt:
+                # the processes got the interrupt too; wait until they have stopped
+                while len(running) > 0:
+                    try:
+                        message = results.get(timeout=10)
+                    except queue.Empty:
+                        break
+                    running.pop(message[1]).join()
+                    if message[0] != 'error':
+                        done[message[1]] = message[2:]
+                for i in sorted(done):
+                    yield input[i], *done[i]
+                return
+            if message[1] not in running:
+                continue  # posted just before its process died, which was already reported as failed
+            running.pop(message[1]).join()
+            if message[0] == 'error':
+                raise message[2]
+            done[message[1]] = message[2:]
+            if message[0] != 'interrupted':
+                pbar.update()
+            while next_index in done:
+                yield input[next_index], *done.pop(next_index)
+                next_index += 1
+    finally:
+        for process in running.values():
+            process.terminate()
+
+
+@dataclass
+class _Failed:
+    """Result of a cart whose process died without reporting a result, e.g. killed when out of memory"""
+    exitcode: int
+
+
+def _next_message(results, running: dict) -> tuple:
+    """
+    Waits for the next message from the processes optimizing the carts. The
+    processes are polled while waiting, and a process that died without
+    posting its result gives the message ('failed', index, _Failed, 0).
+    """
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            for i, process in running.items():
+                if process.exitcode is not None and process.exitcode != 0:
+                    return 'failed', i, _Failed(process.exitcode), 0
+
+
+def _process_job(a, index: int, input_path: str, output_filepath: str, results):
+    """Optimizes one cart in its own process, when processing several carts concurrently"""
+    global args
+    args = a
+    sys.stderr = open(os.devnull, 'w')  # the progress bars of the carts would garble the output
+    try:
+        for _, result, seconds in _process_sequentially([input_path], tqdm.tqdm(disable=True)):
+            results.put(('done' if result is not None else 'interrupted', index, result, seconds))
+    except Exception as e:
+        results.put(('error', index, e))
+
+
+def _create_shared():
+    """
+    Creates the cost cache, the screen and the statistics, which are shared
+    with the pool processes. Shared memory can be passed to the pool processes
+    only when they start, so these are created once and reset for each cart.
+    """
+    global costs, screen
+    # the uncompressed formats are so fast to write that caching them is not worth it
+    costs = cache.CostCache(args.cache_size) if args.cache_size > 0 and args.output_format in ('tic', 'png') else None
+    screen = _Screen(0) if args.screen and args.output_format in ('tic', 'png') else None
+    stats.current = stats.Stats() if args.stats or args.stats_json is not None else None
+
+
+def _default_parse_cache_dir() -> str:
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pakettic')
+
+
+_tree_digest = None
+
+
+def _tree_sources_digest() -> bytes:
+    """
+    Returns a digest of the source code of the modules that build the syntax
+    trees in the parse cache, so that the trees cached by another version of
+    pakettic, or by a locally edited one, are not reused
+    """
+    global _tree_digest
+    if _tree_digest is None:
+        sources = []
+        for module in (ast, parser, optimize):
+            with open(module.__file__, 'rb') as file:
+                sources.append(file.read())
+        _tree_digest = cache.digest(*sources).to_bytes(8, 'little')
+    return _tree_digest
+
+
+def _parse(code: bytes) -> ast.Node:
+    """
+    Parses the code, converts loads to functions and minifies it. The result is
+    cached on disk, keyed by the code and the source code of pakettic, so that
+    an unchanged cart is not parsed again.
+        Parameters:
+            code (bytes): the code of the cart
+        Returns:
+            root (ast.Node): Root of the minified abstract syntax tree
+    """
+    parse_cache = cache.DiskCache(args.parse_cache_dir, args.parse_cache_size << 20) if args.parse_cache_size > 0 else None
+    if parse_cache is not None:
+        key = f'{cache.digest(_tree_sources_digest(), code):016x}.pickle'
+        data = parse_cache.get(key)
+        if data is not None:
+            try:
+                return pickle.loads(data)
+            except Exception:  # e.g. a corrupted file; parse again and overwrite it
+                pass
+    root = parser.parse_string(code.decode('latin-1'))
+    root = optimize.loads_to_funcs(root)
+    root = optimize.minify(root)
+    if parse_cache is not None:
+        parse_cache.put(key, pickle.dumps(root))
+    return root
+
+
+def _process_file(input_path, output_filepath, pbar, workers: Optional[optimize.Workers] = None) -> tuple[int, int, str, Optional[dict]]:
     # These are global for performance reasons. When multiprocessing, globals
     # are not copied to child processes, so we pass them as arguments to the
-    # process initialize (_initializer) function, which set the globals for that
-    # process
-    global args, writer
+    # process initialize (_initializer) function and the per-cart setup
+    # function (_setup), which set the globals for that process
+    global args, writer, fast_writer, costs, writer_key, screen
 
     input_sliced = input_path[-30:] if len(input_path) > 30 else input_path
     pbar.set_description(f"Processing    {input_sliced}")
@@ -229,37 +457,80 @@ def _process_file(input_path, output_filepath, pbar) -> tuple[int, int]:
         cart = ticfile.data_to_code(cart)
 
     pbar.set_description(f"Compressing   {input_sliced}")
-    root = parser.parse_string(cart.code.decode('latin-1'))
-    root = optimize.loads_to_funcs(root)
-    root = optimize.minify(root)
-    root = ast.Hint(root)
+    root = ast.Hint(_parse(cart.code))
     # writer caches as much as possible of the data writing so that we don't have to recompute data parts for each optimization step
     writer = _make_writer(cart.data)
+    writer_key = pickle.dumps(writer)
+    if costs is not None:
+        costs.clear()
     minified_size, finisher = writer(_format(root))
-    with open(output_filepath, 'wb') as output_file:
-        final_size = finisher(output_file)
-    assert final_size == minified_size
+    fast_writer = None
+    if screen is not None:
+        fast_writer = _make_writer(cart.data, fast=True)
+        # calibrate how much smaller the cart gets when compressed with zopfli instead of zlib
+        screen.reset(minified_size - fast_writer(_format(root))[0])
+    checkpoint = output_filepath + '.checkpoint' if args.checkpoint > 0 or args.resume else None
+    final_size = None
+    if not (args.resume and checkpoint is not None and os.path.exists(checkpoint)):
+        with open(output_filepath, 'wb') as output_file:
+            final_size = finisher(output_file)
+        assert final_size == minified_size
+    # else the best solution of the checkpoint gets written, when it is restored
 
     def _best_func(state, cf):
         nonlocal final_size
         cand_size, finisher = cf
+        if type(finisher) is _Reprint:
+            finisher.state = state
         with open(output_filepath, 'wb') as output_file:
             final_size = finisher(output_file)
         assert final_size == cand_size
+        if stats.current is not None:
+            stats.current.improved(final_size)
         if args.print_best:
             pbar.write(f"-- {final_size} bytes:\n{'-'*40}\n{printer.format(pickle.loads(state)[0], pretty=True).strip()}\n{'-'*40}")
 
     # only PNG carts cab benefit from data chunk order shuffling
     data = cart.data if args.output_format == 'png' else None
 
-    with optimize.Solutions((root, data), args.seed, args.queue_length, args.processes, _cost_func, _best_func, _initializer, (args, writer)) as solutions:
-        if args.algorithm == 'lahc':
-            optimize.lahc(solutions, steps=args.steps, list_length=args.lahc_history, init_margin=args.margin)
-        elif args.algorithm == 'dlas':
-            optimize.dlas(solutions, steps=args.steps, list_length=args.dlas_history, init_margin=args.margin)
-        else:
-            optimize.anneal(solutions, steps=args.steps, start_temp=args.start_temp, end_temp=args.end_temp, seed=args.seed)
-    return minified_size, final_size
+    stopping = dict(time_limit=args.time_limit, stall_steps=args.stall_steps, stall_seconds=args.stall_seconds)
+    if args.algorithm == 'lahc':
+        algorithm, kwargs = optimize.lahc, dict(steps=args.steps, list_length=args.lahc_history, init_margin=args.margin, **stopping)
+    elif args.algorithm == 'dlas':
+        algorithm, kwargs = optimize.dlas, dict(steps=args.steps, list_length=args.dlas_history, init_margin=args.margin, **stopping)
+    else:
+        algorithm, kwargs = optimize.anneal, dict(steps=args.steps, start_temp=args.start_temp, end_temp=args.end_temp, seed=args.seed, **stopping)
+    if stats.current is not None:
+        stats.current.reset()
+    operators = None
+    if args.islands:
+        initargs = ((args, costs, screen, stats.current), (writer, fast_writer))
+        optimize.islands((root, data), args.seed, args.processes or os.cpu_count(), _cost_func, _best_func, algorithm, kwargs,
+                         args.migrate, batch=args.batch, init=_initialize_island, initargs=initargs, adaptive=args.adaptive)
+    else:
+        with optimize.Solutions((root, data), args.seed, args.queue_length, args.processes, _cost_func, _best_func, _setup, (writer, fast_writer), args.batch,
+                                checkpoint, args.checkpoint if args.checkpoint > 0 else inf, args.resume, workers, args.adaptive) as solutions:
+            algorithm(solutions, **kwargs)
+        operators = solutions.operators.report()
+    extra = ""
+    if costs is not None:
+        extra += f" Hits:{costs.hits / max(costs.hits + costs.misses, 1):.0%}"
+    if screen is not None:
+        screened, compressed = screen.counts
+        extra += f" Screened:{screened / max(screened + compressed, 1):.0%}"
+    report = None
+    if stats.current is not None:
+        report = stats.current.report(args.processes or os.cpu_count())
+        # how many candidates were already visited, i.e. found in the cost cache, and how many were screened out
+        if costs is not None:
+            report['cache'] = {'hits': costs.hits, 'misses': costs.misses}
+        if screen is not None:
+            report['screen'] = {'screened': screen.counts[0], 'compressed': screen.counts[1]}
+        if operators is not None:
+            report['operators'] = operators
+        if args.stats:
+            extra += "\n" + stats.format_report(report)
+    return minified_size, final_size, extra, report
 
 
 def _compress(bytes=None):
@@ -269,39 +540,168 @@ def _compress(bytes=None):
     return (c.compress(bytes) + c.flush())
 
 
+def _write_stats_json(path: str, input_path: str, report: dict):
+    """Adds the report of a cart to a JSON file, keyed by the input path"""
+    reports = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            reports = json.load(file)
+    reports[input_path] = report
+    with open(path, 'w') as file:
+        json.dump(reports, file, indent=2)
+
+
+def _compress_fast(bytes=None):
+    return zlib.compress(bytes, 9)
+
+
 def _format(root: ast.Node) -> bytes:
     global args
-    return printer.format(root, no_load=args.no_load).encode('latin-1')
+    # the states are mutated only through the mutation index, which resets the caches of the printer
+    return printer.format_bytes(root, no_load=args.no_load, cached=True)
 
 
-def _make_writer(data) -> ticfile.Writer:
+def _make_writer(data, fast=False) -> ticfile.Writer:
     global args
+    compress = _compress_fast if fast else _compress
     if args.output_format == 'lua':
         return ticfile.write_lua(data)
     elif args.output_format == 'png':
-        return ticfile.write_png(data, args.pedantic, _compress)
+        return ticfile.write_png(data, args.pedantic, compress)
     elif args.output_format == 'unc':
         return ticfile.write_tic(data, args.pedantic, None)
     else:
-        return ticfile.write_tic(data, args.pedantic, _compress)
+        return ticfile.write_tic(data, args.pedantic, compress)
 
 
 def _initializer(a):
-    global args, writer
-    args, writer = a
+    global args, costs, screen
+    args, costs, screen, stats.current = a
+
+
+def _setup(a):
+    global writer, fast_writer, writer_key
+    writer, fast_writer = a
+    writer_key = pickle.dumps(writer)
+
+
+def _initialize_island(a):
+    _initializer(a[0])
+    _setup(a[1])
 
 
-def _cost_func(root_data):
-    global args, writer
+def _cost_func(root_data, threshold):
+    global args, writer, fast_writer, costs, writer_key, screen
     root, data = root_data
-    if data is not None:  # PNG carts shuffle the data chunks so we cannot cache the data parts & have to regenerate writer for each step
-        cand_size, finisher = _make_writer(data)(_format(root))
-    else:
-        cand_size, finisher = writer(_format(root))
-    cand_cost = cand_size - args.target_size
+    if args.output_format == 'lua':
+        # the size of a lua cart is just the length of the code and the data,
+        # so the code is measured instead of printed, and the measurement of
+        # the unchanged subtrees is reused
+        with stats.timer('format'):
+            cand_size = printer.measure(root, no_load=args.no_load) + len(writer.data)
+        return _size_cost(cand_size), (cand_size, _Reprint())
+    with stats.timer('format'):
+        code = _format(root)
+    cand_size = None
+    if costs is not None:
+        with stats.timer('cache'):
+            # the data chunks are the same in every candidate, only their order changes
+            key = cache.digest(writer_key, code, b'' if data is None else bytes(b for bank, id, _ in data for b in (bank, id)))
+            cand_size = costs.get(key)
+        if cand_size is not None:
+            finisher = _Recompress(code, data)
+    if cand_size is None:
+        fast_size = None
+        if screen is not None and threshold < inf:
+            with stats.timer('screen'):
+                fast_size = (fast_writer if data is None else _make_writer(data, fast=True))(code)[0]
+            est_size = fast_size + screen.offset.value - args.screen_margin
+            est_cost = est_size - args.target_size
+            if args.exact:
+                est_cost = max(est_cost, 0)  # est_size is a lower bound for the size, so cannot take abs
+            if est_cost > threshold:
+                # the candidate will be rejected, so the estimate will do. If
+                # the cart ever gets written, the finisher compresses it properly
+                with screen.counts.get_lock():
+                    screen.counts[0] += 1
+                return est_cost, (est_size, _Recompress(code, data))
+        with stats.timer('compress'):
+            if data is not None:  # PNG carts shuffle the data chunks so we cannot cache the data parts & have to regenerate writer for each step
+                cand_size, finisher = _make_writer(data)(code)
+            else:
+                cand_size, finisher = writer(code)
+        if fast_size is not None:
+            screen.update(cand_size - fast_size)
+        if costs is not None:
+            costs.put(key, cand_size)
+    return _size_cost(cand_size), (cand_size, finisher)
+
+
+def _size_cost(size: int) -> int:
+    cost = size - args.target_size
     if args.exact:
-        cand_cost = abs(cand_cost)
-    return cand_cost, (cand_size, finisher)
+        cost = abs(cost)
+    return cost
+
+
+class _Screen:
+    """
+    State of the zlib screen, shared by all the processes: the smallest
+    difference between the zopfli and zlib sizes of a cart seen so far, and
+    how many candidates were screened out / compressed with zopfli
+    """
+
+    def __init__(self, offset: int):
+        self.offset = multiprocessing.Value('q', offset)
+        self.counts = multiprocessing.Array('Q', 2)
+
+    def reset(self, offset: int):
+        """Starts screening a new cart, whose zopfli size was offset bytes from its zlib size"""
+        self.offset.value = offset
+        self.counts[:] = [0, 0]
+
+    def update(self, offset: int):
+        """Records a fully compressed candidate, whose zopfli size was offset bytes from its zlib size"""
+        with self.offset.get_lock():
+            if offset < self.offset.value:
+                self.offset.value = offset
+        with self.counts.get_lock():
+            self.counts[1] += 1
+
+
+@dataclass
+class _Recompress:
+    """
+    Finisher for candidates found in the cost cache: the cart is compressed
+    again only if it actually gets written
+    """
+    code: bytes
+    data: Optional[list[ticfile.Chunk]]
+
+    def __post_init__(self):
+        # the order of the chunks is the resident state, which is rolled back
+        # to the parent right after the candidate has been evaluated
+        if self.data is not None:
+            self.data = list(self.data)
+
+    def __call__(self, file) -> int:
+        w = writer if self.data is None else _make_writer(self.data)
+        return w(self.code)[1](file)
+
+
+@dataclass
+class _Reprint:
+    """
+    Finisher for candidates that were measured instead of printed: the state
+    is printed only if the cart actually gets written. The state is filled in
+    by _best_func, as the cost function does not have it pickled.
+    """
+    state: Optional[bytes] = None
+
+    def __call__(self, file) -> int:
+        root, data = pickle.loads(self.state)
+        w = writer if data is None else _make_writer(data)
+        return w(_format(root))[1](file)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,23 @@
 from collections import deque
-from functools import singledispatch, wraps
+from queue import SimpleQueue
+from functools import wraps
 import inspect
 import itertools
 import math
+import multiprocessing
+import os
 import pickle
 import signal
 import random
-from typing import Any, Callable, Optional, Tuple, get_args, get_origin, get_type_hints
+import sys
+import time
+import weakref
+from typing import Any, Callable, Optional, Tuple, Union, get_args, get_origin, get_type_hints
 import tqdm
-from pakettic import ast, parser
-from dataclasses import dataclass, replace
+from pakettic import ast, parser, printer, stats
+from dataclasses import dataclass, fields as dataclass_fields
 from multiprocessing import Pool
+from multiprocessing.managers import SyncManager
 
 
 def _toBase26(num):
@@ -81,7 +88,7 @@ def minify(root: ast.Node) -> ast.Node:
         Returns:
             new_root (ast.Node): Root of the new, mutated abstract syntax tree
     """
-    new_root = pickle.loads(pickle.dumps(root))  # pickling/unpickling is faster than deepcopy
+    new_root = apply_trans(root, lambda node: node)  # copies the tree; faster than deepcopy and, unlike pickling, does not recurse
     changed_names = dict()
     changed_labels = dict()
     name_iter = iter((name for i in itertools.count(start=1, step=1) if (name := _toBase26(i)) not in _RESERVED and name not in parser.keywords))
@@ -118,143 +125,502 @@ def mutate(root_order: tuple[ast.Node, list], rand: random.Random):
                 nil if chunk shuffling not wanted). These will get modified, so deep
                 copy them before calling this function if needed.
             rand (random.Random): Random number generator to use
+
+    The possible mutations are kept in a _MutationIndex, which is built on the
+    first call and reused while the same root is mutated again. Thus, the tree
+    should not be modified by other means between the calls.
     """
+    index = _mutation_index(root_order)
+    mutation = index.sample(rand)
+    if mutation is not None:
+        index.apply(*mutation)
+
+
+_last_index = None
+
+
+def _mutation_index(root_order: tuple[ast.Node, list]) -> '_MutationIndex':
+    """Returns the mutation index of the state, building a new one if the state is not the one indexed last"""
+    global _last_index
     root, order = root_order
-    mutations = []
-    used_names = set()
-    used_labels = set()
+    if _last_index is None or _last_index.root is not root or _last_index.order is not order:
+        _last_index = _MutationIndex(root, order)
+    return _last_index
+
+
+# Mutations that are local to a single node. Their counts are kept per node in
+# the index, so that they can be sampled in O(log n)
+_NODE_KINDS = ('flip', 'reorder', 'reorder_left', 'square', 'unsquare',
+               'fold', 'alt', 'perm', 'oneline', 'step', 'quotes', 'hex')
+# Mutations that are not tied to a single node
+_GLOBAL_KINDS = ('name', 'label', 'chunk')
+_KINDS = _NODE_KINDS + _GLOBAL_KINDS
+# With adaptive sampling, the share of the mutations whose kind is chosen by
+# the weights of the kinds; the rest are chosen uniformly from all the
+# mutations, so that no kind is ever starved
+_ADAPTIVE_SHARE = 0.5
+_LOWERS_SET = set(_LOWERS)
+
+
+def _fold_value(node: ast.BinOp) -> Optional[int]:
+    """Returns the value of a constant binary operation, if it can be folded into a single integer numeral"""
+    if node.op not in _EVALUABLE_OPS or type(node.left) != ast.Numeral or type(node.right) != ast.Numeral:
+        return None
+    try:
+        value = _EVALUABLE_OPS[node.op](node.left.value, node.right.value)
+        if value is None or int(value) != value:
+            return None
+        return int(value)
+    except (ArithmeticError, ValueError):  # e.g. division by zero or infinities
+        return None
+
+
+def _reorder_chain(node: ast.BinOp, i: int) -> list[ast.BinOp]:
+    """Returns the chain of left descendants of node that can be reordered with node"""
+    chain = []
+    while type(node.left) == ast.BinOp and node.left.op in _REORDERABLE_RIGHT[i]:
+        node = node.left
+        chain.append(node)
+    return chain
+
+
+def _node_mutations(node: ast.Node) -> dict[str, int]:
+    """Returns the number of mutations of each kind that can be applied to a node"""
+    counts = {}
+    t = type(node)
+    if t == ast.BinOp:
+        if node.op in _FLIPPABLE_OPS:
+            counts['flip'] = 1
+        if node.op in _REORDERABLE_OPS:
+            i = _REORDERABLE_OPS.index(node.op)
+            depth = len(_reorder_chain(node, i))
+            if depth > 0:
+                counts['reorder'] = depth
+            if _REORDERABLE_LEFT[i]:
+                counts['reorder_left'] = 1
+        if node.op == "*" and node.left == node.right:
+            counts['square'] = 1
+        if node.op == "^" and node.right == _TWO:
+            counts['unsquare'] = 1
+        if _fold_value(node) is not None:
+            counts['fold'] = 1
+    elif t == ast.Alt:
+        if len(node.alts) > 1:
+            counts['alt'] = len(node.alts) - 1
+    elif t == ast.Perm:
+        if node.allow_reorder and len(node.stats) > 1:
+            counts['perm'] = len(node.stats) * (len(node.stats) - 1) // 2
+    elif t == ast.Func:
+        if len(node.args) == 0 or (len(node.args) == 1 and type(node.args[0]) == ast.Ellipsis):
+            counts['oneline'] = 1
+    elif t == ast.ForRange:
+        if node.step is None or node.step == ast.Numeral(1):
+            counts['step'] = 1
+    elif t == ast.Hint:
+        counts['quotes'] = 1
+        counts['hex'] = 1
+    return counts
+
+
+def _swap_count(names: list[str]) -> int:
+    """Number of ways to swap the names with the single letter names"""
+    return sum(len(_LOWERS) - (a in _LOWERS_SET) for a in names)
+
+
+def _swap_pair(names: list[str], r: int) -> tuple[str, str]:
+    """Returns the r:th pair in the enumeration of _swap_count"""
+    for a in names:
+        n = len(_LOWERS) - (a in _LOWERS_SET)
+        if r < n:
+            return a, [b for b in _LOWERS if b != a][r]
+        r -= n
+
+
+class _Fenwick:
+    """
+    Binary indexed tree of non-negative integer weights, for finding the item
+    containing a given cumulative weight and for updating weights in O(log n)
+    """
+    weights: list[int]
+    tree: list[int]
+
+    def __init__(self, weights: list[int]):
+        n = 1
+        while n < len(weights):
+            n *= 2
+        self.weights = weights + [0] * (n - len(weights))
+        prefix = [0] + list(itertools.accumulate(self.weights))
+        self.tree = [prefix[i] - prefix[i - (i & -i)] for i in range(n + 1)]
+
+    def set(self, i: int, weight: int):
+        while i >= len(self.weights):
+            self.__init__(self.weights + [0] * len(self.weights))
+        delta = weight - self.weights[i]
+        if delta == 0:
+            return
+        self.weights[i] = weight
+        n = len(self.weights)
+        i += 1
+        while i <= n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, r: int) -> tuple[int, int]:
+        """Returns the index of the item containing cumulative weight r and the offset of r within it"""
+        pos = 0
+        step = len(self.weights)
+        while step > 0:
+            nxt = pos + step
+            if nxt <= len(self.weights) and self.tree[nxt] <= r:
+                pos = nxt
+                r -= self.tree[nxt]
+            step //= 2
+        return pos, r
+
+
+class _MutationIndex:
+    """
+    Index of all the mutations that can be applied to a state. Each node of the
+    tree gets a slot, which records the parent and the children of the node and
+    the number of node-local mutations of each kind. Sampling a mutation is
+    O(log n) and applying a mutation only updates the slots of the touched
+    subtree and its ancestors, so the tree is walked only once, when the index
+    is built.
+    """
 
-    def _check_mutations(node: ast.Node, parent: ast.Node, attr: str):
-        if type(node) == ast.BinOp:
-            try:
-                i = _FLIPPABLE_OPS.index(node.op)
-
-                def _mutation():
-                    node.left, node.right = node.right, node.left
-                    node.op = _FLIPPED_OPS[i]
-                mutations.append(_mutation)
-            except:
-                pass
-            try:
-                i = _REORDERABLE_OPS.index(node.op)
-                node2 = node
-                while type(node2.left) == ast.BinOp and node2.left.op in _REORDERABLE_RIGHT[i]:
-                    def _mutation(a=node2.left, b=node):
-                        a.right, b.right = b.right, a.right
-                        a.op, b.op = b.op, a.op
-                    mutations.append(_mutation)
-                    node2 = node2.left
-                if _REORDERABLE_LEFT[i]:
-                    def _mutation():
-                        node2.left, node.right = node.right, node2.left
-                    mutations.append(_mutation)
-            except:
-                pass
-            if node.op == "*" and node.left == node.right:
-                def _mutation():
-                    node.op = "^"
-                    node.right = _TWO
-                mutations.append(_mutation)
-            if node.op == "^" and node.right == _TWO:
-                def _mutation():
-                    node.op = "*"
-                    node.right = pickle.loads(pickle.dumps(node.left))
-                mutations.append(_mutation)
-            if node.op in _EVALUABLE_OPS and type(node.left) == ast.Numeral and type(node.right) == ast.Numeral:
-                value = _EVALUABLE_OPS[node.op](node.left.value, node.right.value)
-                if value != None and int(value) == value:
-                    def _mutation():
-                        replace_node(parent, attr, ast.Numeral(int(value)), node)
-                    mutations.append(_mutation)
-        elif type(node) == ast.Name:
-            used_names.add(node.id)
-        elif type(node) == ast.Label:
-            used_labels.add(node.name)
-        elif type(node) == ast.Goto:
-            used_labels.add(node.target)
-        elif type(node) == ast.Alt:
-            for i, _ in enumerate(node.alts[1:]):
-                def _mutation(i=i):
-                    node.alts[0], node.alts[i + 1] = node.alts[i + 1], node.alts[0]
-                mutations.append(_mutation)
-        elif type(node) == ast.Perm:
-            if node.allow_reorder:
-                for i in range(len(node.stats)):
-                    for j in range(i + 1, len(node.stats)):
-                        def _mutation(i=i, j=j):
-                            node.stats[i], node.stats[j] = node.stats[j], node.stats[i]
-                        mutations.append(_mutation)
-        elif type(node) == ast.Func:
-            if len(node.args) == 0 or (len(node.args) == 1 and type(node.args[0]) == ast.Ellipsis):
-                def _mutation():
-                    node.oneline = not node.oneline
-                mutations.append(_mutation)
-        elif type(node) == ast.ForRange:
-            if node.step is None or node.step == ast.Numeral(1):
-                def _mutation():
-                    node.step = ast.Numeral(1) if node.step is None else None
-                mutations.append(_mutation)
-        elif type(node) == ast.Hint:
-            def _mutation():
-                node.double_quotes = not node.double_quotes
-            mutations.append(_mutation)
-
-            def _mutation2():
-                node.no_hex = not node.no_hex
-            mutations.append(_mutation2)
-
-        if node.original != None and parent != None:
-            def _mutation():
-                replace_node(parent, attr, node.original, None)
-
-    visit(root, _check_mutations)
-    used_names = sorted(used_names.difference(_RESERVED))
-
-    def var_repl(id_a, id_b):
-        def _mut():
-            def _repl(node, parent, attr):
-                if type(node) == ast.Name:
-                    if node.id == id_a:
-                        node.id = id_b
-                    elif node.id == id_b:
-                        node.id = id_a
-            visit(root, _repl)
-        return _mut
-    # if both a and b are in used_names, we have both copies of a,b and b,a in the list
-    # but that's probably ok: swapping variables head to head is usually better idea
-    # that swapping variables with new ones
-    mutations.extend((var_repl(a, b) for a in used_names for b in _LOWERS if a != b))
-
-    def label_repl(name_a, name_b):
-        def _mut():
-            def _repl(node, parent, attr):
-                if type(node) == ast.Label:
-                    if node.name == name_a:
-                        node.name = name_b
-                    elif node.name == name_b:
-                        node.name = name_a
-                if type(node) == ast.Goto:
-                    if node.target == name_a:
-                        node.target = name_b
-                    elif node.target == name_b:
-                        node.target = name_a
-            visit(root, _repl)
-        return _mut
-    used_labels = sorted(used_labels)
-    mutations.extend((label_repl(a, b)
-                     for a in used_labels for b in _LOWERS if a != b))
-
-    if order is not None and len(order) > 0:
-        def chunk_swap(i, j: int):
-            def _mut():
-                order[i], order[j] = order[j], order[i]
-            return _mut
-        mutations.extend(chunk_swap(i, j) for i, _ in enumerate(
-            order) for j, _ in enumerate(order) if j > i)
-
-    if len(mutations) > 0:
-        mutation = rand.choice(mutations)
-        mutation()
+    def __init__(self, root: ast.Node, order: Optional[list]):
+        self.root = root
+        self.order = order
+        self.nodes = []  # slot -> node, None for free slots
+        self.parents = []  # slot -> parent slot, -1 for the root
+        self.attrs = []  # slot -> attribute of the parent referencing the node, as in replace_node
+        self.children = []  # slot -> dict from attribute to child slot
+        self.counts = []  # slot -> dict from mutation kind to number of such mutations
+        self.free = []
+        self.names = dict()  # Name.id -> set of slots
+        self.labels = dict()  # Label.name or Goto.target -> set of slots
+        self.kind_totals = dict.fromkeys(_NODE_KINDS, 0)
+        self.trees = dict()  # kind -> _Fenwick, built lazily when the kind is sampled for the first time
+        self._add(root, -1, None)
+
+    def _add(self, node: ast.Node, parent: int, attr: Optional[str]) -> int:
+        """Adds the subtree rooted at node to the index, returning the slot of node"""
+        slots = dict()
+        nodes, parents, attrs, children, counts, totals = \
+            self.nodes, self.parents, self.attrs, self.children, self.counts, self.kind_totals
+
+        def _visitor(n: ast.Node, p: ast.Node, a: str):
+            if len(self.free) > 0:
+                slot = self.free.pop()
+            else:
+                slot = len(nodes)
+                nodes.append(None)
+                parents.append(-1)
+                attrs.append(None)
+                children.append(None)
+                counts.append(None)
+            if len(slots) == 0:
+                p, a = parent, attr
+            else:
+                p = slots[id(p)]
+            slots[id(n)] = slot
+            nodes[slot] = n
+            children[slot] = dict()
+            self._link(p, a, slot)
+            t = type(n)
+            if t == ast.Name:
+                self.names.setdefault(n.id, set()).add(slot)
+            elif t == ast.Label:
+                self.labels.setdefault(n.name, set()).add(slot)
+            elif t == ast.Goto:
+                self.labels.setdefault(n.target, set()).add(slot)
+            c = counts[slot] = _node_mutations(n)
+            for kind, count in c.items():
+                totals[kind] += count
+                if kind in self.trees:
+                    self.trees[kind].set(slot, count)
+
+        visit(node, _visitor)
+        return slots[id(node)]
+
+    def _remove(self, slot: int):
+        """Removes the subtree rooted at slot from the index"""
+        stack = [slot]
+        del self.children[self.parents[slot]][self.attrs[slot]]
+        while len(stack) > 0:
+            s = stack.pop()
+            n = self.nodes[s]
+            if type(n) == ast.Name:
+                self._discard(self.names, n.id, s)
+            elif type(n) == ast.Label:
+                self._discard(self.labels, n.name, s)
+            elif type(n) == ast.Goto:
+                self._discard(self.labels, n.target, s)
+            for kind, count in self.counts[s].items():
+                self.kind_totals[kind] -= count
+                if kind in self.trees:
+                    self.trees[kind].set(s, 0)
+            stack.extend(self.children[s].values())
+            self.nodes[s] = self.children[s] = self.counts[s] = None
+            self.free.append(s)
+
+    @staticmethod
+    def _discard(d: dict, key: str, slot: int):
+        d[key].discard(slot)
+        if len(d[key]) == 0:
+            del d[key]
+
+    def _link(self, parent: int, attr: str, child: int):
+        self.parents[child] = parent
+        self.attrs[child] = attr
+        if parent >= 0:
+            self.children[parent][attr] = child
+
+    def _recount(self, slot: int):
+        old = self.counts[slot]
+        new = _node_mutations(self.nodes[slot])
+        if old != new:
+            for kind in old.keys() | new.keys():
+                count = new.get(kind, 0)
+                self.kind_totals[kind] += count - old.get(kind, 0)
+                if kind in self.trees:
+                    self.trees[kind].set(slot, count)
+        self.counts[slot] = new
+
+    def _recount_up(self, slot: int, done: Optional[set] = None, remeasure: bool = True):
+        """
+        Recounts the mutations of a node and all its ancestors, as they might
+        depend on the subtree, and resets their printer caches; the cache of
+        printer.measure is kept if told that the lengths cannot have changed
+        """
+        while slot >= 0:
+            if done is not None:
+                if slot in done:
+                    return
+                done.add(slot)
+            node = self.nodes[slot]
+            node.printed = None
+            if remeasure:
+                node.measured = None
+            self._recount(slot)
+            slot = self.parents[slot]
+
+    def _replace(self, slot: int, node: ast.Node) -> int:
+        """Replaces the subtree at slot with node, which should already be referenced by the parent. Returns the new slot."""
+        parent, attr = self.parents[slot], self.attrs[slot]
+        self._remove(slot)
+        new_slot = self._add(node, parent, attr)
+        self._recount_up(parent)
+        return new_slot
+
+    def _used_names(self) -> list[str]:
+        return sorted(n for n in self.names if n not in _RESERVED)
+
+    def _used_labels(self) -> list[str]:
+        return sorted(self.labels)
+
+    def totals(self) -> dict[str, int]:
+        """Returns the number of possible mutations of each kind"""
+        ret = dict(self.kind_totals)
+        ret['name'] = _swap_count(self._used_names())
+        ret['label'] = _swap_count(self._used_labels())
+        n = len(self.order) if self.order is not None else 0
+        ret['chunk'] = n * (n - 1) // 2
+        return ret
+
+    def sample(self, rand: random.Random, weights: Optional[dict[str, float]] = None) -> Optional[tuple[str, int, Any]]:
+        """
+        Chooses uniformly one of all the possible mutations, or with weights,
+        part of the time chooses first the kind in proportion to the weights
+        and then uniformly one of the mutations of that kind
+            Parameters:
+                rand (random.Random): Random number generator to use
+                weights (dict[str,float]): weight of each kind, see _Operators
+            Returns:
+                mutation (tuple[str,int,Any]): kind of the mutation, slot of the node and the argument of the mutation, or None if there is nothing to mutate
+        """
+        totals = self.totals()
+        total = sum(totals.values())
+        if total == 0:
+            return None
+        if weights is not None and rand.random() < _ADAPTIVE_SHARE:
+            kinds = [k for k, count in totals.items() if count > 0]
+            kind = rand.choices(kinds, [weights[k] for k in kinds])[0]
+            r = rand.randrange(totals[kind])
+        else:
+            r = rand.randrange(total)
+            for kind, count in totals.items():
+                if r < count:
+                    break
+                r -= count
+        if kind == 'name':
+            return kind, -1, _swap_pair(self._used_names(), r)
+        if kind == 'label':
+            return kind, -1, _swap_pair(self._used_labels(), r)
+        if kind == 'chunk':
+            i = 0
+            while r >= len(self.order) - 1 - i:
+                r -= len(self.order) - 1 - i
+                i += 1
+            return kind, -1, (i, i + 1 + r)
+        if kind not in self.trees:
+            self.trees[kind] = _Fenwick([c.get(kind, 0) if c is not None else 0 for c in self.counts])
+        slot, r = self.trees[kind].find(r)
+        if kind == 'reorder_left':
+            node = self.nodes[slot]
+            return kind, slot, len(_reorder_chain(node, _REORDERABLE_OPS.index(node.op)))
+        if kind == 'perm':
+            n = len(self.nodes[slot].stats)
+            i = 0
+            while r >= n - 1 - i:
+                r -= n - 1 - i
+                i += 1
+            return kind, slot, (i, i + 1 + r)
+        return kind, slot, r
+
+    def apply(self, kind: str, slot: int, arg: Any) -> tuple[str, int, Any]:
+        """
+        Applies a mutation to the tree and updates the index
+            Parameters:
+                kind (str): kind of the mutation
+                slot (int): slot of the mutated node, -1 for mutations not tied to a node
+                arg (Any): argument of the mutation, as returned by sample
+            Returns:
+                inverse (tuple[str,int,Any]): the mutation that undoes this mutation
+        """
+        node = self.nodes[slot] if slot >= 0 else None
+        children = self.children[slot] if slot >= 0 else None
+        inverse = (kind, slot, arg)  # most of the mutations are their own inverses
+        changed = slot  # the deepest node whose subtree was changed
+        if kind == 'flip':
+            node.left, node.right = node.right, node.left
+            node.op = _FLIPPED_OPS[_FLIPPABLE_OPS.index(node.op)]
+            left, right = children['left'], children['right']
+            self._link(slot, 'left', right)
+            self._link(slot, 'right', left)
+        elif kind == 'reorder':
+            a = _reorder_chain(node, _REORDERABLE_OPS.index(node.op))[arg]
+            changed = self._left_descendant(slot, arg + 1)
+            a.right, node.right = node.right, a.right
+            a.op, node.op = node.op, a.op
+            a_right, right = self.children[changed]['right'], children['right']
+            self._link(changed, 'right', right)
+            self._link(slot, 'right', a_right)
+        elif kind == 'reorder_left':
+            # arg is the depth of the descendant, as the chain can get longer
+            # after the mutation
+            changed = self._left_descendant(slot, arg)
+            node2 = self.nodes[changed]
+            node2.left, node.right = node.right, node2.left
+            left2, right = self.children[changed]['left'], children['right']
+            self._link(changed, 'left', right)
+            self._link(slot, 'right', left2)
+        elif kind == 'square':
+            node.op = "^"
+            node.right = ast.Numeral(2)
+            self._replace(children['right'], node.right)
+            return 'unsquare', slot, 0
+        elif kind == 'unsquare':
+            node.op = "*"
+            node.right = pickle.loads(pickle.dumps(node.left))
+            self._replace(children['right'], node.right)
+            return 'square', slot, 0
+        elif kind == 'fold':
+            new = ast.Numeral(_fold_value(node))
+            replace_node(self.nodes[self.parents[slot]], self.attrs[slot], new, node)
+            return 'unfold', self._replace(slot, new), 0
+        elif kind == 'unfold':
+            old = node.original
+            replace_node(self.nodes[self.parents[slot]], self.attrs[slot], old, None)
+            return 'fold', self._replace(slot, old), 0
+        elif kind == 'alt':
+            node.alts[0], node.alts[arg + 1] = node.alts[arg + 1], node.alts[0]
+            first, other = children['alts.0'], children[f'alts.{arg + 1}']
+            self._link(slot, 'alts.0', other)
+            self._link(slot, f'alts.{arg + 1}', first)
+        elif kind == 'perm':
+            i, j = arg
+            node.stats[i], node.stats[j] = node.stats[j], node.stats[i]
+            a, b = children[f'stats.{i}'], children[f'stats.{j}']
+            self._link(slot, f'stats.{i}', b)
+            self._link(slot, f'stats.{j}', a)
+        elif kind == 'oneline':
+            node.oneline = not node.oneline
+        elif kind == 'step':
+            if node.step is None:
+                node.step = ast.Numeral(1)
+                self._add(node.step, slot, 'step')
+            else:
+                node.step = None
+                self._remove(children['step'])
+        elif kind == 'quotes':
+            node.double_quotes = not node.double_quotes
+        elif kind == 'hex':
+            node.no_hex = not node.no_hex
+        elif kind == 'name':
+            a, b = arg
+            slots_a, slots_b = self.names.pop(a, set()), self.names.pop(b, set())
+            for s in slots_a:
+                self.nodes[s].id = b
+            for s in slots_b:
+                self.nodes[s].id = a
+            self._swap_sets(self.names, a, b, slots_a, slots_b, not printer.same_measure(a, b))
+            return inverse
+        elif kind == 'label':
+            a, b = arg
+            slots_a, slots_b = self.labels.pop(a, set()), self.labels.pop(b, set())
+            for slots, new in ((slots_a, b), (slots_b, a)):
+                for s in slots:
+                    if type(self.nodes[s]) == ast.Label:
+                        self.nodes[s].name = new
+                    else:
+                        self.nodes[s].target = new
+            self._swap_sets(self.labels, a, b, slots_a, slots_b, not printer.same_measure(a, b))
+            return inverse
+        elif kind == 'chunk':
+            i, j = arg
+            self.order[i], self.order[j] = self.order[j], self.order[i]
+            return inverse
+        self._recount_up(changed)
+        return inverse
+
+    def _left_descendant(self, slot: int, depth: int) -> int:
+        for _ in range(depth):
+            slot = self.children[slot]['left']
+        return slot
+
+    def _swap_sets(self, d: dict, a: str, b: str, slots_a: set, slots_b: set, remeasure: bool):
+        """
+        Stores the slots of a under b and vice versa, and recounts all the
+        nodes that might have changed. remeasure is False if the swap cannot
+        change the printed lengths, so the printer.measure caches are kept.
+        """
+        if len(slots_a) > 0:
+            d[b] = slots_a
+        if len(slots_b) > 0:
+            d[a] = slots_b
+        done = set()
+        for s in itertools.chain(slots_a, slots_b):
+            self._recount_up(s, done, remeasure)
+
+    def path(self, slot: int) -> Optional[tuple[str, ...]]:
+        """Returns the path of attributes from the root to the node in slot, which unlike the slot is the same in all processes"""
+        if slot < 0:
+            return None
+        path = []
+        while self.parents[slot] >= 0:
+            path.append(self.attrs[slot])
+            slot = self.parents[slot]
+        return tuple(reversed(path))
+
+    def slot(self, path: Optional[tuple[str, ...]]) -> int:
+        """Returns the slot of the node at the path returned by path"""
+        if path is None:
+            return -1
+        slot = 0  # the root is always indexed first and never removed
+        for attr in path:
+            slot = self.children[slot][attr]
+        return slot
 
 
 def replace_node(parent: ast.Node, attr: str, node: ast.Node, old: ast.Node):
@@ -275,65 +641,346 @@ def replace_node(parent: ast.Node, attr: str, node: ast.Node, old: ast.Node):
         setattr(parent, attr, node)
 
 
+# Maximum number of mutations replayed from a snapshot of the state. When the
+# chain of accepted mutations gets longer, a new snapshot is taken.
+_MAX_CHAIN = 32
+# Maximum number of mutations the resident state of a process can be rolled back
+_MAX_UNDO = 2 * _MAX_CHAIN
+# Number of spare resident states a process keeps, see _Evaluator
+_SPARE_RESIDENTS = 16
+
+
+class _Snapshot:
+    """A pickled state, which the pool processes load from the store when they don't have a resident copy of it"""
+
+    def __init__(self, key: int, data: bytes):
+        self.key = key
+        self.data = data
+
+
+@dataclass
+class _Version:
+    """
+    Handle to a state: a snapshot and the chain of (version, mutation) pairs
+    to replay on top of it. The handles are what the optimization algorithms
+    pass around, so neither the main process nor the pool processes need to
+    pickle whole states for every step.
+    """
+    snapshot: _Snapshot
+    chain: tuple
+    cost: float = math.inf  # the cost of the state, once evaluated
+    kind: Optional[str] = None  # the kind of the last mutation, until the state is accepted i.e. mutated further
+
+    @property
+    def key(self) -> int:
+        return self.chain[-1][0] if len(self.chain) > 0 else self.snapshot.key
+
+
+class Workers:
+    """
+    Processes that evaluate the candidates of Solutions. The same processes can
+    serve several Solutions one after another, e.g. one for each cart, so that
+    they are started only once. init(initargs) is called in each process when
+    it starts; the cost function, init and initargs of each Solutions are sent
+    through the manager when the Solutions starts, and each process sets them
+    up before evaluating its first candidate for that Solutions. Thus, unlike
+    the initargs of Workers, the initargs of Solutions must be picklable and
+    cannot contain shared memory objects, which must be passed here.
+    """
+
+    def __init__(self, processes: int, init=None, initargs=()):
+        self.processes = processes
+        self.manager = SyncManager()
+        self.manager.start(_ignore_sigint)
+        self.store = self.manager.dict()  # the snapshots of the current Solutions
+        self.context = self.manager.dict()  # the generation and pickled (cost_func, init, initargs) of the current Solutions
+        self.generation = 0
+        self.pool = Pool(processes=processes, initializer=_PoolInitializer(init), initargs=(initargs, self.store, self.context))
+
+    def setup(self, cost_func: Callable[[Any, float], Tuple[int, Any]], init=None, initargs=()) -> int:
+        """
+        Starts serving a new Solutions: forgets the snapshots of the previous
+        one and sends the context of the new one. Returns the generation of the
+        context, which is sent along with each task.
+        """
+        self.generation += 1
+        self.store.clear()
+        self.context['current'] = (self.generation, pickle.dumps((cost_func, init, initargs)))
+        return self.generation
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.manager.shutdown()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.manager.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if args[0] is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+class _Operators:
+    """
+    Bookkeeping of the kinds of mutations (operators): how many candidates of
+    each kind were proposed and accepted, and the mean difference of their
+    costs to the costs of the states they mutated. With adaptive=True, the
+    kinds also get weights for sampling, by probability matching: the weight
+    of a kind is a moving average of how often it has improved on the state
+    it mutated, so that rare but valuable kinds, like folding constants, are
+    not drowned out by the numerous name swaps.
+    """
+
+    RATE = 0.01  # how fast the moving averages forget
+    PRIOR = 0.1  # the initial improvement rate of each kind
+    FLOOR = 1e-3  # the smallest weight, as the rates of kinds that never improve decay to zero
+
+    def __init__(self, adaptive: bool):
+        self.adaptive = adaptive
+        self.counts = {k: [0, 0, 0] for k in _KINDS}  # kind -> [proposed, accepted, sum of cost deltas]
+        self.rates = dict.fromkeys(_KINDS, self.PRIOR)
+
+    def proposed(self, kind: str, delta: float):
+        """Records a candidate of the kind, whose cost was delta more than the cost of the state it mutated"""
+        if delta == math.inf or delta != delta:  # the cost of the state mutated was not known
+            return
+        c = self.counts[kind]
+        c[0] += 1
+        c[2] += delta
+        self.rates[kind] += self.RATE * ((delta < 0) - self.rates[kind])
+
+    def accepted(self, kind: str):
+        self.counts[kind][1] += 1
+
+    def weights(self) -> Optional[dict[str, float]]:
+        """Returns the weights of the kinds for _MutationIndex.sample, None if not adaptive"""
+        return {k: max(r, self.FLOOR) for k, r in self.rates.items()} if self.adaptive else None
+
+    def report(self) -> dict:
+        """Returns the proposed and accepted counts, the acceptance rate and the mean cost delta of each kind proposed"""
+        return {k: {'proposed': p, 'accepted': a, 'acceptance': a / p, 'mean_delta': d / p}
+                for k, (p, a, d) in self.counts.items() if p > 0}
+
+
 class Solutions:
+    """
+    Pool of candidate solutions being evaluated. The cost function is called
+    as cost_func(state, threshold): the candidates with a cost above threshold
+    are certain to be rejected by the optimization algorithm, so the cost
+    function may return a cheap estimate (which must still be above the
+    threshold) instead of the exact cost for them.
+
+    With a pool of processes, the candidates are returned in the order their
+    evaluations complete, so that a slow evaluation does not stall the others.
+
+    With batch > 1, each task tries up to batch mutations of the state and
+    returns the first one that is within the threshold, or the best of them.
+
+    If checkpoint is a path, the complete state of the optimization is saved
+    there every checkpoint_interval seconds, and with resume=True, the
+    optimization continues from the checkpoint if it exists. With a single
+    process, the resumed optimization continues exactly as it would have
+    without the interruption.
+
+    With adaptive=True, the kinds of mutations are sampled adaptively, by how
+    often each kind has recently improved on the state it mutated; see
+    _Operators.
+
+    The candidates are evaluated by the given Workers, which are shared with
+    other Solutions. Without workers, a Solutions with more than one process
+    starts its own Workers, calling init(initargs) in each process when it
+    starts, and stops them when it exits.
+    """
     processes: int
     queue: deque
-    mutate_func: Callable[[Any], Any]
-    cost_func: Callable[[Any, int], Tuple[int, Any]]
-    init_state: Any
+    done: SimpleQueue
+    cost_func: Callable[[Any, float], Tuple[int, Any]]
     queue_length: int
 
-    def __init__(self, state, seed: int, queue_length: int, processes: int, cost_func: Callable[[Any, int], Tuple[int, Any]],  best_func, init=None, initargs=()):
+    def __init__(self, state, seed: int, queue_length: int, processes: int, cost_func: Callable[[Any, float], Tuple[int, Any]],  best_func, init=None, initargs=(), batch: int = 1,
+                 checkpoint: Optional[str] = None, checkpoint_interval: float = 60, resume: bool = False, workers: Optional[Workers] = None,
+                 adaptive: bool = False):
         self.processes = processes
-        if processes != 1:
-            self.pool = Pool(processes=processes, initializer=_PoolInitializer(init), initargs=(initargs,))
+        self.batch = batch
+        self.checkpoint_path = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.next_checkpoint = time.monotonic() + checkpoint_interval
+        self.resume = resume
+        self.resumed = None  # the variables of the algorithm, when resuming from a checkpoint
+        self.snapshots = weakref.WeakValueDictionary()  # the snapshots still referenced by some version
+        self.own_workers = workers is None and processes != 1
+        if self.own_workers:
+            workers = Workers(processes, init, initargs)
+            init, initargs = None, ()
+        self.workers = workers
+        if workers is not None:
+            self.store = workers.store
+            self.generation = workers.setup(cost_func, init, initargs)
+            self.pool = workers.pool
         else:
+            self.store = dict()
             self.pool = None
-        self.queue = deque()
+        self.queue = deque()  # the tasks queued and not yet returned by get
+        self.done = SimpleQueue()  # results of the pool, in the order they complete
+        # when the results come in order, a candidate is returned queue_length - 1 steps after it was queued
+        self.in_order = self.pool is None
         self.cost_func = cost_func
-        self.cost_func_pickled = pickle.dumps(self.cost_func)
         self.queue_length = queue_length
-        self.init_state = pickle.dumps(state)
+        self.init_state = self._snapshot(0, pickle.dumps(state))
+        self.last_key = 0
         self.seed = seed
         self.best_func = best_func
+        # replays the mutations in the main process, for the states that need to be saved or snapshotted
+        self.replayer = _Evaluator(cost_func, self.store)
+        self.operators = _Operators(adaptive)
 
     def __enter__(self):
-        if self.pool is not None:
-            self.pool.__enter__()
-
+        if self.resume and self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            self._load_checkpoint()
+            return self
         rng = random.Random(self.seed)
+        init = _Version(self.init_state, ())
         for i in range(self.queue_length):
-            if self.pool is not None:
-                self.put(self.init_state, pickle.dumps(rng), first=i == 0)
-            else:
-                self.put(self.init_state, pickle.loads(pickle.dumps(rng)), first=i == 0)
-            rng = random.Random(rng.getrandbits(32))  # shuffle the rng so that the different rngs are used
+            self.put(init, rng.getrandbits(64), first=i == 0)
         return self
 
     def __exit__(self, *args):
-        if self.pool is not None:
-            self.pool.close()
-            self.pool.join()
-            self.pool.__exit__(*args)
+        if self.own_workers:
+            self.workers.__exit__(*args)
+        elif self.workers is not None and args[0] is None:
+            # wait for the tasks still in the pool, so that they don't run after the workers have moved on to the next Solutions
+            while len(self.queue) > 0:
+                entry, _ = self.done.get()
+                self.queue.remove(entry)
+        if args[0] is None and self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)  # the optimization finished, nothing to resume anymore
 
     def get(self):
+        """
+        Returns the next evaluated candidate: the new state, its cost, the rng
+        (seed) to be used when mutating it further, the finisher returned by
+        the cost function and the threshold the candidate was queued with
+        """
+        with stats.timer('get'):
+            if self.pool is not None:
+                entry, result = self.done.get(timeout=9999)
+                if isinstance(result, BaseException):
+                    raise result
+                self.queue.remove(entry)
+                parent, threshold, _ = entry
+            else:
+                parent, threshold, task = self.queue.popleft()
+                with stats.timer('evaluate'):
+                    result = self.replayer.evaluate(*task)
+        mutation, cost, seed, finisher = result
+        if mutation is None:
+            if parent.cost == math.inf:
+                parent.cost = cost
+            return parent, cost, seed, finisher, threshold
+        self.operators.proposed(mutation[0], cost - parent.cost)
+        self.last_key += 1
+        return _Version(parent.snapshot, parent.chain + ((self.last_key, mutation),), cost, mutation[0]), cost, seed, finisher, threshold
+
+    def put(self, state: _Version, rng: int, threshold: float = math.inf, first=False):
+        """
+        Queues a state to be mutated using seed rng and evaluated. Candidates
+        with a cost above threshold will be rejected by the caller, so their
+        cost needs not to be exact.
+        """
+        with stats.timer('put'):
+            if state.kind is not None:
+                self.operators.accepted(state.kind)
+                state.kind = None
+            if len(state.chain) >= _MAX_CHAIN:
+                # the chain is getting long, so take a new snapshot so that the pool
+                # processes don't have to replay that many mutations
+                snapshot = self._snapshot(state.key, self.dumps(state))
+                state.snapshot, state.chain = snapshot, ()
+            self._submit((state, threshold, (state.snapshot.key, state.chain, rng, threshold, self.batch, first, self.operators.weights())))
+
+    def _submit(self, entry):
+        self.queue.append(entry)
         if self.pool is not None:
-            return self.queue.popleft().get(timeout=9999)
-        else:
-            state, rng, first = self.queue.popleft()
-            return _mutate_cost(state, rng, self.cost_func, first)
-
-    def put(self, state: Any, rng: random.Random, first=False):
-        if self.pool is not None:
-            self.queue.append(self.pool.apply_async(_mutate_cost_pickled, (state, rng, self.cost_func_pickled, first)))
-        else:
-            self.queue.append((state, rng, first))
-
-    def best(self, state, finisher):
-        self.best_func(state, finisher)
-
-
-def anneal(solutions: Solutions, steps: int, start_temp: float, end_temp: float, seed: int = 0) -> Any:
+            # the callbacks run in the result handler thread of the pool
+            def _done(result):
+                self.done.put((entry, result))
+            self.pool.apply_async(_evaluate, (self.generation,) + entry[2], callback=_done, error_callback=_done)
+
+    def best(self, state: _Version, cost, finisher=None):
+        """
+        Called by the optimization algorithms when a new best state is found,
+        or without the finisher when the best state was restored from a
+        checkpoint; the state is then evaluated again to get its finisher
+        """
+        data = self.dumps(state)
+        if finisher is None:
+            finisher = self.cost_func(pickle.loads(data), math.inf)[1]
+        self.best_func(data, finisher)
+
+    def restore(self) -> Optional[tuple]:
+        """Returns the variables the algorithm passed to checkpoint, or None if not resuming from a checkpoint"""
+        return self.resumed
+
+    def checkpoint(self, variables: tuple):
+        """
+        Saves the state of the optimization, if checkpoint_interval seconds
+        have passed since the last save. The algorithms call this at the start
+        of each step, with the variables needed to continue from that step.
+        """
+        if self.checkpoint_path is None or time.monotonic() < self.next_checkpoint:
+            return
+        root = self.replayer.state[0] if self.replayer.state is not None else None
+        # the mutations sampled depend on the layout of the index, so it is saved too
+        index = _last_index if _last_index is not None and _last_index.root is root else None
+        saved = dict(init=self.init_state.data, last_key=self.last_key, snapshots=list(self.snapshots.values()), operators=self.operators,
+                     resident=(self.replayer.keys, self.replayer.undo, self.replayer.state, index), queue=list(self.queue), variables=variables)
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(saved, file)
+        os.replace(tmp_path, self.checkpoint_path)  # so that an interruption while saving doesn't corrupt the checkpoint
+        self.next_checkpoint = time.monotonic() + self.checkpoint_interval
+
+    def _load_checkpoint(self):
+        global _last_index
+        with open(self.checkpoint_path, 'rb') as file:
+            saved = pickle.load(file)
+        if saved['init'] != self.init_state.data:
+            raise ValueError(f"Checkpoint {self.checkpoint_path} was saved for a different cart or settings")
+        for snapshot in saved['snapshots']:
+            self.store[snapshot.key] = snapshot.data
+            self.snapshots[snapshot.key] = snapshot
+        self.last_key = saved['last_key']
+        self.operators = saved['operators']
+        self.replayer.keys, self.replayer.undo, self.replayer.state, index = saved['resident']
+        if index is not None:
+            _last_index = index
+        for entry in saved['queue']:
+            self._submit(entry)
+        self.resumed = saved['variables']
+
+    def dumps(self, state: _Version) -> bytes:
+        """Returns the state pickled"""
+        return pickle.dumps(self.replayer.checkout(state.snapshot.key, state.chain))
+
+    def _snapshot(self, key: int, data: bytes) -> _Snapshot:
+        for k in list(self.store.keys()):
+            if k not in self.snapshots:  # no version refers to this snapshot anymore
+                del self.store[k]
+        snapshot = _Snapshot(key, data)
+        self.store[key] = data
+        self.snapshots[key] = snapshot
+        return snapshot
+
+
+def anneal(solutions: Solutions, steps: int, start_temp: float, end_temp: float, seed: int = 0,
+           time_limit: float = 0, stall_steps: int = 0, stall_seconds: float = 0) -> Any:
     """
     Perform simulated annealing optimization, using exponential temperature schedule.
     See https://en.wikipedia.org/wiki/Simulated_annealing
@@ -343,34 +990,60 @@ def anneal(solutions: Solutions, steps: int, start_temp: float, end_temp: float,
             start_temp (float): starting temperature for the optimization
             end_temp (float): end temperature for the optimization
             seed (int): seed for the random number generator
+            time_limit (float): stop after this many seconds, 0 = no limit. the temperature schedule follows
+                the elapsed time, or the steps if they run out first
+            stall_steps (int): stop if the best cost has not improved in this many steps, 0 = never
+            stall_seconds (float): stop if the best cost has not improved in this many seconds, 0 = never
         Returns:
             best (Any): The best solution found
     """
-    state, current_cost, rng, finalize = solutions.get()
-    solutions.best(state, finalize)
-    best_cost = current_cost
-    best = state
-    r = random.Random(seed)  # deterministic seed, to have deterministic results
-    bar = tqdm.tqdm(_stepsGenerator(steps), position=1, leave=False)
+    saved = solutions.restore()
+    if saved is None:
+        state, current_cost, rng, finalize, _ = solutions.get()
+        solutions.best(state, current_cost, finalize)
+        best_cost = current_cost
+        best = state
+        r = random.Random(seed)  # deterministic seed, to have deterministic results
+        budget = _Budget(time_limit, stall_steps, stall_seconds)
+        start = 0
+    else:
+        start, state, current_cost, rng, best, best_cost, r, budget = saved
+        solutions.best(best, best_cost)  # the output was not written before resuming
+    bar = _progress(steps, start)
     for i in bar:
-        solutions.put(state, rng)
-        alpha = i / (steps - 1)
+        solutions.checkpoint((i, state, current_cost, rng, best, best_cost, r, budget))
+        alpha = i / (steps - 1) if steps > 1 else 0  # with infinite steps, stay at start_temp unless there's a time limit
+        if time_limit > 0:
+            alpha = min(max(budget.elapsed() / time_limit, alpha), 1)
         temp = math.exp((1 - alpha) * math.log(start_temp) + alpha * math.log(end_temp))
-        candidate, cand_cost, rng, finalize = solutions.get()
-        if cand_cost < current_cost or math.exp(-(cand_cost - current_cost) / temp) >= r.random():
+        # the random number is drawn when the candidate is queued, so that the
+        # acceptance threshold is known already when evaluating it:
+        # exp(-(cand_cost - current_cost) / temp) >= u <=> cand_cost <= current_cost - temp * log(u)
+        solutions.put(state, rng, current_cost - temp * math.log(1 - r.random()))
+        candidate, cand_cost, rng, finalize, threshold = solutions.get()
+        if threshold == math.inf:  # queued by solutions itself, without a threshold
+            threshold = current_cost - temp * math.log(1 - r.random())
+        # only the threshold the candidate was queued with: with a queue, the
+        # current cost may have risen since, above the estimated costs of the
+        # candidates that were certain to be rejected. The threshold is never
+        # below the current cost at the time of queuing, so improvements over
+        # that are still always accepted
+        if cand_cost <= threshold:
             current_cost = cand_cost
             state = candidate
         if cand_cost < best_cost:
             best_cost = cand_cost
             best = candidate
-            solutions.best(best, finalize)
+            solutions.best(best, best_cost, finalize)
+            budget.improved(i)
         bar.set_description(f"B:{best_cost} C:{current_cost} A:{cand_cost} T: {temp:.1f}")
-        if best_cost <= 0:
+        if best_cost <= 0 or budget.exhausted(i):
             break
-    return best
+    return solutions.dumps(best)
 
 
-def lahc(solutions: Solutions, steps: int, list_length: int, init_margin: int) -> Any:
+def lahc(solutions: Solutions, steps: int, list_length: int, init_margin: int,
+         time_limit: float = 0, stall_steps: int = 0, stall_seconds: float = 0) -> Any:
     """
     Optimize a function using Late Acceptance Hill Climbing
     See https://arxiv.org/pdf/1806.09328.pdf
@@ -379,18 +1052,34 @@ def lahc(solutions: Solutions, steps: int, list_length: int, init_margin: int) -
             steps (int): how many steps the optimization algorithms takes
             list_length (int): length of the history in the algorithm
             init_margin (int): how much margin, in bytes, to add to the initial best cost
+            time_limit (float): stop after this many seconds, 0 = no limit
+            stall_steps (int): stop if the best cost has not improved in this many steps, 0 = never
+            stall_seconds (float): stop if the best cost has not improved in this many seconds, 0 = never
         Returns:
             best (Any): The best solution found
     """
-    state, current_cost, rng, finalize = solutions.get()
-    solutions.best(state, finalize)
-    best_cost = current_cost
-    history = [best_cost + init_margin] * list_length
-    best = state
-    bar = tqdm.tqdm(_stepsGenerator(steps), position=1, leave=False)
+    saved = solutions.restore()
+    if saved is None:
+        state, current_cost, rng, finalize, _ = solutions.get()
+        solutions.best(state, current_cost, finalize)
+        best_cost = current_cost
+        history = [best_cost + init_margin] * list_length
+        best = state
+        budget = _Budget(time_limit, stall_steps, stall_seconds)
+        start = 0
+    else:
+        start, state, current_cost, rng, best, best_cost, history, budget = saved
+        solutions.best(best, best_cost)  # the output was not written before resuming
+    bar = _progress(steps, start)
     for i in bar:
-        solutions.put(state, rng)
-        candidate, cand_cost, rng, finalize = solutions.get()
+        solutions.checkpoint((i, state, current_cost, rng, best, best_cost, history, budget))
+        # the candidate is judged queue_length - 1 steps later if the results
+        # come in order, any time later otherwise: history only decreases, but
+        # the current cost can rise to any history entry before
+        window = min(solutions.queue_length if solutions.in_order else list_length, list_length)
+        threshold = max(current_cost, max(history[(i + k) % list_length] for k in range(window)))
+        solutions.put(state, rng, threshold)
+        candidate, cand_cost, rng, finalize, _ = solutions.get()
         v = i % list_length
         if cand_cost < history[v] or cand_cost <= current_cost:
             current_cost = cand_cost
@@ -400,14 +1089,16 @@ def lahc(solutions: Solutions, steps: int, list_length: int, init_margin: int) -
         if cand_cost < best_cost:
             best_cost = cand_cost
             best = candidate
-            solutions.best(best, finalize)
+            solutions.best(best, best_cost, finalize)
+            budget.improved(i)
         bar.set_description(f"B:{best_cost} C:{current_cost} A:{cand_cost}")
-        if best_cost <= 0:
+        if best_cost <= 0 or budget.exhausted(i):
             break
-    return best
+    return solutions.dumps(best)
 
 
-def dlas(solutions: Solutions, steps: int, list_length: int, init_margin: int) -> Any:
+def dlas(solutions: Solutions, steps: int, list_length: int, init_margin: int,
+         time_limit: float = 0, stall_steps: int = 0, stall_seconds: float = 0) -> Any:
     """
     Optimize a function using Diversified Late Acceptance Search
     See https://arxiv.org/pdf/1806.09328.pdf
@@ -416,21 +1107,33 @@ def dlas(solutions: Solutions, steps: int, list_length: int, init_margin: int) -
             steps (int): how many steps the optimization algorithms takes
             list_length (int): length of the history in the algorithm
             init_margin (int): how much margin, in bytes, to add to the initial best cost
+            time_limit (float): stop after this many seconds, 0 = no limit
+            stall_steps (int): stop if the best cost has not improved in this many steps, 0 = never
+            stall_seconds (float): stop if the best cost has not improved in this many seconds, 0 = never
         Returns:
             best (Any): The best solution found
     """
-    state, current_cost, rng, finalize = solutions.get()
-    solutions.best(state, finalize)
-    best_cost = current_cost
-    cost_max = best_cost + init_margin
-    history = [cost_max] * list_length
-    N = list_length
-    best = state
-    bar = tqdm.tqdm(_stepsGenerator(steps), position=1, leave=False)
+    saved = solutions.restore()
+    if saved is None:
+        state, current_cost, rng, finalize, _ = solutions.get()
+        solutions.best(state, current_cost, finalize)
+        best_cost = current_cost
+        cost_max = best_cost + init_margin
+        history = [cost_max] * list_length
+        N = list_length
+        best = state
+        budget = _Budget(time_limit, stall_steps, stall_seconds)
+        start = 0
+    else:
+        start, state, current_cost, rng, best, best_cost, history, cost_max, N, budget = saved
+        solutions.best(best, best_cost)  # the output was not written before resuming
+    bar = _progress(steps, start)
     for i in bar:
-        solutions.put(state, rng)
+        solutions.checkpoint((i, state, current_cost, rng, best, best_cost, history, cost_max, N, budget))
+        # cost_max never increases and the current cost never exceeds it
+        solutions.put(state, rng, cost_max)
         prev_cost = current_cost
-        candidate, cand_cost, rng, finalize = solutions.get()
+        candidate, cand_cost, rng, finalize, _ = solutions.get()
         v = i % list_length
         if cand_cost == current_cost or cand_cost < cost_max:
             current_cost = cand_cost
@@ -447,13 +1150,123 @@ def dlas(solutions: Solutions, steps: int, list_length: int, init_margin: int) -
         if cand_cost < best_cost:
             best_cost = cand_cost
             best = candidate
-            solutions.best(best, finalize)
+            solutions.best(best, best_cost, finalize)
+            budget.improved(i)
         bar.set_description(f"B:{best_cost} C:{current_cost} M:{cost_max} A:{cand_cost}")
-        if best_cost <= 0:
+        if best_cost <= 0 or budget.exhausted(i):
             break
+    return solutions.dumps(best)
+
+
+def islands(state, seed: int, processes: int, cost_func: Callable[[Any, float], Tuple[int, Any]], best_func, algorithm, kwargs: dict, migrate: int, queue_length: int = 1, batch: int = 1, init=None, initargs=(), adaptive: bool = False) -> bytes:
+    """
+    Island model: each process runs an independent optimization, without
+    communicating with the others every step. Every migrate steps, an island
+    whose best state is worse than the best of all the islands continues from
+    the overall best. Each island runs the given number of steps, so the total
+    work scales with the number of processes.
+        Parameters:
+            state (Any): the initial state
+            seed (int): seed for the random number generators; island i uses seed + i
+            processes (int): number of islands, one process each
+            cost_func (Callable[[Any, float], Tuple[int, Any]]): cost function, see Solutions
+            best_func (Callable[[bytes, Any], None]): called in this process with the pickled state and finisher when a new overall best is found
+            algorithm (Callable[..., Any]): the optimization algorithm run by each island, e.g. lahc
+            kwargs (dict): arguments for the algorithm; a 'seed' argument is offset by the island index too
+            migrate (int): how often, in steps, the islands look for a better overall best
+            queue_length (int): queue length of the Solutions of each island
+            batch (int): batch size of the Solutions of each island
+            init (Callable[[Any], None]): initializer called in each island process
+            initargs (Any): arguments passed to init
+            adaptive (bool): whether the islands sample the kinds of mutations adaptively, see Solutions
+        Returns:
+            best (bytes): The best state found, pickled
+    """
+    manager = SyncManager()
+    manager.start(_ignore_sigint)
+    shared = manager.dict()  # the overall best (cost, pickled state), from which the islands migrate
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_island, daemon=True, args=(
+        i, state, seed + i, queue_length, batch, cost_func, algorithm, kwargs, migrate, shared, results, init, initargs, adaptive)) for i in range(processes)]
+    best_cost, best, running = math.inf, None, processes
+    try:
+        for p in procs:
+            p.start()
+        bar = tqdm.tqdm(total=processes, position=1, leave=False)
+        while running > 0:
+            msg = results.get()
+            if msg[0] == 'best':
+                _, cost, data, finisher = msg
+                if cost < best_cost:
+                    best_cost, best = cost, data
+                    shared['best'] = (cost, data)
+                    best_func(data, finisher)
+            elif msg[0] == 'error':
+                raise msg[1]
+            else:
+                running -= 1
+                bar.update()
+            bar.set_description(f"B:{best_cost} islands running:{running}")
+        bar.close()
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        manager.shutdown()
     return best
 
 
+class _Island(Solutions):
+    """
+    The Solutions of one island: evaluates the candidates in the island
+    process, reports the best states to the main process and every migrate
+    steps replaces the candidate with the overall best if it beats the best
+    of the island.
+    """
+
+    def __init__(self, state, seed: int, queue_length: int, cost_func, batch: int, migrate: int, shared, results, adaptive: bool):
+        super().__init__(state, seed, queue_length, 1, cost_func, None, batch=batch, adaptive=adaptive)
+        self.migrate = migrate
+        self.shared = shared
+        self.results = results
+        self.best_cost = math.inf
+        self.steps = 0
+
+    def get(self):
+        candidate, cost, seed, finisher, threshold = super().get()
+        self.steps += 1
+        if self.migrate > 0 and self.steps % self.migrate == 0:
+            migrant = self.shared.get('best')
+            if migrant is not None and migrant[0] < self.best_cost:
+                cost, data = migrant
+                self.last_key += 1
+                candidate, finisher = _Version(self._snapshot(self.last_key, data), (), cost), None
+        return candidate, cost, seed, finisher, threshold
+
+    def best(self, state: _Version, cost, finisher):
+        self.best_cost = cost
+        if finisher is not None:  # the migrants have been reported already by the island that found them
+            self.results.put(('best', cost, self.dumps(state), finisher))
+
+
+def _island(index, state, seed, queue_length, batch, cost_func, algorithm, kwargs, migrate, shared, results, init, initargs, adaptive):
+    """Runs the optimization algorithm of one island, in its own process"""
+    _ignore_sigint()
+    sys.stderr = open(os.devnull, 'w')  # the progress bars of the islands would garble the output
+    try:
+        if init is not None:
+            init(initargs)
+        if 'seed' in kwargs:
+            kwargs = {**kwargs, 'seed': kwargs['seed'] + index}
+        with _Island(state, seed, queue_length, cost_func, batch, migrate, shared, results, adaptive) as solutions:
+            algorithm(solutions, **kwargs)
+        results.put(('done',))
+    except Exception as e:
+        results.put(('error', e))
+
+
 @dataclass
 class _PoolInitializer:
     """
@@ -461,53 +1274,249 @@ class _PoolInitializer:
     """
     init: Callable[[Any], None]
 
-    def __call__(self, a):
-        # ignore SIGINT in the pool processes; rather, let the main process handle it and close the pool when it happens
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    def __call__(self, a, store, context):
+        global _store, _context
+        _ignore_sigint()
         if self.init is not None:
             self.init(a)
+        _store, _context = store, context
+
+
+def _ignore_sigint():
+    # ignore SIGINT in the pool processes; rather, let the main process handle it and close the pool when it happens
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def _mutate_cost(state, rng: random.Random, cost_func, first):
+class _Evaluator:
     """
-    Helper function that mutates a state and calculates the cost. Used when not
-    doing multiprocessing. Avoids unnecessary pickling/unpickling of the rng and
-    the cost_func.
+    Keeps a resident copy of a state. To check out another version, the
+    resident copy is rolled back to the latest version it has in common with
+    the chain of the version, and the rest of the chain is replayed; a snapshot
+    is loaded from the store only when there is no common version. Candidates
+    are evaluated by applying a mutation, computing the cost and undoing the
+    mutation, so that the resident state stays intact.
+
+    A few spare resident copies are kept too, as the candidates of a long
+    queue come from interleaved lines of versions, which soon have no common
+    version within the undo history of a single copy.
     """
-    state = pickle.loads(state)
-    if not first:
-        mutate(state, rng)
-    new_cost, finisher = cost_func(state)
-    return pickle.dumps(state), new_cost, rng, finisher
 
-
-def _mutate_cost_pickled(state, rng, cost_func, first):
+    def __init__(self, cost_func: Callable[[Any, float], Tuple[int, Any]], store):
+        self.cost_func = cost_func
+        self.store = store
+        self.keys = []  # the versions the resident copy went through, the last one is the resident version
+        self.undo = []  # for each version after the first, the mutation that rolls back to the previous one
+        self.state = None
+        self.spares = []  # other resident copies as (keys, undo, state, index), the most recently used last
+
+    @property
+    def key(self) -> Optional[int]:
+        return self.keys[-1] if len(self.keys) > 0 else None
+
+    def checkout(self, snapshot: int, chain: tuple) -> Any:
+        """Returns the state of the version, made resident"""
+        keys = [snapshot] + [k for k, _ in chain]
+        start = _common_version(self.keys, keys)
+        try:
+            if start is None:
+                for i in range(len(self.spares) - 1, -1, -1):
+                    start = _common_version(self.spares[i][0], keys)
+                    if start is not None:
+                        self._swap(self.spares.pop(i))
+                        break
+                else:
+                    self._swap(([snapshot], [], pickle.loads(self.store[snapshot]), None))
+                    start = 0
+            index = _mutation_index(self.state)
+            while self.keys[-1] != keys[start]:
+                kind, path, arg = self.undo.pop()
+                self.keys.pop()
+                index.apply(kind, index.slot(path), arg)
+            for key, (kind, path, arg) in chain[start:]:
+                # slots change when subtrees are replaced, so the undo mutations refer to paths
+                kind, slot, arg = index.apply(kind, index.slot(path), arg)
+                self.undo.append((kind, index.path(slot), arg))
+                self.keys.append(key)
+        except BaseException:
+            self.keys, self.undo, self.state = [], [], None  # the resident copy is in an unknown state
+            raise
+        if len(self.undo) > _MAX_UNDO:
+            del self.keys[:-_MAX_UNDO - 1], self.undo[:-_MAX_UNDO]
+        return self.state
+
+    def _swap(self, resident: tuple):
+        """Makes another copy resident, keeping the current one, with its mutation index, as a spare"""
+        global _last_index
+        if self.state is not None:
+            index = _last_index if _last_index is not None and _last_index.root is self.state[0] else None
+            self.spares.append((self.keys, self.undo, self.state, index))
+            if len(self.spares) > _SPARE_RESIDENTS:
+                del self.spares[0]
+        self.keys, self.undo, self.state, index = resident
+        if index is not None:
+            _last_index = index
+
+    def evaluate(self, snapshot: int, chain: tuple, seed: int, threshold: float, batch: int, first: bool, weights: Optional[dict] = None):
+        """
+        Mutates the state of the version using seed and computes the cost,
+        which needs not to be exact if it is above threshold. With batch > 1,
+        up to batch mutations are tried and the first one with a cost at most
+        threshold, or the best one, is returned. weights are the weights of
+        the kinds of mutations, None to sample uniformly.
+        Returns the mutation applied (None if the state was not mutated), the
+        cost, the seed for the next mutation and the finisher.
+        """
+        with stats.timer('checkout'):
+            state = self.checkout(snapshot, chain)
+        rand = random.Random(seed)
+        if first:
+            new_cost, finisher = self.cost_func(state, threshold)
+            return None, new_cost, rand.getrandbits(64), finisher
+        index = _mutation_index(state)
+        best = None
+        for _ in range(batch):
+            mutation = inverse = None
+            with stats.timer('mutate'):
+                m = index.sample(rand, weights)
+                if m is not None:
+                    kind, slot, arg = m
+                    mutation = (kind, index.path(slot), arg)
+                    inverse = index.apply(kind, slot, arg)
+            try:
+                # candidates worse than the best of the batch won't be returned, so their costs needn't be exact either
+                new_cost, finisher = self.cost_func(state, threshold if best is None else min(threshold, best[1]))
+            finally:
+                if inverse is not None:
+                    with stats.timer('mutate'):
+                        index.apply(*inverse)
+            if best is None or new_cost < best[1]:
+                best = (mutation, new_cost, finisher)
+            if new_cost <= threshold or m is None:
+                break
+        mutation, new_cost, finisher = best
+        return mutation, new_cost, rand.getrandbits(64), finisher
+
+
+def _common_version(resident: list, keys: list) -> Optional[int]:
+    """Returns the position of the latest of keys that is also in resident, None if there is none"""
+    positions = set(resident)
+    return next((i for i in range(len(keys) - 1, -1, -1) if keys[i] in positions), None)
+
+
+_evaluator = None
+_generation = None  # the generation of the context the pool process has set up
+_store = None
+_context = None
+
+
+def _evaluate(generation: int, snapshot: int, chain: tuple, seed: int, threshold: float, batch: int, first: bool, weights: Optional[dict]):
+    """Evaluates a candidate in a pool process"""
+    global _evaluator, _generation
+    if generation != _generation:
+        _generation, data = _context['current']
+        cost_func, init, initargs = pickle.loads(data)
+        if init is not None:
+            init(initargs)
+        _evaluator = _Evaluator(cost_func, _store)
+    with stats.timer('evaluate'):
+        return _evaluator.evaluate(snapshot, chain, seed, threshold, batch, first, weights)
+
+
+class _Budget:
     """
-    Helper function that mutates a state and calculates the cost. Used when
-    multiprocessing. Pickles/unpickles also the rng and cost_func as these need
-    to go back and forth between the main process and the pool processes.
+    Stopping criteria of the optimization algorithms on top of the steps: a
+    limit on the elapsed time, and on the steps or seconds since the best
+    cost last improved. A limit of 0 is no limit. When pickled into a
+    checkpoint, the times are saved relative to now, so a resumed
+    optimization continues with the time it had left.
     """
-    rng = pickle.loads(rng)
-    state = pickle.loads(state)
-    if not first:
-        mutate(state, rng)
-    new_cost, finisher = pickle.loads(cost_func)(state)
-    return pickle.dumps(state), new_cost, pickle.dumps(rng), finisher
 
+    def __init__(self, time_limit: float, stall_steps: int, stall_seconds: float):
+        self.time_limit = time_limit
+        self.stall_steps = stall_steps
+        self.stall_seconds = stall_seconds
+        self.start = self.improved_time = time.monotonic()
+        self.improved_step = 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def improved(self, step: int):
+        """Records that the best cost improved on step"""
+        self.improved_step = step
+        self.improved_time = time.monotonic()
 
-def _stepsGenerator(steps: int):
+    def exhausted(self, step: int) -> bool:
+        """Returns True if the optimization should stop after step"""
+        now = time.monotonic()
+        return ((self.time_limit > 0 and now - self.start >= self.time_limit) or
+                (self.stall_steps > 0 and step - self.improved_step >= self.stall_steps) or
+                (self.stall_seconds > 0 and now - self.improved_time >= self.stall_seconds))
+
+    def __getstate__(self):
+        now = time.monotonic()
+        return {**self.__dict__, 'start': now - self.start, 'improved_time': now - self.improved_time}
+
+    def __setstate__(self, state):
+        now = time.monotonic()
+        self.__dict__.update(state, start=now - state['start'], improved_time=now - state['improved_time'])
+
+
+def _stepsGenerator(steps: int, start: int = 0):
     """
     Generator for the steps of the optimization algorithms, taking into account that 0 means infinite steps
     """
     if steps == 0:
-        return itertools.count()
+        return itertools.count(start)
     else:
-        return range(steps)
+        return range(start, steps)
+
+
+def _progress(steps: int, start: int) -> tqdm.tqdm:
+    """Progress bar for the steps of the optimization algorithms, starting from step start"""
+    return tqdm.tqdm(_stepsGenerator(steps, start), initial=start, total=steps if steps > 0 else None, position=1, leave=False)
+
+
+# The attributes of each node class holding its children, as (name, is_list),
+# and the names of the arguments of its constructor. These are computed from
+# the type hints once per class, as get_type_hints is far too slow to be called
+# for every node.
+_NODE_FIELDS = {}
+
+# Classes whose fields are not in the order they appear in the code; the
+# children are visited in the order of the code, e.g. to give the names their
+# initial minified names in the order they appear.
+_CODE_ORDER = {
+    ast.Repeat: ('block', 'condition'),
+    ast.ExpressionField: ('key', 'value'),
+}
+
+
+def _node_fields(cls: type) -> tuple[tuple, tuple]:
+    fields = _NODE_FIELDS.get(cls)
+    if fields is None:
+        children = []
+        for name, typehint in get_type_hints(cls).items():
+            if get_origin(typehint) is Union:  # Optional[X]; None children are skipped when traversing
+                typehint = next(a for a in get_args(typehint) if a is not type(None))
+            if get_origin(typehint) is list:
+                args = get_args(typehint)
+                if len(args) > 0 and inspect.isclass(args[0]) and issubclass(args[0], ast.Node):
+                    children.append((name, True))
+            elif inspect.isclass(typehint) and issubclass(typehint, ast.Node):
+                children.append((name, False))
+        order = _CODE_ORDER.get(cls)
+        if order is not None:
+            children.sort(key=lambda c: order.index(c[0]))
+        fields = _NODE_FIELDS[cls] = (tuple(children), tuple(f.name for f in dataclass_fields(cls) if f.init))
+    return fields
 
 
 def apply_trans(node: ast.Node, trans: Callable[[ast.Node], ast.Node]) -> ast.Node:
     """
-    Applies a transformation to an abstract syntax tree recursively
+    Applies a transformation to each node of an abstract syntax tree, children
+    before their parents. The tree is traversed with an explicit stack, so deep
+    trees do not exhaust the recursion limit.
         Parameters:
             node (ast.Node): Root of the syntax tree to transform
             trans (Callable[[ast.Node], ast.Node]): Callback function that takes a node and returns a transformed node
@@ -516,212 +1525,66 @@ def apply_trans(node: ast.Node, trans: Callable[[ast.Node], ast.Node]) -> ast.No
     """
     if node is None:
         return trans(node)
-    replaces = dict()
-    try:
-        for name, typehint in get_type_hints(node).items():
-            attr = getattr(node, name)
-            origin = get_origin(typehint)
-            args = get_args(typehint)
-            if origin is Optional:
-                if attr is None:
-                    continue
-                origin = args
-            if origin is list and len(args) > 0 and issubclass(args[0], ast.Node):
-                replaces[name] = [apply_trans(e, trans) for e in attr]
-            elif inspect.isclass(typehint) and issubclass(typehint, ast.Node):
-                replaces[name] = apply_trans(attr, trans)
-    except TypeError:
-        pass
-    return trans(replace(node, **replaces))
+    # preorder with the children pushed first to last, i.e. the last child is
+    # traversed first; in reverse, this is postorder with the first child first
+    order = []
+    stack = [node]
+    while len(stack) > 0:
+        n = stack.pop()
+        order.append(n)
+        for name, is_list in _node_fields(type(n))[0]:
+            child = getattr(n, name)
+            if child is not None:
+                if is_list:
+                    stack.extend(child)
+                else:
+                    stack.append(child)
+    # the transformed children of a node are on top of the results stack when
+    # the node is reached, the last child topmost
+    results = []
+    for n in reversed(order):
+        cls = type(n)
+        children, init = _node_fields(cls)
+        kwargs = {name: getattr(n, name) for name in init}
+        for name, is_list in reversed(children):
+            child = kwargs[name]
+            if child is not None:
+                if is_list:
+                    start = len(results) - len(child)
+                    kwargs[name] = results[start:]
+                    del results[start:]
+                else:
+                    kwargs[name] = results.pop()
+        new = cls(**kwargs)
+        if len(children) == 0:
+            new = ast.shared(new)  # keeps the shared leaves shared, e.g. in the copy made by minify
+        results.append(trans(new))
+    return results[0]
 
 
-@singledispatch
 def visit(node: ast.Node, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
     """
-    Visit each node of an abstract syntax tree recursively
+    Visit each node of an abstract syntax tree, parents before their children
+    and the children in the order they appear in the code. The tree is
+    traversed with an explicit stack, so deep trees do not exhaust the
+    recursion limit.
         Parameters:
             node (ast.Node): A (root) node of the syntax tree to visit
-            visitor (Callable[[ast.Node, ast.Node, str], None]): Callback function called for each node
+            visitor (Callable[[ast.Node, ast.Node, str], None]): Callback function called for each node,
+                with the node, its parent and the attribute of the parent holding it, e.g. "stats.3"
     """
-    if node != None:
+    if node is None:
+        return
+    stack = [(node, parent, attr)]
+    while len(stack) > 0:
+        node, parent, attr = stack.pop()
         visitor(node, parent, attr)
-
-
-@ visit.register
-def _(node: ast.Block, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for s in node.stats:
-        visit(s, visitor)
-
-
-@ visit.register
-def _(node: ast.Return, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, e in enumerate(node.exps):
-        visit(e, visitor, node, f"exps.{i}")
-
-
-@ visit.register
-def _(node: ast.Do, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.block, visitor, node, "block")
-
-
-@ visit.register
-def _(node: ast.Assign, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, t in enumerate(node.targets):
-        visit(t, visitor, node, f"targets.{i}")
-    for i, v in enumerate(node.values):
-        visit(v, visitor, node, f"values.{i}")
-
-
-@ visit.register
-def _(node: ast.While, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.condition, visitor, node, "condition")
-    visit(node.block, visitor, node, "block")
-
-
-@ visit.register
-def _(node: ast.Repeat, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.block, visitor, node, "block")
-    visit(node.condition, visitor, node, "condition")
-
-
-@ visit.register
-def _(node: ast.ForRange, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.var, visitor, node, "var")
-    visit(node.lb, visitor, node, "lb")
-    visit(node.ub, visitor, node, "ub")
-    visit(node.step, visitor, node, "step")
-    visit(node.body, visitor, node, "body")
-
-
-@ visit.register
-def _(node: ast.ForIn, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, n in enumerate(node.names):
-        visit(n, visitor, node, f"names.{i}")
-    for i, e in enumerate(node.exps):
-        visit(e, visitor, node, f"exps.{i}")
-    visit(node.body, visitor, node, "body")
-
-
-@ visit.register
-def _(node: ast.Local, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, t in enumerate(node.targets):
-        visit(t, visitor, node, f"targets.{i}")
-    if node.values is not None:
-        for i, v in enumerate(node.values):
-            visit(v, visitor, node, f"values.{i}")
-
-
-@ visit.register
-def _(node: ast.Func, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, a in enumerate(node.args):
-        visit(a, visitor, node, f"args.{i}")
-    visit(node.body, visitor, node, "body")
-
-
-@ visit.register
-def _(node: ast.LocalFunc, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.name, visitor, node, "name")
-    for i, a in enumerate(node.args):
-        visit(a, visitor, node, f"args.{i}")
-    visit(node.body, visitor, node, "body")
-
-
-@ visit.register
-def _(node: ast.Index, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.obj, visitor, node, "obj")
-    visit(node.item, visitor, node, "item")
-
-
-@ visit.register
-def _(node: ast.Table, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, f in enumerate(node.fields):
-        visit(f, visitor, node, f"fields.{i}")
-
-
-@ visit.register
-def _(node: ast.ExpressionField, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.key, visitor, node, "key")
-    visit(node.value, visitor, node, "value")
-
-
-@ visit.register
-def _(node: ast.NamedField, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.value, visitor, node, "value")
-
-
-@ visit.register
-def _(node: ast.Field, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.value, visitor, node, "value")
-
-
-@ visit.register(ast.MethodCall)
-def _(node: ast.MethodCall, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.value, visitor, node, "value")
-    for i, a in enumerate(node.args):
-        visit(a, visitor, node, f"args.{i}")
-
-
-@ visit.register(ast.Call)
-def _(node: ast.Call, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.func, visitor, node, "func")
-    for i, a in enumerate(node.args):
-        visit(a, visitor, node, f"args.{i}")
-
-
-@ visit.register
-def _(node: ast.If, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.test, visitor, node, "test")
-    visit(node.body, visitor, node, "body")
-    visit(node.orelse, visitor, node, "orelse")
-
-
-@ visit.register
-def _(node: ast.BinOp, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.left, visitor, node, "left")
-    visit(node.right, visitor, node, "right")
-
-
-@ visit.register
-def _(node: ast.UnaryOp, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.operand, visitor, node, "operand")
-
-
-@ visit.register
-def _(node: ast.Alt, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, a in enumerate(node.alts):
-        visit(a, visitor, node, f"alts.{i}")
-
-
-@ visit.register
-def _(node: ast.Perm, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    for i, s in enumerate(node.stats):
-        visit(s, visitor, node, f"stats.{i}")
-
-
-@ visit.register
-def _(node: ast.Hint, visitor: Callable[[ast.Node, ast.Node, str], None], parent: ast.Node = None, attr: str = None):
-    visitor(node, parent, attr)
-    visit(node.block, visitor, node, "block")
+        fields = _NODE_FIELDS.get(type(node)) or _node_fields(type(node))
+        for name, is_list in reversed(fields[0]):
+            child = getattr(node, name)
+            if child is not None:
+                if is_list:
+                    for i in range(len(child) - 1, -1, -1):
+                        stack.append((child[i], node, f"{name}.{i}"))
+                else:
+                    stack.append((child, node, name))
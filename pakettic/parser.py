@@ -1,307 +1,529 @@
-from xml.dom.expatbuilder import DOCUMENT_NODE
+import re
+import sys
 from pakettic import ast
 import pyparsing as pp
-import functools
 
-pp.ParserElement.enablePackrat()
-
-LBRACK, RBRACK, LBRACE, RBRACE, LPAR, RPAR, EQ, COMMA, SEMI, COLON, PERIOD, VLINE = map(
-    pp.Suppress, '[]{}()=,;:.|'
-)
 keywords = """\
     return break do end while if then elseif else for in function local repeat until nil false true and or not goto
     """.split()
-keyword_pats = {
-    k.upper(): pp.Regex(k + r"(?![a-zA-Z_])").suppress()
-    for k in keywords
+_KEYWORDS = frozenset(keywords)
+
+# The tokens, tried in this order at each position. Whitespace and comments are
+# skipped, except the magic comments of pakettic: --{ (or --{! to disallow
+# reordering) and --} delimit a block of statements that can be reordered, and
+# --| separates alternative expressions. Debug comments --![ ... --!] are
+# ignored like long comments. Warning: order is important e.g. numbers have to
+# come before operators, as .5 would be matched as the operator .
+_TOKEN = re.compile(r"""
+    (?P<space>[ \t\r\n\f\v]+)
+  | (?P<comment>--!(?P<debug_eq>=*)\[[\s\S]*?--!(?P=debug_eq)\]
+      | --\[(?P<comment_eq>=*)\[[\s\S]*?\](?P=comment_eq)\]
+      | --(?![|{}])[^\n]*)
+  | (?P<magic>--\{!?|--\}|--\|)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<hex>0[xX](?=[0-9a-fA-F.])(?P<hex_whole>[0-9a-fA-F]*)(?:\.(?P<hex_frac>[0-9a-fA-F]*))?(?:[pP](?P<hex_exp>[+-]?\d+))?)
+  | (?P<decimal>(?=\.?\d)(?P<whole>\d*)(?:\.(?P<frac>\d*))?(?:[eE](?P<exp>[+-]?\d+))?)
+  | (?P<long_string>\[(?P<string_eq>=*)\[(?P<long_value>[\s\S]*?)\](?P=string_eq)\])
+  | (?P<short_string>"(?P<double_value>(?:[^"\\\n\r]|\\z\s*|\\[\s\S])*)"|'(?P<single_value>(?:[^'\\\n\r]|\\z\s*|\\[\s\S])*)')
+  | (?P<op>\.\.\.|\.\.|::|//|<<|>>|<=|>=|==|~=|[-+*/%^#&~|<>=(){}\[\];:,.])
+""", re.VERBOSE)
+
+_ESCAPE = re.compile(r"\\(?:x(?P<hex>[0-9a-fA-F]{2})|(?P<decimal>\d{1,3})|u\{(?P<utf8>[0-9a-fA-F]+)\}|z\s*|(?P<char>[\s\S]))")
+_ESCAPED_CHARS = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+                  '\\': '\\', '"': '"', "'": "'", '\n': '\n', '\r': '\n'}
+
+# Priorities of the binary operators; all of them are left associative. The
+# power operator is not here: it binds more strongly than unary operators to
+# the thing on its left, but less strongly to the thing on its right, so it is
+# parsed separately.
+_BINARY_PRIORITIES = {
+    'or': 1,
+    'and': 2,
+    '<': 3, '>': 3, '<=': 3, '>=': 3, '~=': 3, '==': 3,
+    '|': 4,
+    '~': 5,
+    '&': 6,
+    '<<': 7, '>>': 7,
+    '..': 8,
+    '+': 9, '-': 9,
+    '*': 10, '/': 10, '//': 10, '%': 10,
 }
-vars().update(keyword_pats)
-any_keyword = pp.MatchFirst(keyword_pats.values()).setName("<keyword>")
-
-# Name
-Name = ~any_keyword + pp.Word(pp.alphas + "_", pp.alphanums + "_")
-
-# LiteralString
-short_literal_string = (pp.QuotedString(
-    '"', escChar='\\') | pp.QuotedString('\'', escChar='\\')).setParseAction(lambda toks: ast.LiteralString(toks[0]))
-long_literal_string = pp.Regex(r"\[(=*)\[(?P<str>[\s\S]*?)\]\1\]")
-long_literal_string.setParseAction(lambda t: ast.LiteralString(
-    t["str"][1:] if t["str"].startswith("\n") else t["str"]))
-LiteralString = short_literal_string | long_literal_string
-
-# Numeral
-base10 = pp.Regex(r"(?P<whole>\d+)(?:\.(?P<frac>\d*))?(?:[eE](?P<exp>[+-]?\d+))?")
-base10.set_parse_action(lambda t: ast.Numeral(int(t["whole"] or 0), int(
-    t["frac"][::-1]) if t["frac"] else 0, int(t["exp"] or 0)))
-
-frac10 = pp.Regex(r"\.(?P<frac>\d+)(?:[eE](?P<exp>[+-]?\d+))?")
-frac10.set_parse_action(lambda t: ast.Numeral(0, int(t["frac"][::-1] or 0), int(t["exp"] or 0)))
-
-base16 = pp.Regex(r"0[xX](?P<whole>[0-9a-fA-F]+)(?:\.(?P<frac>[0-9a-fA-F]*))?(?:[pP](?P<exp>[+-]?\d+))?")
-base16.set_parse_action(lambda t: ast.Numeral(int(t["whole"], 16) if t["whole"]
-                        else 0, int(t["frac"][::-1], 16) if t["frac"] else 0, int(t["exp"] or 0), hex=True))
-
-frac16 = pp.Regex(r"0[xX]\.(?P<frac>[0-9a-fA-F]*)(?:[pP](?P<exp>[+-]?\d+))?")
-frac16.set_parse_action(lambda t: ast.Numeral(0, int(t["frac"][::-1], 16) if t["frac"] else 0, int(t["exp"] or 0), hex=True))
-
-# warning: order is important. base16 have to come before base10 as 0x would be matched as 0
-Numeral = base16 | frac16 | base10 | frac10
-
-# The actual grammar
-stat = pp.Forward()
-retstat = pp.Forward()
-varlist = pp.Forward()
-explist = pp.Forward()
-functioncall = pp.Forward()
-label = pp.Forward()
-exp = pp.Forward()
-namelist = pp.Forward()
-funcname = pp.Forward()
-funcbody = pp.Forward()
-var = pp.Forward()
-functiondef = pp.Forward()
-prefixexp = pp.Forward()
-tableconstructor = pp.Forward()
-args = pp.Forward()
-parlist = pp.Forward()
-fieldlist = pp.Forward()
-fieldsep = pp.Forward()
-field = pp.Forward()
-
-# block ::= {stat} [retstat]
-block = pp.Group(stat[0, ...] + retstat[0, 1], aslist=True)
-block.set_parse_action(lambda t: ast.Block(t[0]))
-chunk = block
-
-# stat ::=  ‘;’ |
-#        varlist ‘=’ explist |
-#        functioncall |
-#        label |
-#        break |
-#        goto Name |
-#        do block end |
-#        while exp do block end |
-#        repeat block until exp |
-#        if exp then block {elseif exp then block} [else block] end |
-#        for Name ‘=’ exp ‘,’ exp [‘,’ exp] do block end |
-#        for namelist in explist do block end |
-#        function funcname funcbody |
-#        local function Name funcbody |
-#        local namelist [‘=’ explist]
-assign = varlist + EQ + explist
-assign.set_parse_action(lambda toks: ast.Assign(toks[0], toks[1]))
-break_ = BREAK.set_parse_action(lambda toks: ast.Break())
-goto = (GOTO - Name).set_parse_action(lambda toks: ast.Goto(toks[0]))
-doblock = DO - block - END
-doblock.set_parse_action(lambda t: ast.Do(t[0]))
-permblockstart = pp.Regex(r"--{[!]?")
-permblockstart.set_parse_action(lambda t:
-                                len(t[0]) < 4)
-permblock = permblockstart + pp.Group(stat[0, ...], aslist=True) + pp.Literal('--}').suppress()
-permblock.set_parse_action(lambda t: ast.Perm(t[1], allow_reorder=t[0]))
-while_ = WHILE - exp - DO - block - END
-while_.set_parse_action(lambda toks: ast.While(toks[0], toks[1]))
-repeat = REPEAT - block - UNTIL - exp
-repeat.set_parse_action(lambda toks: ast.Repeat(condition=toks[1], block=toks[0]))
-for_range = FOR + Name + EQ - exp - COMMA - exp - (COMMA - exp)[0, 1] - DO - block - END
-for_range.set_parse_action(lambda t: ast.ForRange(ast.Name(t[0]), t[1], t[2], None, t[3]) if len(
-    t) < 5 else ast.ForRange(ast.Name(t[0]), t[1], t[2], t[3], t[4]))
-if_ = IF - exp + THEN + block + \
-    pp.Group(pp.ZeroOrMore(pp.Group(ELSEIF - exp + THEN + block))) + \
-    pp.Optional(ELSE - block, default=None) + END
-# The AST does not know anything about elseif; split them into else if
-if_.set_parse_action(lambda toks: functools.reduce(lambda x, y: ast.If(x.test, body=x.body, orelse=ast.Block([ast.If(
-    test=y[0], body=y[1], orelse=x.orelse)])), reversed(toks[2]), ast.If(test=toks[0], body=toks[1], orelse=toks[3])))
-for_in = FOR + pp.Group(namelist, aslist=True) + IN - \
-    explist - DO - block - END
-for_in.set_parse_action(lambda toks: ast.ForIn(toks[0], toks[1], toks[2]))
-local_var = LOCAL + pp.Group(namelist, aslist=True) - (EQ + explist)[0, 1]
-local_var.set_parse_action(lambda toks: ast.Local(toks[0], None) if len(toks) < 2 else ast.Local(toks[0], toks[1]))
-func_vanilla_def = FUNCTION + funcname + funcbody
-func_vanilla_def.set_parse_action(lambda toks: ast.Assign([toks[0]], [toks[1]]))
-# function t.a.b.c:f (params) body end is syntactic sugar for t.a.b.c.f = function (self, params) body end
-func_member_def = FUNCTION + funcname + COLON - Name - funcbody
-func_member_def.set_parse_action(lambda t: ast.Assign(
-    [ast.Index(t[0], ast.LiteralString(t[1]))],
-    [ast.Func(args=[ast.Name('self')] + t[2].args, body=t[2].body)]
-))
-func_def = func_vanilla_def | func_member_def
-local_func_def = LOCAL + FUNCTION - Name - funcbody
-local_func_def.set_parse_action(lambda toks: ast.LocalFunc(ast.Name(toks[0]), toks[1].args, toks[1].body))
-
-stat <<= SEMI | \
-    label | \
-    break_ | \
-    goto | \
-    doblock | \
-    permblock | \
-    while_ | \
-    repeat | \
-    for_range | \
-    if_ | \
-    for_in | \
-    local_var | \
-    func_def | \
-    assign | \
-    local_func_def | \
-    functioncall
-
-# retstat ::= return [explist] [‘;’]
-retstat <<= RETURN - pp.Optional(explist, default=[]) - SEMI[0, 1]
-retstat.set_parse_action(lambda toks: ast.Return(exps=toks[0]))
-
-# label ::= ‘::’ Name ‘::’
-label <<= pp.Literal('::').suppress() - Name - pp.Literal('::').suppress()
-label.set_parse_action(lambda toks: ast.Label(toks[0]))
-
-# funcname ::= Name {‘.’ Name} [‘:’ Name]
-funcname <<= Name - (PERIOD - Name)[0, ...]
-funcname.set_parse_action(lambda t: functools.reduce(lambda x, y: ast.Index(x, ast.LiteralString(y)), t[1:], ast.Name(t[0])))
-# the [‘:’ Name] case is handled separately
-
-# varlist ::= var {‘,’ var}
-varlist <<= pp.Group(var - (COMMA - var)[0, ...], aslist=True)
-
-# namelist ::= Name {‘,’ Name}
-_Name = Name.copy().set_parse_action(lambda t: ast.Name(t[0]))
-namelist <<= _Name - (COMMA + _Name)[0, ...]
-
-# explist ::= exp {‘,’ exp}
-explist <<= pp.Group(exp - (COMMA - exp)[0, ...], aslist=True)
-
-# exp ::=  nil | false | true | Numeral | LiteralString | ‘...’ | functiondef | prefixexp | tableconstructor | exp binop exp | unop exp
-
-
-left_assoc = lambda t: functools.reduce(lambda x, y: ast.BinOp(x, y[0], y[1]), zip(t[0][1::2], t[0][2::2]), t[0][0])
-right_assoc = lambda t: functools.reduce(lambda x, y: ast.BinOp(y[1], y[0], x), zip(t[0][-2::-2], t[0][-3::-2]), t[0][-1])
-alt = lambda t: ast.Alt(t.asList()) if len(t) > 1 else t[0]
-
-
-def unaryAction(t):
-    return functools.reduce(lambda x, y: ast.UnaryOp(op=y, operand=x), t[-2::-1], t[-1])
-
-
-nil = pp.Keyword("nil").set_parse_action(lambda: ast.Nil())
-false = pp.Keyword("false").set_parse_action(lambda: ast.Boolean(False))
-true = pp.Keyword("true").set_parse_action(lambda: ast.Boolean(True))
-ellipsis = pp.Literal("...").set_parse_action(lambda: ast.Ellipsis())
-# The power operator is weird: it binds more strongly than unary to the
-# thing on its left, but less strongly than unary to its right. So, we
-# need to treat it separately
-expliteral = nil | false | true | Numeral | LiteralString | ellipsis | functiondef | prefixexp | tableconstructor | LPAR + exp + RPAR
-altexp = expliteral + (pp.Literal('--|').suppress() - expliteral)[0, ...]
-altexp.set_parse_action(alt)
-powerexp = pp.Forward()
-unaryexp = pp.Regex(r"not(?![a-zA-Z_])|#|-(?!-)|~")[0, ...] + powerexp
-unaryexp.set_parse_action(unaryAction)
-powerexp <<= altexp + (pp.Literal('^').suppress() - unaryexp)[0, 1]
-powerexp.set_parse_action(lambda t: ast.BinOp(left=t[0], op="^", right=t[1]) if len(t) > 1 else t[0])
-exp <<= pp.infixNotation(
-    unaryexp,
-    [
-        (pp.oneOf('* / // %'), 2, pp.OpAssoc.LEFT, left_assoc),
-        (pp.Regex(r"[+]|-(?!-)"), 2, pp.OpAssoc.LEFT, left_assoc),
-        ('..', 2, pp.OpAssoc.LEFT, left_assoc),
-        (pp.oneOf('<< >>'), 2, pp.OpAssoc.LEFT, left_assoc),
-        ('&', 2, pp.OpAssoc.LEFT, left_assoc),
-        ('~', 2, pp.OpAssoc.LEFT, left_assoc),
-        ('|', 2, pp.OpAssoc.LEFT, left_assoc),
-        (pp.oneOf('< > <= >= ~= ==', left_assoc),
-         2, pp.OpAssoc.LEFT, left_assoc),
-        (pp.Regex(r"and(?![a-zA-Z_])"), 2, pp.OpAssoc.LEFT, left_assoc),  # can't use AND as it suppresses the token
-        (pp.Regex(r"or(?![a-zA-Z_])"), 2, pp.OpAssoc.LEFT, left_assoc),  # can't use OR as it suppresses the token
-    ]
-)
-
-# args: := ‘(’ [explist] ‘)’ | tableconstructor | LiteralString
-args <<= LPAR + pp.Optional(explist, default=[]) + RPAR | (tableconstructor | LiteralString).set_parse_action(lambda t: [[t[0]]])
-
-
-# prefixexp: := var | functioncall | ‘(’ exp ‘)’
-# prefixexp has a nasty left recursive grammar. we need to implement the grammar slightly differently to avoid it
-postfix = args.copy().set_parse_action(lambda t: ast.Call(None, t[0])) | \
-    (COLON + Name + args).set_parse_action(lambda t: ast.MethodCall(None, t[0], t[1])) | \
-    (LBRACK + exp + RBRACK).set_parse_action(lambda t: ast.Index(None, t[0])) | \
-    (PERIOD + Name).set_parse_action(lambda t: ast.Index(None, ast.LiteralString(t[0])))
-prefixexp <<= (
-    Name.copy().set_parse_action(lambda toks: ast.Name(id=toks[0])) |
-    LPAR + exp + RPAR) + pp.ZeroOrMore(postfix)
-prefixexp.set_parse_action(lambda t: functools.reduce(
-    lambda x, y: ast.Call(x, y.args) if type(y) is ast.Call else
-    ast.MethodCall(x, y.method, y.args) if type(y) is ast.MethodCall else
-    ast.Index(x, y.item) if type(y) is ast.Index else
-    None, t[1:], t[0])
-)
-
-# var ::=  Name | prefixexp ‘[’ exp ‘]’ | prefixexp ‘.’ Name
-# var <<= Name.copy().set_parse_action(lambda t: ast.Name(t[0])) | \
-#   (prefixexp + LBRACK + exp + RBRACK).set_parse_action(lambda t: ast.Index(t[0], t[1])) | \
-#    (prefixexp + PERIOD + Name).set_parse_action(lambda t: ast.Index(t[0], ast.LiteralString(t[1])))
-
-
-def checkVar(t):
-    if not isinstance(t[0], (ast.Index, ast.Name)):
-        raise pp.ParseException(f"Expected ast.Index or ast.Name call, got {type(t[0])}")
-
-
-var <<= prefixexp.copy().add_parse_action(checkVar)
-
-# functioncall: := prefixexp args | prefixexp ‘:’ Name args
-
-
-def checkFunctionCall(t):
-    if not isinstance(t[0], (ast.Call, ast.MethodCall)):
-        raise pp.ParseException(f"Expected call or method call, got {type(t[0])}")
-
-
-functioncall <<= prefixexp.copy().add_parse_action(checkFunctionCall)
-
-# functiondef: := function funcbody
-functiondef <<= FUNCTION + funcbody
-
-# funcbody: := ‘(’ [parlist] ‘)’ block end
-funcbody <<= LPAR + pp.Optional(parlist, default=[]) + RPAR + block + END
-funcbody.set_parse_action(lambda toks: ast.Func(args=toks[0], body=toks[1]))
-
-# parlist: := namelist[‘,’ ‘...’] | ‘...’
-parlist <<= pp.Group(namelist + (COMMA + ellipsis)[0, 1] | ellipsis, aslist=True)
-
-
-# tableconstructor: := ‘{’ [fieldlist] ‘}’
-tableconstructor <<= pp.Group(LBRACE - fieldlist[0, 1] - RBRACE, aslist=True)
-tableconstructor.set_parse_action(lambda t: ast.Table(fields=t[0]))
-
-# fieldlist: := field {fieldsep field}[fieldsep]
-fieldlist <<= field + (fieldsep + field)[0, ...] + fieldsep[0, 1]
-
-
-def expFieldParseAction(t):
-    if type(t[0]) is ast.LiteralString:
-        try:
-            # if the key is a string and the string is a valid identifier, we can use NamedField instead
-            Name.parse_string(t[0].value, parse_all=True)
-            return ast.NamedField(key=t[0].value, value=t[1])
-        except:
-            pass
-    return ast.ExpressionField(key=t[0], value=t[1])
-
-
-# field: := ‘[’ exp ‘]’ ‘=’ exp | Name ‘=’ exp | exp
-field <<= (LBRACK + exp + RBRACK + EQ + exp).set_parse_action(expFieldParseAction) | \
-    (Name + EQ + exp).set_parse_action(lambda t: ast.NamedField(key=t[0], value=t[1])) | \
-    (exp.copy()).set_parse_action(lambda t: ast.Field(value=t[0]))
-
-# fieldsep ::= ‘,’ | ‘;’
-fieldsep <<= COMMA | SEMI
-
-# ignore comments, WARNING: has to be last, as it updates all the rules recursively
-comment_intro = pp.Literal("--")
-short_comment = pp.Regex(r"--(?![\|\{\}])") + pp.restOfLine
-long_comment = pp.Regex(r"--\[(=*)\[(?P<str>[\s\S]*?)\]\1\]")
-debug_comment = pp.Regex(r"--!(=*)\[[\s\S]*?--!\1\]")
-lua_comment = debug_comment | long_comment | short_comment
-block.ignore(lua_comment)
-
-
-def parse_string(x):
+_UNARY_OPS = frozenset(('not', '#', '-', '~'))
+# Tokens that end the list of statements of a block
+_BLOCK_ENDS = frozenset(('return', 'end', 'else', 'elseif', 'until', '--}', '<eof>'))
+_ARGS_STARTS = frozenset(('(', '{', '<string>'))
+
+
+def _unescape(match: re.Match) -> str:
+    if match['hex'] is not None:
+        return chr(int(match['hex'], 16))
+    if match['decimal'] is not None:
+        return chr(int(match['decimal']))
+    if match['utf8'] is not None:
+        return chr(int(match['utf8'], 16)).encode('utf-8').decode('latin-1')
+    if match['char'] is not None:
+        return _ESCAPED_CHARS[match['char']]
+    return ''  # \z skips the following whitespace
+
+
+def _tokenize(code: str) -> tuple[list, list, list]:
+    """
+    Splits the code into tokens, in a single pass over the code.
+        Parameters:
+            code (str): LUA code
+        Returns:
+            kinds (list[str]): the kind of each token. For keywords, operators
+                and magic comments, the kind is the token itself, otherwise
+                <name>, <number> or <string>. The last token is <eof>.
+            values (list): the value of each token: the name, the ast.Numeral
+                of a number or the (unescaped) value of a string. Names and
+                operators are interned and small numerals are shared, as
+                they repeat a lot in the syntax tree.
+            positions (list[int]): the position of each token in the code
+    """
+    kinds, values, positions = [], [], []
+    match, intern = _TOKEN.match, sys.intern
+    pos = 0
+    while pos < len(code):
+        m = match(code, pos)
+        if m is None:
+            raise pp.ParseException(code, pos, "Unexpected character")
+        group = m.lastgroup
+        if group == 'name':
+            value = intern(m.group())
+            kinds.append(value if value in _KEYWORDS else '<name>')
+        elif group == 'op' or group == 'magic':
+            value = intern(m.group())
+            kinds.append(value)
+        elif group == 'decimal':
+            frac = m['frac']
+            value = ast.shared(ast.Numeral(int(m['whole'] or 0), int(frac[::-1]) if frac else 0, int(m['exp'] or 0)))
+            kinds.append('<number>')
+        elif group == 'hex':
+            whole, frac = m['hex_whole'], m['hex_frac']
+            value = ast.shared(ast.Numeral(int(whole, 16) if whole else 0, int(frac[::-1], 16) if frac else 0, int(m['hex_exp'] or 0), hex=True))
+            kinds.append('<number>')
+        elif group == 'short_string':
+            value = m['double_value'] if m['double_value'] is not None else m['single_value']
+            if '\\' in value:
+                try:
+                    value = _ESCAPE.sub(_unescape, value)
+                except (KeyError, ValueError):
+                    raise pp.ParseException(code, pos, "Invalid escape sequence in string")
+            kinds.append('<string>')
+        elif group == 'long_string':
+            value = m['long_value']
+            if value.startswith('\n'):
+                value = value[1:]
+            kinds.append('<string>')
+        else:  # whitespace and comments
+            pos = m.end()
+            continue
+        values.append(value)
+        positions.append(pos)
+        pos = m.end()
+    kinds.append('<eof>')
+    values.append(None)
+    positions.append(len(code))
+    return kinds, values, positions
+
+
+class _Parser:
+    """
+    Recursive descent parser of LUA. Lists of statements, expressions and
+    binary operators are parsed in loops, so the parser recurses only as deep as
+    the code is nested, and the time is linear in the length of the code.
+    """
+
+    def __init__(self, code: str):
+        self.code = code
+        self.kinds, self.values, self.positions = _tokenize(code)
+        self.pos = 0
+
+    def error(self, msg: str):
+        raise pp.ParseException(self.code, self.positions[self.pos], msg)
+
+    def accept(self, kind: str) -> bool:
+        if self.kinds[self.pos] == kind:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind: str):
+        if self.kinds[self.pos] != kind:
+            self.error(f"Expected '{kind}'")
+        self.pos += 1
+
+    def take(self, kind: str):
+        if self.kinds[self.pos] != kind:
+            self.error(f"Expected {kind}")
+        self.pos += 1
+        return self.values[self.pos - 1]
+
+    def name(self) -> str:
+        return self.take('<name>')
+
+    # block ::= {stat} [retstat]
+    # retstat ::= return [explist] [‘;’]
+    def block(self) -> ast.Block:
+        stats = []
+        kinds = self.kinds
+        while kinds[self.pos] not in _BLOCK_ENDS:
+            stat = self.stat()
+            if stat is not None:
+                stats.append(stat)
+        if self.accept('return'):
+            exps = [] if kinds[self.pos] in _BLOCK_ENDS or kinds[self.pos] == ';' else self.explist()
+            self.accept(';')
+            stats.append(ast.Return(exps=exps))
+        return ast.Block(stats)
+
+    # stat ::=  ‘;’ |
+    #        varlist ‘=’ explist |
+    #        functioncall |
+    #        label |
+    #        break |
+    #        goto Name |
+    #        do block end |
+    #        while exp do block end |
+    #        repeat block until exp |
+    #        if exp then block {elseif exp then block} [else block] end |
+    #        for Name ‘=’ exp ‘,’ exp [‘,’ exp] do block end |
+    #        for namelist in explist do block end |
+    #        function funcname funcbody |
+    #        local function Name funcbody |
+    #        local namelist [‘=’ explist]
+    # Returns None for ‘;’, which is not included in the syntax tree
+    def stat(self) -> ast.Node:
+        kind = self.kinds[self.pos]
+        if kind == '<name>' or kind == '(':
+            return self.exprstat()
+        self.pos += 1
+        if kind == 'local':
+            if self.accept('function'):
+                name = ast.Name(self.name())
+                func = self.funcbody()
+                return ast.LocalFunc(name, func.args, func.body)
+            targets = self.namelist()
+            return ast.Local(targets, self.explist() if self.accept('=') else None)
+        if kind == 'if':
+            return self.if_()
+        if kind == 'function':
+            # funcname ::= Name {‘.’ Name} [‘:’ Name]
+            target = ast.Name(self.name())
+            while self.accept('.'):
+                target = ast.Index(target, ast.LiteralString(self.name()))
+            if self.accept(':'):
+                # function t.a.b.c:f (params) body end is syntactic sugar for t.a.b.c.f = function (self, params) body end
+                method = ast.LiteralString(self.name())
+                func = self.funcbody()
+                return ast.Assign([ast.Index(target, method)], [ast.Func(args=[ast.Name('self')] + func.args, body=func.body)])
+            return ast.Assign([target], [self.funcbody()])
+        if kind == 'for':
+            var = ast.Name(self.name())
+            if self.accept('='):
+                lb = self.exp()
+                self.expect(',')
+                ub = self.exp()
+                step = self.exp() if self.accept(',') else None
+                return ast.ForRange(var, lb, ub, step, self.doblock())
+            names = [var]
+            while self.accept(','):
+                names.append(ast.Name(self.name()))
+            self.expect('in')
+            exps = self.explist()
+            return ast.ForIn(names, exps, self.doblock())
+        if kind == ';':
+            return None
+        if kind == 'while':
+            condition = self.exp()
+            return ast.While(condition, self.doblock())
+        if kind == 'do':
+            block = self.block()
+            self.expect('end')
+            return ast.Do(block)
+        if kind == 'repeat':
+            block = self.block()
+            self.expect('until')
+            return ast.Repeat(condition=self.exp(), block=block)
+        if kind == 'break':
+            return ast.shared(ast.Break())
+        if kind == 'goto':
+            return ast.Goto(self.name())
+        if kind == '::':
+            # label ::= ‘::’ Name ‘::’
+            label = ast.Label(self.name())
+            self.expect('::')
+            return label
+        if kind == '--{' or kind == '--{!':
+            stats = []
+            while not self.accept('--}'):
+                stat = self.stat()
+                if stat is not None:
+                    stats.append(stat)
+            return ast.Perm(stats, allow_reorder=kind == '--{')
+        self.pos -= 1
+        self.error("Expected statement")
+
+    # varlist ‘=’ explist | functioncall
+    def exprstat(self) -> ast.Node:
+        first = self.prefixexp()
+        if self.kinds[self.pos] != '=' and self.kinds[self.pos] != ',':
+            if not isinstance(first, (ast.Call, ast.MethodCall)):
+                self.error("Expected call or assignment")
+            return first
+        targets = [first]
+        while self.accept(','):
+            targets.append(self.prefixexp())
+        for target in targets:
+            if not isinstance(target, (ast.Index, ast.Name)):
+                self.error(f"Cannot assign to {type(target).__name__}")
+        self.expect('=')
+        return ast.Assign(targets, self.explist())
+
+    # The AST does not know anything about elseif; split them into else if
+    def if_(self) -> ast.If:
+        branches = []
+        while True:
+            test = self.exp()
+            self.expect('then')
+            branches.append((test, self.block()))
+            if not self.accept('elseif'):
+                break
+        orelse = self.block() if self.accept('else') else None
+        self.expect('end')
+        for test, body in reversed(branches[1:]):
+            orelse = ast.Block([ast.If(test=test, body=body, orelse=orelse)])
+        return ast.If(test=branches[0][0], body=branches[0][1], orelse=orelse)
+
+    # do block end
+    def doblock(self) -> ast.Block:
+        self.expect('do')
+        block = self.block()
+        self.expect('end')
+        return block
+
+    # namelist ::= Name {‘,’ Name}
+    def namelist(self) -> list[ast.Name]:
+        names = [ast.Name(self.name())]
+        while self.accept(','):
+            names.append(ast.Name(self.name()))
+        return names
+
+    # explist ::= exp {‘,’ exp}
+    def explist(self) -> list[ast.Node]:
+        exps = [self.exp()]
+        while self.accept(','):
+            exps.append(self.exp())
+        return exps
+
+    # exp ::=  nil | false | true | Numeral | LiteralString | ‘...’ | functiondef |
+    #          prefixexp | tableconstructor | exp binop exp | unop exp
+    # Precedence climbing: the right operand of a binary operator contains
+    # only operators of higher priority
+    def exp(self, limit: int = 0) -> ast.Node:
+        left = self.unaryexp()
+        kinds = self.kinds
+        while True:
+            op = kinds[self.pos]
+            priority = _BINARY_PRIORITIES.get(op, 0)
+            if priority <= limit:
+                return left
+            self.pos += 1
+            left = ast.BinOp(left, op, self.exp(priority))
+
+    # unaryexp ::= {unop} powerexp
+    def unaryexp(self) -> ast.Node:
+        kinds = self.kinds
+        start = self.pos
+        while kinds[self.pos] in _UNARY_OPS:
+            self.pos += 1
+        ops = kinds[start:self.pos]
+        node = self.powerexp()
+        for op in reversed(ops):
+            node = ast.UnaryOp(op=op, operand=node)
+        return node
+
+    # powerexp ::= altexp [‘^’ unaryexp]
+    def powerexp(self) -> ast.Node:
+        left = self.altexp()
+        if self.accept('^'):
+            return ast.BinOp(left=left, op='^', right=self.unaryexp())
+        return left
+
+    # altexp ::= simpleexp {‘--|’ simpleexp}
+    def altexp(self) -> ast.Node:
+        node = self.simpleexp()
+        if self.kinds[self.pos] != '--|':
+            return node
+        alts = [node]
+        while self.accept('--|'):
+            alts.append(self.simpleexp())
+        return ast.Alt(alts)
+
+    def simpleexp(self) -> ast.Node:
+        kind = self.kinds[self.pos]
+        if kind == '<number>':
+            self.pos += 1
+            return self.values[self.pos - 1]
+        if kind == '<string>':
+            self.pos += 1
+            return ast.LiteralString(self.values[self.pos - 1])
+        if kind == '{':
+            return self.tableconstructor()
+        if kind == 'function':
+            self.pos += 1
+            return self.funcbody()
+        if kind == 'nil':
+            self.pos += 1
+            return ast.shared(ast.Nil())
+        if kind == 'true' or kind == 'false':
+            self.pos += 1
+            return ast.shared(ast.Boolean(kind == 'true'))
+        if kind == '...':
+            self.pos += 1
+            return ast.shared(ast.Ellipsis())
+        return self.prefixexp()
+
+    # prefixexp ::= var | functioncall | ‘(’ exp ‘)’
+    # var ::=  Name | prefixexp ‘[’ exp ‘]’ | prefixexp ‘.’ Name
+    # functioncall ::= prefixexp args | prefixexp ‘:’ Name args
+    # The left recursion is parsed as a loop over the postfixes
+    def prefixexp(self) -> ast.Node:
+        if self.kinds[self.pos] == '(':
+            self.pos += 1
+            node = self.exp()
+            self.expect(')')
+        elif self.kinds[self.pos] == '<name>':
+            node = ast.Name(self.name())
+        else:
+            self.error("Expected expression")
+        kinds = self.kinds
+        while True:
+            kind = kinds[self.pos]
+            if kind == '.':
+                self.pos += 1
+                node = ast.Index(node, ast.LiteralString(self.name()))
+            elif kind == '[':
+                self.pos += 1
+                node = ast.Index(node, self.exp())
+                self.expect(']')
+            elif kind == ':':
+                self.pos += 1
+                method = self.name()
+                node = ast.MethodCall(node, method, self.args())
+            elif kind in _ARGS_STARTS:
+                node = ast.Call(node, self.args())
+            else:
+                return node
+
+    def var(self) -> ast.Node:
+        node = self.prefixexp()
+        if not isinstance(node, (ast.Index, ast.Name)):
+            self.error(f"Expected ast.Index or ast.Name, got {type(node)}")
+        return node
+
+    # args ::= ‘(’ [explist] ‘)’ | tableconstructor | LiteralString
+    def args(self) -> list[ast.Node]:
+        if self.accept('('):
+            args = [] if self.kinds[self.pos] == ')' else self.explist()
+            self.expect(')')
+            return args
+        if self.kinds[self.pos] == '{':
+            return [self.tableconstructor()]
+        return [ast.LiteralString(self.take('<string>'))]
+
+    # funcbody ::= ‘(’ [parlist] ‘)’ block end
+    # parlist ::= namelist [‘,’ ‘...’] | ‘...’
+    def funcbody(self) -> ast.Func:
+        self.expect('(')
+        args = []
+        if not self.accept(')'):
+            while True:
+                if self.accept('...'):
+                    args.append(ast.shared(ast.Ellipsis()))
+                    break
+                args.append(ast.Name(self.name()))
+                if not self.accept(','):
+                    break
+            self.expect(')')
+        body = self.block()
+        self.expect('end')
+        return ast.Func(args=args, body=body)
+
+    # tableconstructor ::= ‘{’ [fieldlist] ‘}’
+    # fieldlist ::= field {fieldsep field} [fieldsep]
+    # field ::= ‘[’ exp ‘]’ ‘=’ exp | Name ‘=’ exp | exp
+    # fieldsep ::= ‘,’ | ‘;’
+    def tableconstructor(self) -> ast.Table:
+        self.expect('{')
+        fields = []
+        kinds = self.kinds
+        while kinds[self.pos] != '}':
+            if self.accept('['):
+                key = self.exp()
+                self.expect(']')
+                self.expect('=')
+                value = self.exp()
+                # if the key is a string and the string is a valid identifier, we can use NamedField instead
+                if type(key) is ast.LiteralString and _is_name(key.value):
+                    fields.append(ast.NamedField(key=key.value, value=value))
+                else:
+                    fields.append(ast.ExpressionField(key=key, value=value))
+            elif kinds[self.pos] == '<name>' and kinds[self.pos + 1] == '=':
+                key = self.name()
+                self.pos += 1
+                fields.append(ast.NamedField(key=key, value=self.exp()))
+            else:
+                fields.append(ast.Field(value=self.exp()))
+            if not self.accept(',') and not self.accept(';'):
+                break
+        self.expect('}')
+        return ast.Table(fields=fields)
+
+
+_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def _is_name(s: str) -> bool:
+    return _NAME.fullmatch(s) is not None and s not in _KEYWORDS
+
+
+class _Rule:
+    """
+    A rule of the grammar that can be used to parse a string on its own, with
+    the same interface as the pyparsing elements of the earlier versions e.g.
+    parser.exp.parse_string('1+2', parse_all=True)[0]
+    """
+
+    def __init__(self, parse):
+        self.parse = parse
+
+    def parse_string(self, code: str, parse_all: bool = False) -> list:
+        parser = _Parser(code)
+        result = self.parse(parser)
+        if parse_all:
+            parser.expect('<eof>')
+        return [result]
+
+
+chunk = _Rule(_Parser.block)
+exp = _Rule(_Parser.exp)
+var = _Rule(_Parser.var)
+tableconstructor = _Rule(_Parser.tableconstructor)
+Name = _Rule(_Parser.name)
+Numeral = _Rule(lambda parser: parser.take('<number>'))
+LiteralString = _Rule(lambda parser: ast.LiteralString(parser.take('<string>')))
+
+
+def parse_string(x: str) -> ast.Block:
+    """
+    Parses LUA code into an abstract syntax tree
+        Parameters:
+            x (str): LUA code
+        Returns:
+            root (ast.Block): Root of the abstract syntax tree
+        Raises:
+            pyparsing.ParseException: if the code is not valid LUA
+    """
     return chunk.parse_string(x, parse_all=True)[0]
@@ -1,19 +1,50 @@
 
 
 from dataclasses import dataclass
-from functools import singledispatch
 import typing
 import re
 from pakettic import ast
 
 
-def format(node: ast.Node, pretty: bool = False, no_load: bool = False) -> str:
+def format(node: ast.Node, pretty: bool = False, no_load: bool = False, cached: bool = False) -> str:
+    """
+    Prints the code of a tree. With cached, the printed code of each subtree
+    is cached in the nodes, so after a mutation, only the mutated node and its
+    ancestors are printed again. Whoever mutates the tree must then reset
+    their Node.printed to None, like optimize does.
+    """
+    if cached:
+        return _CachedFormatter(pretty=pretty, no_load=no_load).format(node).decode('latin-1')
     return Formatter(pretty=pretty, no_load=no_load).format(node)
 
 
-_hexy = re.compile(r'[0-9a-fxA-FXpP\.]').search
-_alphaunder = re.compile('[_a-zA-Z]').search
-_alphanumunder = re.compile('[_a-zA-Z0-9]').search
+def format_bytes(node: ast.Node, pretty: bool = False, no_load: bool = False, cached: bool = False) -> bytes:
+    """Like format, but returns the code encoded as latin-1, which the cached printer builds directly"""
+    if cached:
+        return _CachedFormatter(pretty=pretty, no_load=no_load).format(node)
+    return Formatter(pretty=pretty, no_load=no_load).format(node).encode('latin-1')
+
+
+def measure(node: ast.Node, no_load: bool = False) -> int:
+    """
+    Returns len(format(node, no_load=no_load)), without printing the code. The
+    measurements of the subtrees are cached in the nodes, so after a mutation,
+    only the mutated node and its ancestors are measured again. Whoever mutates
+    the tree must reset their Node.measured to None, like optimize does.
+        Parameters:
+            node (ast.Node): Root of the tree to measure
+            no_load (bool): Print the oneline functions as functions, not loads
+        Returns:
+            length (int): Length of the printed code
+    """
+    return _Measurer(no_load=no_load).measure(node).length
+
+
+# The characters deciding the spaces between tokens, see Formatter.__addspaces
+_hexy = frozenset('0123456789abcdefxABCDEFXpP.')
+_alphaunder = frozenset('_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_alphanumunder = _alphaunder | frozenset('0123456789')
+_escaped = re.compile(r'[\\\'"\n\t\f\r]').search
 _single_quote_translation = str.maketrans({"\n": r"\n",
                                            "\t": r"\t",
                                            "\f": r"\f",
@@ -37,9 +68,19 @@ class Formatter:
     no_load: bool = False
 
     def format(self, node: ast.Node) -> str:
-        tokens = _traverse(node, self)
+        tokens = []
+        self.traverse(node, tokens)
         return ''.join(self.__addspaces(tokens))
 
+    def traverse(self, node: ast.Node, out: list):
+        """Appends the tokens of a node to out; the printing functions recurse through this"""
+        _PRINTERS.get(type(node), _print_unknown)(node, self, out)
+
+    def load(self, body: ast.Block):
+        """Returns the string literal of a function body printed as load'...'"""
+        fmt = Formatter(self.indent + 2, double_quotes=not self.double_quotes, pretty=False, no_load=self.no_load)
+        return self.escape(fmt.format(body))
+
     @property
     def __quote(self):
         return '"' if self.double_quotes else "'"
@@ -47,465 +88,671 @@ class Formatter:
     def escape(self, s: str):
         return f"{self.__quote}{s.translate(_double_quote_translation if self.double_quotes else _single_quote_translation)}{self.__quote}"
 
-    def __addspaces(self, tokens: typing.Iterable[str]):
+    def __addspaces(self, tokens: list[typing.Union[str, ast.Numeral]]) -> list[str]:
+        spaced = []
+        append = spaced.append
         prevtoken = ' '
         for token in tokens:
             if type(token) is str:
                 if len(token) == 0:
                     continue
-                if type(prevtoken) is str and bool(_alphaunder(prevtoken[0])) and bool(_alphanumunder(token[0])):
+                if type(prevtoken) is str and prevtoken[0] in _alphaunder and token[0] in _alphanumunder:
                     # the previous token was word, and the next continues with a character that might be confused with it
-                    yield ' '
-                elif type(prevtoken) is ast.Numeral and bool(_hexy(token[0])):
-                    yield ' '  # the previous token was numeral and the next starts with something that be confused with a hex or a decimal point
-                yield token
+                    append(' ')
+                elif type(prevtoken) is ast.Numeral and token[0] in _hexy:
+                    append(' ')  # the previous token was numeral and the next starts with something that be confused with a hex or a decimal point
+                append(token)
             elif type(token) is ast.Numeral:
                 strnumeral = str(token)
-                if strnumeral[0] != '.' and type(prevtoken) is str and bool(_alphaunder(prevtoken[0])):
+                if strnumeral[0] != '.' and type(prevtoken) is str and prevtoken[0] in _alphaunder:
                     # the previous token was word, and the next continues with a character that might be confused with it
-                    yield ' '
-                yield strnumeral
+                    append(' ')
+                append(strnumeral)
             prevtoken = token
+        return spaced
+
+
+def same_measure(a: str, b: str) -> bool:
+    """
+    Tells if the measurements of printer.measure stay valid when identifiers
+    a and b are swapped: identifiers start with a letter or an underscore and
+    have nothing to escape, so only the length and whether a space is needed
+    after a numeral can differ.
+    """
+    return len(a) == len(b) and (a[0] in _hexy) == (b[0] in _hexy)
+
+
+def _spaced(prevtoken, token) -> bool:
+    """Tells if Formatter.__addspaces puts a space between two non-empty tokens"""
+    if type(token) is ast.Numeral:
+        return str(token)[0] != '.' and type(prevtoken) is str and prevtoken[0] in _alphaunder
+    if type(prevtoken) is str:
+        return prevtoken[0] in _alphaunder and token[0] in _alphanumunder
+    return token[0] in _hexy
+
+
+class _Measured(typing.NamedTuple):
+    """
+    Measurement of a printed subtree: its length, the first and last tokens,
+    which decide the spaces around it, and the counts of the characters that
+    get escaped if the subtree ends up inside a load'...' string
+    """
+    length: int
+    first: typing.Union[str, ast.Numeral, None]  # None if nothing was printed
+    last: typing.Union[str, ast.Numeral, None]
+    backslashes: int = 0
+    single_quotes: int = 0
+    double_quotes: int = 0
+    controls: int = 0  # newlines, tabs, form feeds and carriage returns
+
+
+@dataclass
+class _Measurer(Formatter):
+    """
+    Formatter that measures the subtrees instead of printing them. Each child
+    is appended as a single _Measured token, cached in the node for the
+    formatting options in effect.
+    """
+
+    def measure(self, node: ast.Node) -> _Measured:
+        tokens = []
+        self.traverse(node, tokens)
+        return self.__compose(tokens)
+
+    def traverse(self, node: ast.Node, out: list):
+        if type(node) is ast.Name:
+            out.append(node.id)  # the most common node is cheaper to measure than to cache
+            return
+        key = (self.double_quotes, self.no_hex, self.no_load)
+        if node.measured is None:
+            node.measured = {}
+        m = node.measured.get(key)
+        if m is None:
+            tokens = []
+            _PRINTERS.get(type(node), _print_unknown)(node, self, tokens)
+            m = node.measured[key] = self.__compose(tokens)
+        out.append(m)
+
+    def load(self, body: ast.Block):
+        m = _Measurer(double_quotes=not self.double_quotes, no_load=self.no_load).measure(body)
+        quote = '"' if self.double_quotes else "'"
+        quotes = m.double_quotes if self.double_quotes else m.single_quotes
+        backslashes = 2 * m.backslashes + quotes + m.controls
+        length = m.length + m.backslashes + quotes + m.controls + 2
+        if self.double_quotes:
+            return _Measured(length, quote, quote, backslashes, m.single_quotes, quotes + 2)
+        return _Measured(length, quote, quote, backslashes, quotes + 2, m.double_quotes)
+
+    def __compose(self, tokens) -> _Measured:
+        length = backslashes = single_quotes = double_quotes = controls = 0
+        first = last = None
+        for token in tokens:
+            if type(token) is _Measured:
+                head = token.first
+                if head is None:
+                    continue
+                if last is not None and _spaced(last, head):
+                    length += 1
+                length += token.length
+                backslashes += token.backslashes
+                single_quotes += token.single_quotes
+                double_quotes += token.double_quotes
+                controls += token.controls
+                last = token.last
+            elif type(token) is str:
+                if len(token) == 0:
+                    continue
+                head = token
+                if last is not None and _spaced(last, token):
+                    length += 1
+                length += len(token)
+                if _escaped(token):
+                    backslashes += token.count('\\')
+                    single_quotes += token.count("'")
+                    double_quotes += token.count('"')
+                    controls += token.count('\n') + token.count('\t') + token.count('\f') + token.count('\r')
+                last = token
+            else:
+                head = token
+                if last is not None and _spaced(last, token):
+                    length += 1
+                length += len(str(token))
+                last = token
+            if first is None:
+                first = head
+        return _Measured(length, first, last, backslashes, single_quotes, double_quotes, controls)
+
+
+# The latin-1 encodings of the tokens printed so far, starting with the
+# keywords and operators, as the same tokens get printed over and over
+_encoded = {t: t.encode('latin-1') for t in (
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto', 'if', 'in', 'load', 'local',
+    'local function', 'nil', 'not', 'or', 'repeat', 'return', 'then', 'true', 'until', 'while',
+    '+', '-', '*', '/', '//', '%', '^', '#', '&', '~', '|', '<<', '>>', '..', '==', '~=', '<=', '>=', '<', '>', '=',
+    '(', ')', '{', '}', '[', ']', ']=', '::', ':', ',', '.', '...', '--|', '--{', '--{!', '--}', '\n')}
+_MAX_ENCODED = 1 << 16
+
+
+def _encode(token: str) -> bytes:
+    if len(_encoded) >= _MAX_ENCODED:
+        _encoded.clear()  # e.g. after many carts with different names and strings
+    b = _encoded[token] = token.encode('latin-1')
+    return b
+
+
+class _Fragment(typing.NamedTuple):
+    """Printed code of a subtree in latin-1, with its first and last tokens, which decide the spaces around it"""
+    code: bytes
+    first: typing.Union[str, ast.Numeral, None]  # None if nothing was printed
+    last: typing.Union[str, ast.Numeral, None]
 
 
-# This used to be a singledispatchmethod of Formatter, but for some reason, @singledispatchmethod are far slower than
-# @singledispatch
-@ singledispatch
-def _traverse(node: ast.Node, fmt: Formatter):
+@dataclass
+class _CachedFormatter(Formatter):
+    """
+    Formatter that caches the printed code of each subtree in the node, for
+    the formatting options in effect. Each child is appended as a single
+    _Fragment token. The code is built as latin-1 bytes, so that it needs
+    not to be encoded for compressing.
+    """
+
+    def format(self, node: ast.Node) -> bytes:
+        tokens = []
+        self.traverse(node, tokens)
+        return self.__compose(tokens).code
+
+    def traverse(self, node: ast.Node, out: list):
+        if type(node) is ast.Name:
+            out.append(node.id)  # the most common node is cheaper to print than to cache
+            return
+        key = (self.double_quotes, self.no_hex, self.no_load, self.pretty, self.indent if self.pretty else 0)
+        if node.printed is None:
+            node.printed = {}
+        f = node.printed.get(key)
+        if f is None:
+            tokens = []
+            _PRINTERS.get(type(node), _print_unknown)(node, self, tokens)
+            f = node.printed[key] = self.__compose(tokens)
+        out.append(f)
+
+    def load(self, body: ast.Block):
+        fmt = _CachedFormatter(self.indent + 2, double_quotes=not self.double_quotes, no_load=self.no_load)
+        return self.escape(fmt.format(body).decode('latin-1'))
+
+    def __compose(self, tokens) -> _Fragment:
+        parts = []
+        first = last = None
+        encoded = _encoded
+        for token in tokens:
+            if type(token) is _Fragment:
+                head = token.first
+                if head is None:
+                    continue
+                if last is not None and _spaced(last, head):
+                    parts.append(b' ')
+                parts.append(token.code)
+                last = token.last
+            elif type(token) is str:
+                if len(token) == 0:
+                    continue
+                head = token
+                if last is not None and _spaced(last, token):
+                    parts.append(b' ')
+                parts.append(encoded.get(token) or _encode(token))
+                last = token
+            else:
+                head = token
+                if last is not None and _spaced(last, token):
+                    parts.append(b' ')
+                parts.append(str(token).encode('latin-1'))
+                last = token
+            if first is None:
+                first = head
+        return _Fragment(b''.join(parts), first, last)
+
+
+# The printing functions of the node classes. Each appends the tokens of a
+# node to out, and the children through fmt.traverse. This used to be a
+# @singledispatch of generators, but dispatching on the exact type with a
+# dict and appending to a list avoid the nested generators, which resumed
+# every level of the tree for every token.
+_PRINTERS = {}
+
+
+def _prints(cls):
+    def register(func):
+        _PRINTERS[cls] = func
+        return func
+    return register
+
+
+def _print_unknown(node: ast.Node, fmt: Formatter, out: list):
     # raise TypeError("_print encounted unknown ast.node")
-    yield str(node)
+    out.append(str(node))
 
 
-@ _traverse.register
-def _(node: ast.Block, fmt: Formatter):
+@_prints(ast.Block)
+def _(node: ast.Block, fmt: Formatter, out: list):
+    if not fmt.pretty:
+        for n in node.stats:
+            fmt.traverse(n, out)
+        return
     for n in node.stats:
-        if fmt.pretty:
-            yield '  ' * fmt.indent
-        yield from _traverse(n, fmt)
-        if fmt.pretty:
-            yield '\n'
+        out.append('  ' * fmt.indent)
+        fmt.traverse(n, out)
+        out.append('\n')
 
 
-@ _traverse.register
-def _(node: ast.Return, fmt: Formatter):
-    yield 'return'
+@_prints(ast.Return)
+def _(node: ast.Return, fmt: Formatter, out: list):
+    out.append('return')
     for i, v in enumerate(node.exps):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
+            out.append(',')
+        fmt.traverse(v, out)
 
 
-@ _traverse.register
-def _(node: ast.Perm, fmt: Formatter):
+@_prints(ast.Perm)
+def _(node: ast.Perm, fmt: Formatter, out: list):
     if fmt.pretty:
         if node.allow_reorder:
-            yield '--{'
+            out.append('--{')
         else:
-            yield '--{!'
-        yield '\n'
-        yield '  ' * fmt.indent
+            out.append('--{!')
+        out.append('\n')
+        out.append('  ' * fmt.indent)
     for i, n in enumerate(node.stats):
         if fmt.pretty and i > 0:
-            yield '  ' * fmt.indent
-        yield from _traverse(n, fmt)
+            out.append('  ' * fmt.indent)
+        fmt.traverse(n, out)
         if fmt.pretty and i < len(node.stats) - 1:
-            yield '\n'
+            out.append('\n')
     if fmt.pretty:
-        yield '\n'
-        yield '  ' * fmt.indent
-        yield '--}'
+        out.append('\n')
+        out.append('  ' * fmt.indent)
+        out.append('--}')
 
 
-@ _traverse.register
-def _(node: ast.Do, fmt: Formatter):
-    yield 'do'
+@_prints(ast.Do)
+def _(node: ast.Do, fmt: Formatter, out: list):
+    out.append('do')
     if fmt.pretty:
-        yield '\n'
+        out.append('\n')
     fmt.indent += 1
-    yield from _traverse(node.block, fmt)
+    fmt.traverse(node.block, out)
     fmt.indent -= 1
     if fmt.pretty:
-        yield '  ' * fmt.indent
-    yield 'end'
+        out.append('  ' * fmt.indent)
+    out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.Assign, fmt: Formatter):
+@_prints(ast.Assign)
+def _(node: ast.Assign, fmt: Formatter, out: list):
     for i, v in enumerate(node.targets):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
-    yield '='
+            out.append(',')
+        fmt.traverse(v, out)
+    out.append('=')
     for i, v in enumerate(node.values):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
+            out.append(',')
+        fmt.traverse(v, out)
 
 
-@ _traverse.register
-def _(node: ast.Label, fmt: Formatter):
-    yield '::'
-    yield node.name
-    yield '::'
+@_prints(ast.Label)
+def _(node: ast.Label, fmt: Formatter, out: list):
+    out.append('::')
+    out.append(node.name)
+    out.append('::')
 
 
-@ _traverse.register
-def _(node: ast.Break, fmt: Formatter):
-    yield 'break'
+@_prints(ast.Break)
+def _(node: ast.Break, fmt: Formatter, out: list):
+    out.append('break')
 
 
-@ _traverse.register
-def _(node: ast.LiteralString, fmt: Formatter):
-    yield fmt.escape(node.value)
+@_prints(ast.LiteralString)
+def _(node: ast.LiteralString, fmt: Formatter, out: list):
+    out.append(fmt.escape(node.value))
 
 
-@ _traverse.register
-def _(node: ast.Goto, fmt: Formatter):
-    yield 'goto'
-    yield node.target
+@_prints(ast.Goto)
+def _(node: ast.Goto, fmt: Formatter, out: list):
+    out.append('goto')
+    out.append(node.target)
 
 
-@ _traverse.register
-def _(node: ast.Boolean, fmt: Formatter):
-    yield 'true' if node.value else 'false'
+@_prints(ast.Boolean)
+def _(node: ast.Boolean, fmt: Formatter, out: list):
+    out.append('true' if node.value else 'false')
 
 
-@ _traverse.register
-def _(node: ast.Ellipsis, fmt: Formatter):
-    yield '...'
+@_prints(ast.Ellipsis)
+def _(node: ast.Ellipsis, fmt: Formatter, out: list):
+    out.append('...')
 
 
-@ _traverse.register
-def _(node: ast.Nil, fmt: Formatter):
-    yield 'nil'
+@_prints(ast.Nil)
+def _(node: ast.Nil, fmt: Formatter, out: list):
+    out.append('nil')
 
 
-@ _traverse.register
-def _(node: ast.While, fmt: Formatter):
-    yield 'while'
-    yield from _traverse(node.condition, fmt)
-    yield 'do'
+@_prints(ast.While)
+def _(node: ast.While, fmt: Formatter, out: list):
+    out.append('while')
+    fmt.traverse(node.condition, out)
+    out.append('do')
     if fmt.pretty:
-        yield '\n'
+        out.append('\n')
     fmt.indent += 1
-    yield from _traverse(node.block, fmt)
+    fmt.traverse(node.block, out)
     fmt.indent -= 1
     if fmt.pretty:
-        yield '  ' * fmt.indent
-    yield 'end'
+        out.append('  ' * fmt.indent)
+    out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.Repeat, fmt: Formatter):
-    yield 'repeat'
+@_prints(ast.Repeat)
+def _(node: ast.Repeat, fmt: Formatter, out: list):
+    out.append('repeat')
     if fmt.pretty:
-        yield '\n'
+        out.append('\n')
     fmt.indent += 1
-    yield from _traverse(node.block, fmt)
+    fmt.traverse(node.block, out)
     fmt.indent -= 1
-    yield 'until'
-    yield from _traverse(node.condition, fmt)
-
-
-@ _traverse.register
-def _(node: ast.ForRange, fmt: Formatter):
-    yield 'for'
-    yield from _traverse(node.var, fmt)
-    yield '='
-    yield from _traverse(node.lb, fmt)
-    yield ','
-    yield from _traverse(node.ub, fmt)
+    out.append('until')
+    fmt.traverse(node.condition, out)
+
+
+@_prints(ast.ForRange)
+def _(node: ast.ForRange, fmt: Formatter, out: list):
+    out.append('for')
+    fmt.traverse(node.var, out)
+    out.append('=')
+    fmt.traverse(node.lb, out)
+    out.append(',')
+    fmt.traverse(node.ub, out)
     if node.step is not None:
-        yield ','
-        yield from _traverse(node.step, fmt)
-    yield 'do'
+        out.append(',')
+        fmt.traverse(node.step, out)
+    out.append('do')
     if fmt.pretty:
-        yield '\n'
+        out.append('\n')
     fmt.indent += 1
-    yield from _traverse(node.body, fmt)
+    fmt.traverse(node.body, out)
     fmt.indent -= 1
     if fmt.pretty:
-        yield '  ' * fmt.indent
-    yield 'end'
+        out.append('  ' * fmt.indent)
+    out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.ForIn, fmt: Formatter):
-    yield 'for'
+@_prints(ast.ForIn)
+def _(node: ast.ForIn, fmt: Formatter, out: list):
+    out.append('for')
     for i, v in enumerate(node.names):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
-    yield 'in'
+            out.append(',')
+        fmt.traverse(v, out)
+    out.append('in')
     for i, v in enumerate(node.exps):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
-    yield 'do'
+            out.append(',')
+        fmt.traverse(v, out)
+    out.append('do')
     if fmt.pretty:
-        yield '\n'
+        out.append('\n')
     fmt.indent += 1
-    yield from _traverse(node.body, fmt)
+    fmt.traverse(node.body, out)
     fmt.indent -= 1
     if fmt.pretty:
-        yield '  ' * fmt.indent
-    yield 'end'
+        out.append('  ' * fmt.indent)
+    out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.Local, fmt: Formatter):
-    yield 'local'
+@_prints(ast.Local)
+def _(node: ast.Local, fmt: Formatter, out: list):
+    out.append('local')
     for i, v in enumerate(node.targets):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
+            out.append(',')
+        fmt.traverse(v, out)
     if node.values is not None:
-        yield '='
+        out.append('=')
         for i, v in enumerate(node.values):
             if i > 0:
-                yield ','
-            yield from _traverse(v, fmt)
+                out.append(',')
+            fmt.traverse(v, out)
 
 
-@ _traverse.register
-def _(node: ast.Func, fmt: Formatter):
+@_prints(ast.Func)
+def _(node: ast.Func, fmt: Formatter, out: list):
     if (len(node.args) == 0 or (len(node.args) == 1 and type(node.args[0]) == ast.Ellipsis)) and not fmt.pretty and not fmt.no_load and node.oneline:
-        fmt.indent += 1
-        fmt2 = Formatter(fmt.indent + 1, double_quotes=not fmt.double_quotes, pretty=False, no_load=fmt.no_load)
-        s = fmt2.format(node.body)
-        yield 'load'
-        yield fmt.escape(s)
-        fmt.indent -= 1
+        out.append('load')
+        out.append(fmt.load(node.body))
     else:
-        yield 'function'
-        yield '('
+        out.append('function')
+        out.append('(')
         for i, v in enumerate(node.args):
             if i > 0:
-                yield ','
-            yield from _traverse(v, fmt)
-        yield ')'
+                out.append(',')
+            fmt.traverse(v, out)
+        out.append(')')
         if fmt.pretty:
-            yield '\n'
+            out.append('\n')
         fmt.indent += 1
-        yield from _traverse(node.body, fmt)
+        fmt.traverse(node.body, out)
         fmt.indent -= 1
         if fmt.pretty:
-            yield '  ' * fmt.indent
-        yield 'end'
+            out.append('  ' * fmt.indent)
+        out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.LocalFunc, fmt: Formatter):
-    yield 'local function'
-    yield node.name.id
-    yield '('
+@_prints(ast.LocalFunc)
+def _(node: ast.LocalFunc, fmt: Formatter, out: list):
+    out.append('local function')
+    out.append(node.name.id)
+    out.append('(')
     for i, v in enumerate(node.args):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
-    yield ')'
+            out.append(',')
+        fmt.traverse(v, out)
+    out.append(')')
     if fmt.pretty:
-        yield '\n'
+        out.append('\n')
     fmt.indent += 1
-    yield from _traverse(node.body, fmt)
+    fmt.traverse(node.body, out)
     fmt.indent -= 1
     if fmt.pretty:
-        yield '  ' * fmt.indent
-    yield 'end'
+        out.append('  ' * fmt.indent)
+    out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.Index, fmt: Formatter):
+@_prints(ast.Index)
+def _(node: ast.Index, fmt: Formatter, out: list):
     require_parentheses = type(node.obj) is not ast.Name and \
         type(node.obj) is not ast.Index and \
         type(node.obj) is not ast.MethodCall and \
         type(node.obj) is not ast.Call
     if require_parentheses:
-        yield '('
-    yield from _traverse(node.obj, fmt)
+        out.append('(')
+    fmt.traverse(node.obj, out)
     if require_parentheses:
-        yield ')'
+        out.append(')')
     if type(node.item) is ast.LiteralString:
-        yield '.'
-        yield node.item.value
+        out.append('.')
+        out.append(node.item.value)
     else:
-        yield '['
-        yield from _traverse(node.item, fmt)
-        yield ']'
+        out.append('[')
+        fmt.traverse(node.item, out)
+        out.append(']')
 
 
-@ _traverse.register
-def _(node: ast.Table, fmt: Formatter):
-    yield '{'
+@_prints(ast.Table)
+def _(node: ast.Table, fmt: Formatter, out: list):
+    out.append('{')
     for i, f in enumerate(node.fields):
         if i > 0:
-            yield ','
-        yield from _traverse(f, fmt)
-    yield '}'
+            out.append(',')
+        fmt.traverse(f, out)
+    out.append('}')
 
 
-@ _traverse.register
-def _(node: ast.NamedField, fmt: Formatter):
-    yield node.key
-    yield '='
-    yield from _traverse(node.value, fmt)
+@_prints(ast.NamedField)
+def _(node: ast.NamedField, fmt: Formatter, out: list):
+    out.append(node.key)
+    out.append('=')
+    fmt.traverse(node.value, out)
 
 
-@ _traverse.register
-def _(node: ast.ExpressionField, fmt: Formatter):
-    yield '['
-    yield from _traverse(node.key, fmt)
-    yield ']='
-    yield from _traverse(node.value, fmt)
+@_prints(ast.ExpressionField)
+def _(node: ast.ExpressionField, fmt: Formatter, out: list):
+    out.append('[')
+    fmt.traverse(node.key, out)
+    out.append(']=')
+    fmt.traverse(node.value, out)
 
 
-@ _traverse.register
-def _(node: ast.Field, fmt: Formatter):
-    yield from _traverse(node.value, fmt)
+@_prints(ast.Field)
+def _(node: ast.Field, fmt: Formatter, out: list):
+    fmt.traverse(node.value, out)
 
 
-@ _traverse.register
-def _(node: ast.Call, fmt: Formatter):
-    yield from _traverse(node.func, fmt)
+@_prints(ast.Call)
+def _(node: ast.Call, fmt: Formatter, out: list):
+    fmt.traverse(node.func, out)
     if len(node.args) == 1 and (type(node.args[0]) is ast.Table or type(node.args[0]) is ast.LiteralString):
-        yield from _traverse(node.args[0], fmt)
+        fmt.traverse(node.args[0], out)
     else:
-        yield '('
+        out.append('(')
         for i, v in enumerate(node.args):
             if i > 0:
-                yield ','
-            yield from _traverse(v, fmt)
-        yield ')'
+                out.append(',')
+            fmt.traverse(v, out)
+        out.append(')')
 
 
-@ _traverse.register
-def _(node: ast.MethodCall, fmt: Formatter):
+@_prints(ast.MethodCall)
+def _(node: ast.MethodCall, fmt: Formatter, out: list):
     require_parentheses = type(node.value) is not ast.Name and \
         type(node.value) is not ast.Index and \
         type(node.value) is not ast.MethodCall and \
         type(node.value) is not ast.Call
     if require_parentheses:
-        yield '('
-    yield from _traverse(node.value, fmt)
+        out.append('(')
+    fmt.traverse(node.value, out)
     if require_parentheses:
-        yield ')'
-    yield ':'
-    yield from _traverse(node.method, fmt)
-    yield '('
+        out.append(')')
+    out.append(':')
+    out.append(node.method)
+    out.append('(')
     for i, v in enumerate(node.args):
         if i > 0:
-            yield ','
-        yield from _traverse(v, fmt)
-    yield ')'
+            out.append(',')
+        fmt.traverse(v, out)
+    out.append(')')
 
 
-@ _traverse.register
-def _(node: ast.If, fmt: Formatter):
-    yield 'if'
-    yield from _traverse(node.test, fmt)
-    yield 'then'
+@_prints(ast.If)
+def _(node: ast.If, fmt: Formatter, out: list):
+    out.append('if')
+    fmt.traverse(node.test, out)
+    out.append('then')
     fmt.indent += 1
     if fmt.pretty:
-        yield '\n'
-    yield from _traverse(node.body, fmt)
+        out.append('\n')
+    fmt.traverse(node.body, out)
     fmt.indent -= 1
     while node.orelse is not None and len(node.orelse.stats) == 1 and type(node.orelse.stats[0]) == ast.If:
         node = node.orelse.stats[0]
         if fmt.pretty:
-            yield '  ' * fmt.indent
-        yield 'elseif'
-        yield from _traverse(node.test, fmt)
-        yield 'then'
+            out.append('  ' * fmt.indent)
+        out.append('elseif')
+        fmt.traverse(node.test, out)
+        out.append('then')
         fmt.indent += 1
         if fmt.pretty:
-            yield '\n'
-        yield from _traverse(node.body, fmt)
+            out.append('\n')
+        fmt.traverse(node.body, out)
         fmt.indent -= 1
     if node.orelse is not None:
         if fmt.pretty:
-            yield '  ' * fmt.indent
-        yield 'else'
+            out.append('  ' * fmt.indent)
+        out.append('else')
         if fmt.pretty:
-            yield '\n'
+            out.append('\n')
         fmt.indent += 1
-        yield from _traverse(node.orelse, fmt)
+        fmt.traverse(node.orelse, out)
         fmt.indent -= 1
     if fmt.pretty:
-        yield '  ' * fmt.indent
-    yield 'end'
+        out.append('  ' * fmt.indent)
+    out.append('end')
 
 
-@ _traverse.register
-def _(node: ast.Name, fmt: Formatter):
-    yield node.id
+@_prints(ast.Name)
+def _(node: ast.Name, fmt: Formatter, out: list):
+    out.append(node.id)
 
 
-@ _traverse.register
-def _(node: ast.BinOp, fmt: Formatter):
+@_prints(ast.BinOp)
+def _(node: ast.BinOp, fmt: Formatter, out: list):
+    precedence = node.precedence
+    left, right = node.left.precedence, node.right.precedence
     if node.op == '^':
-        if node.left.precedence >= node.precedence:
-            yield '('
-        yield from _traverse(node.left, fmt)
-        if node.left.precedence >= node.precedence:
-            yield ')'
-        yield node.op
-        if node.right.precedence > node.precedence:
-            yield '('
-        yield from _traverse(node.right, fmt)
-        if node.right.precedence > node.precedence:
-            yield ')'
+        left_parens, right_parens = left >= precedence, right > precedence
     else:
-        if node.left.precedence > node.precedence:
-            yield '('
-        yield from _traverse(node.left, fmt)
-        if node.left.precedence > node.precedence:
-            yield ')'
-        yield node.op
-        if node.right.precedence >= node.precedence:
-            yield '('
-        yield from _traverse(node.right, fmt)
-        if node.right.precedence >= node.precedence:
-            yield ')'
-
-
-@ _traverse.register
-def _(node: ast.UnaryOp, fmt: Formatter):
-    yield node.op
-    if node.operand.precedence > node.precedence:
-        yield '('
-    yield from _traverse(node.operand, fmt)
-    if node.operand.precedence > node.precedence:
-        yield ')'
-
-
-@ _traverse.register
-def _(node: ast.Alt, fmt: Formatter):
-    yield from _traverse(node.alts[0], fmt)
+        left_parens, right_parens = left > precedence, right >= precedence
+    if left_parens:
+        out.append('(')
+    fmt.traverse(node.left, out)
+    if left_parens:
+        out.append(')')
+    out.append(node.op)
+    if right_parens:
+        out.append('(')
+    fmt.traverse(node.right, out)
+    if right_parens:
+        out.append(')')
+
+
+@_prints(ast.UnaryOp)
+def _(node: ast.UnaryOp, fmt: Formatter, out: list):
+    out.append(node.op)
+    parens = node.operand.precedence > node.precedence
+    if parens:
+        out.append('(')
+    fmt.traverse(node.operand, out)
+    if parens:
+        out.append(')')
+
+
+@_prints(ast.Alt)
+def _(node: ast.Alt, fmt: Formatter, out: list):
+    fmt.traverse(node.alts[0], out)
     if fmt.pretty and len(node.alts) > 0:
         for i, v in enumerate(node.alts[1:]):
-            yield '--|'
-            yield from _traverse(v, fmt)
+            out.append('--|')
+            fmt.traverse(v, out)
             if i == len(node.alts) - 2:
-                yield '\n'
-                yield '  ' * fmt.indent
+                out.append('\n')
+                out.append('  ' * fmt.indent)
 
 
-@ _traverse.register
-def _(node: ast.Numeral, fmt: Formatter):
+@_prints(ast.Numeral)
+def _(node: ast.Numeral, fmt: Formatter, out: list):
     # We treat numerals a bit differently, to see if they need spaces before, so
-    # we yield them as Numerals, not strs
+    # we out.append(them as Numerals, not strs)
     if fmt.no_hex and node.hex and node.fractional == 0 and node.exponent == 0:
-        yield ast.Numeral(node.whole)
+        out.append(ast.Numeral(node.whole))
     else:
-        yield node
+        out.append(node)
 
 
-@ _traverse.register
-def _(node: ast.Hint, fmt: Formatter):
+@_prints(ast.Hint)
+def _(node: ast.Hint, fmt: Formatter, out: list):
     prev_double_quotes = fmt.double_quotes
     prev_no_hex = fmt.no_hex
     fmt.double_quotes = node.double_quotes
     fmt.no_hex = node.no_hex
-    yield from _traverse(node.block, fmt)
+    fmt.traverse(node.block, out)
     fmt.double_quotes = prev_double_quotes
     fmt.no_hex = prev_no_hex
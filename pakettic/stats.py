@@ -0,0 +1,113 @@
+import contextlib
+import multiprocessing
+import time
+from typing import Optional
+
+# The phases of an optimization step that are timed. Nested phases are
+# included in the time of the enclosing phase, e.g. evaluate includes checkout,
+# mutate and the phases of the cost function.
+PHASES = (
+    'get',       # Solutions.get: waiting for a result (or evaluating it, without a pool)
+    'put',       # Solutions.put: snapshotting and queuing a task
+    'evaluate',  # a whole task in the worker
+    'checkout',  # bringing the resident state up to date: replaying mutations or unpickling a snapshot
+    'mutate',    # sampling and applying a mutation, or undoing it
+    'format',    # printing the code, or measuring its length for lua carts
+    'cache',     # looking up the cost cache
+    'screen',    # compressing with zlib for the screen
+    'compress',  # writing the cart, i.e. compressing with zopfli
+)
+
+_INDEX = {phase: i for i, phase in enumerate(PHASES)}
+
+# The statistics being collected in this process, None if not collecting
+current: Optional['Stats'] = None
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+class Stats:
+    """
+    Timers and counters for the phases of the optimization. The totals live in
+    shared memory, so all the processes of a pool add to the same totals. Like
+    the cost cache, a Stats must be created before the pool and passed to the
+    pool processes in the initializer arguments.
+    """
+
+    def __init__(self):
+        self.counts = multiprocessing.RawArray('Q', len(PHASES))
+        self.times = multiprocessing.RawArray('d', len(PHASES))
+        self.lock = multiprocessing.Lock()
+        self.start = time.perf_counter()
+        self.improvements = []  # (seconds, steps, size) of every new best; only the main process records these
+
+    def reset(self):
+        """Zeroes the statistics, e.g. before optimizing the next cart"""
+        with self.lock:
+            for i in range(len(PHASES)):
+                self.counts[i] = 0
+                self.times[i] = 0.0
+        self.start = time.perf_counter()
+        self.improvements = []
+
+    def add(self, phase: str, seconds: float):
+        i = _INDEX[phase]
+        with self.lock:
+            self.counts[i] += 1
+            self.times[i] += seconds
+
+    def improved(self, size: int):
+        """Records that a new best solution of size bytes was found"""
+        self.improvements.append((time.perf_counter() - self.start, self.counts[_INDEX['get']], size))
+
+    @contextlib.contextmanager
+    def _timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def report(self, processes: int) -> dict:
+        """
+        Returns the statistics as a dictionary: the wall time, steps per second,
+        the utilisation of the worker processes, the count, total time and
+        mean time of each phase and when the best solutions were found.
+            Parameters:
+                processes (int): the number of worker processes
+            Returns:
+                report (dict): the statistics, with times in seconds
+        """
+        wall = time.perf_counter() - self.start
+        steps = self.counts[_INDEX['get']]
+        phases = {p: {'count': self.counts[i], 'total': self.times[i], 'mean': self.times[i] / max(self.counts[i], 1)}
+                  for i, p in enumerate(PHASES)}
+        return {
+            'wall': wall,
+            'steps': steps,
+            'steps_per_second': steps / wall if wall > 0 else 0.0,
+            'utilisation': phases['evaluate']['total'] / (wall * processes) if wall > 0 else 0.0,
+            'phases': phases,
+            'best': [list(x) for x in self.improvements],
+        }
+
+
+def timer(phase: str):
+    """
+    Context manager that times a phase, when collecting statistics in this
+    process; otherwise it does nothing.
+    """
+    if current is None:
+        return _NO_TIMER
+    return current._timer(phase)
+
+
+def format_report(report: dict) -> str:
+    """Formats a report returned by Stats.report as a human-readable table"""
+    lines = [f"  {report['steps']} steps in {report['wall']:.1f} s, {report['steps_per_second']:.1f} steps/s, worker utilisation {report['utilisation']:.0%}"]
+    for phase, p in report['phases'].items():
+        if p['count'] > 0:
+            lines.append(f"  {phase:<9}{p['count']:>9} x {p['mean'] * 1000:8.3f} ms = {p['total']:8.2f} s")
+    for kind, o in report.get('operators', {}).items():
+        lines.append(f"  {kind:<13}{o['proposed']:>9} proposed, {o['acceptance']:4.0%} accepted, mean delta {o['mean_delta']:+6.2f}")
+    return '\n'.join(lines)
@@ -0,0 +1,56 @@
+import pickle
+import unittest
+from pakettic import ast, parser
+from pakettic.ast import *
+
+
+class TestNodes(unittest.TestCase):
+    def test_nodes_have_slots(self):
+        node = BinOp(Name('x'), '+', Numeral(1))
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertIsNone(node.original)
+        self.assertIsNone(node.measured)
+        self.assertIsNone(node.printed)
+        with self.assertRaises(AttributeError):
+            node.foo
+
+    def test_parsed_leaves_are_shared(self):
+        root = parser.parse_string('a=nil b=nil c=1 d=1 e=0x1 f=1.5 g=1.5 h=true i=true')
+        values = [stat.values[0] for stat in root.stats]
+        self.assertIs(values[0], values[1])
+        self.assertIs(values[2], values[3])
+        self.assertIsNot(values[3], values[4])
+        self.assertIsNot(values[5], values[6])
+        self.assertIs(values[7], values[8])
+        self.assertIs(ast.shared(Numeral(1)), values[2])
+
+    def test_parsed_names_are_interned(self):
+        root = parser.parse_string('foobar=1 foobar=foobar..foobar')
+        self.assertIs(root.stats[0].targets[0].id, root.stats[1].values[0].right.id)
+
+
+class TestPickling(unittest.TestCase):
+    def test_roundtrip(self):
+        root = parser.parse_string('local a,b=1,"x" function f(...)return a..b,{c=1,[2]=3}end')
+        self.assertEqual(pickle.loads(pickle.dumps(root)), root)
+
+    def test_original_is_pickled_but_caches_are_not(self):
+        node = Numeral(3)
+        node.original = BinOp(Numeral(1), '+', Numeral(2))
+        node.measured = node.printed = {None: 'cache'}
+        got = pickle.loads(pickle.dumps(node))
+        self.assertEqual(got, node)
+        self.assertEqual(got.original, node.original)
+        self.assertIsNone(got.measured)
+        self.assertIsNone(got.printed)
+
+    def test_sharing_is_preserved(self):
+        root = parser.parse_string('a=nil b=nil')
+        got = pickle.loads(pickle.dumps(root))
+        self.assertIs(got.stats[0].values[0], got.stats[1].values[0])
+
+    def test_old_state_loads(self):
+        # pickles of older versions had the __dict__ of the node as the state
+        node = Name.__new__(Name)
+        node.__setstate__({'id': 'x', 'original': None})
+        self.assertEqual(node, Name('x'))
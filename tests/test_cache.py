@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from pakettic import cache
+
+
+class TestCostCache(unittest.TestCase):
+    def test_get_returns_put_value(self):
+        c = cache.CostCache(16)
+        key = cache.digest(b'print(1)')
+        self.assertIsNone(c.get(key))
+        c.put(key, 42)
+        self.assertEqual(c.get(key), 42)
+        self.assertEqual((c.hits, c.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        c = cache.CostCache(2, ways=2)  # a single set of two entries
+        c.put(1, 10)
+        c.put(2, 20)
+        c.get(1)
+        c.put(3, 30)
+        self.assertEqual(c.get(1), 10)
+        self.assertIsNone(c.get(2))
+        self.assertEqual(c.get(3), 30)
+
+    def test_clear(self):
+        c = cache.CostCache(16)
+        c.put(1, 10)
+        c.get(1)
+        c.clear()
+        self.assertEqual((c.hits, c.misses), (0, 0))
+        self.assertIsNone(c.get(1))
+
+    def test_digest_is_never_zero(self):
+        self.assertNotEqual(cache.digest(b''), 0)
+        self.assertEqual(cache.digest(b'ab', b'c'), cache.digest(b'a', b'bc'))
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_get_returns_put_value(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            c = cache.DiskCache(os.path.join(tmpdir, 'cache'), 1024)
+            self.assertIsNone(c.get('a'))
+            c.put('a', b'print(1)')
+            self.assertEqual(c.get('a'), b'print(1)')
+            # a new instance, like the next run, finds it too
+            self.assertEqual(cache.DiskCache(os.path.join(tmpdir, 'cache'), 1024).get('a'), b'print(1)')
+
+    def test_least_recently_used_is_evicted(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            c = cache.DiskCache(tmpdir, 10)
+            c.put('a', b'1234')
+            c.put('b', b'1234')
+            os.utime(os.path.join(tmpdir, 'a'), (1000, 1000))
+            os.utime(os.path.join(tmpdir, 'b'), (2000, 2000))
+            c.get('a')
+            c.put('c', b'1234')
+            self.assertEqual(c.get('a'), b'1234')
+            self.assertIsNone(c.get('b'))
+            self.assertEqual(c.get('c'), b'1234')
+
+
+if __name__ == '__main__':
+    unittest.main()
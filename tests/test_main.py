@@ -0,0 +1,63 @@
+import io
+import math
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from pakettic import ast, cache, main, parser
+from pakettic.ticfile import ChunkID
+
+
+class TestCostFunc(unittest.TestCase):
+    def setUp(self):
+        main.args = types.SimpleNamespace(output_format='png', pedantic=False, target_size=0, exact=False, no_load=False,
+                                          screen_margin=2, **main._ZOPFLI_LEVELS[0])
+        main.costs = cache.CostCache(64)
+        main.screen = None
+
+    def test_cached_finisher_writes_the_candidate_order(self):
+        data = [(0, ChunkID.TILES, bytes(range(64)) * 4), (0, ChunkID.MAP, b'hello' * 40), (0, ChunkID.DEFAULT, b'')]
+        main._setup((main._make_writer(data), None))
+        root = ast.Hint(parser.parse_string('x=1'))
+        data.reverse()  # the candidate mutated the order of the chunks
+        candidate = list(data)
+        main._cost_func((root, data), math.inf)
+        size, finisher = main._cost_func((root, data), math.inf)[1]
+        self.assertIs(type(finisher), main._Recompress)  # found in the cost cache
+        data.reverse()  # the mutation is undone after evaluating the candidate
+        expected = io.BytesIO()
+        main._make_writer(candidate)(main._format(root))[1](expected)
+        file = io.BytesIO()
+        self.assertEqual(finisher(file), size)
+        self.assertEqual(file.getvalue(), expected.getvalue())
+
+
+class TestResume(unittest.TestCase):
+    def test_resume_without_improvement_keeps_the_best(self):
+        cart = os.path.join(os.path.dirname(__file__), '..', 'examples', 'fish.lua')
+        cost_func = main._cost_func
+        calls = 0
+
+        def _interrupted(state, threshold):
+            nonlocal calls
+            calls += 1
+            if calls > 150:
+                raise KeyboardInterrupt
+            return cost_func(state, threshold)
+
+        def _no_improvement(state, threshold):
+            cost, finisher = cost_func(state, threshold)
+            return (math.inf, finisher) if threshold < math.inf else (cost, finisher)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'fish.tic')
+            argv = ['pakettic', cart, '-o', output, '-P1', '-s', '1000', '--checkpoint', '0.001', '--parse-cache-size', '0']
+            with mock.patch.object(sys, 'argv', argv), mock.patch.object(main, '_cost_func', _interrupted), self.assertRaises(SystemExit):
+                main.main()
+            self.assertTrue(os.path.exists(output + '.checkpoint'))
+            best = os.path.getsize(output)
+            with mock.patch.object(sys, 'argv', argv + ['--resume']), mock.patch.object(main, '_cost_func', _no_improvement), self.assertRaises(SystemExit):
+                main.main()
+            self.assertEqual(os.path.getsize(output), best)
@@ -1,7 +1,14 @@
+import math
+import os
+import pickle
+import random
+import tempfile
+import time
 import unittest
 from pakettic import parser
 from pakettic import printer
 from pakettic import optimize
+from pakettic import ast
 
 
 class TestOptimization(unittest.TestCase):
@@ -92,8 +99,310 @@ class TestOptimization(unittest.TestCase):
                         except Exception as err:
                             self.fail(err)
 
+    def test_mutation_index_stays_consistent(self):
+        cases = [
+            'x=a*a+b*2-c/d+e-f',
+            'x=(a+b)*(a+b) y=c^2 z=3*4+5//2',
+            'x=1--|2--|3 y=a>b and c<=d',
+            '--{\na=1\nb=2\nc=3\n--}\nfor i=1,10 do end',
+            'f=function()::a:: goto a end g=function(...)end',
+            'x=1/0 y=2^3 z=0xff',
+        ]
+        for code in cases:
+            with self.subTest(code=code):
+                root = ast.Hint(parser.parse_string(code))
+                state = (root, [1, 2, 3])
+                rand = random.Random(0)
+                for _ in range(200):
+                    optimize.mutate(state, rand)
+                    # the caches of the printer in the nodes should be reset whenever they change
+                    self.assertEqual(printer.measure(root), len(printer.format(root)))
+                    self.assertEqual(printer.format(root, cached=True), printer.format(root))
+                index = optimize._mutation_index(state)
+                self.assertEqual(index.totals(), optimize._MutationIndex(*state).totals())
+                parser.parse_string(printer.format(root))  # should still be valid code
+
+    def test_loads_to_funcs(self):
+        root = optimize.loads_to_funcs(parser.parse_string('f=load"x=1" local g=load"y=2" for i=1,2,load"return 3" do end'))
+        self.assertEqual(root.stats[0].values[0], ast.Func(args=[], body=parser.parse_string('x=1')))
+        self.assertEqual(root.stats[1].values[0], ast.Func(args=[], body=parser.parse_string('y=2')))
+        self.assertEqual(root.stats[2].step, ast.Func(args=[], body=parser.parse_string('return 3')))
+
+    def test_deep_trees_do_not_recurse(self):
+        root = parser.parse_string('x=' + '..'.join(['long_name'] * 5000))
+        root = optimize.minify(optimize.loads_to_funcs(root))
+        visited = []
+        optimize.visit(root, lambda node, parent, attr: visited.append(node))
+        self.assertEqual(len(visited), 3 + 5000 + 4999)  # block, assign, x, the names and the operators
+        self.assertEqual(len({n.id for n in visited if type(n) is ast.Name}), 2)
+
+    def test_adaptive_sampling_follows_weights(self):
+        root = ast.Hint(parser.parse_string('x=a>b y=c+d+e+f+g+h+i+j+k+l'))
+        index = optimize._MutationIndex(root, None)
+        rand = random.Random(0)
+        weights = dict.fromkeys(optimize._KINDS, 0.0)
+        weights['flip'] = 1.0
+        kinds = [index.sample(rand)[0] for _ in range(1000)]
+        adaptive_kinds = [index.sample(rand, weights)[0] for _ in range(1000)]
+        # the only flip is rare among all the mutations, but chosen every time the weights are used
+        self.assertLess(kinds.count('flip'), 100)
+        self.assertGreater(adaptive_kinds.count('flip'), 400)
+        self.assertGreater(len(set(adaptive_kinds)), 1)  # the other kinds are still sampled
+
+    def test_adaptive_weights_never_reach_zero(self):
+        root = ast.Hint(parser.parse_string('x=a>b y=c+d'))
+        index = optimize._MutationIndex(root, None)
+        operators = optimize._Operators(True)
+        operators.rates = dict.fromkeys(optimize._KINDS, 0.0)  # decayed after a long run without improvements
+        rand = random.Random(0)
+        for _ in range(100):
+            self.assertIsNotNone(index.sample(rand, operators.weights()))
+
+    def test_checkout_rolls_back_to_common_version(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\nd=1+2*3\n--}\nfor i=1,10 do end'
+        store = {0: pickle.dumps((parser.parse_string(code), [1, 2, 3]))}
+        evaluator = optimize._Evaluator(None, store)
+        rand = random.Random(0)
+        chains = [()]
+        for key in range(1, 300):
+            # branch off a random version, like the candidates of a long queue do
+            chain = rand.choice(chains)
+            state = evaluator.checkout(0, chain)
+            index = optimize._mutation_index(state)
+            m = index.sample(rand)
+            if m is None:
+                continue
+            kind, slot, arg = m
+            chains.append(chain + ((key, (kind, index.path(slot), arg)),))
+            chain = rand.choice(chains)
+            state = evaluator.checkout(0, chain)
+            index = optimize._last_index
+            expected = optimize._Evaluator(None, store).checkout(0, chain)
+            optimize._last_index = index  # keep using the index that was rolled back
+            self.assertEqual(printer.format(state[0]), printer.format(expected[0]))
+            self.assertEqual(state[1], expected[1])
+            self.assertEqual(index.totals(), optimize._MutationIndex(*expected).totals())
+
+    def test_spare_residents_are_reused(self):
+        class _Store(dict):
+            loads = 0
+
+            def __getitem__(self, key):
+                self.loads += 1
+                return super().__getitem__(key)
+        code = 'x=a*a+b*2-c/d+e-f y=(a+b)*(a+b) z=1--|2--|3'
+        store = _Store({0: pickle.dumps((parser.parse_string(code), [1, 2, 3]))})
+        evaluator = optimize._Evaluator(None, store)
+        rand = random.Random(0)
+        # two lines of versions that have nothing in common after the snapshot, like the interleaved candidates of a
+        # long queue, and that get longer than the undo history
+        chains = [(), ()]
+        for key in range(1, 4 * optimize._MAX_UNDO):
+            line = key % 2
+            state = evaluator.checkout(0, chains[line])
+            index = optimize._mutation_index(state)
+            kind, slot, arg = index.sample(rand)
+            chains[line] += ((key, (kind, index.path(slot), arg)),)
+        self.assertEqual(store.loads, 2)  # the snapshot is loaded again only once it is out of the undo history
+        for chain in chains:
+            state = evaluator.checkout(0, chain)
+            expected = optimize._Evaluator(None, store).checkout(0, chain)
+            self.assertEqual(printer.format(state[0]), printer.format(expected[0]))
+
+    def test_replayed_states_match_their_costs(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for processes in [1, 2]:
+            for batch in [1, 4]:
+                with self.subTest(processes=processes, batch=batch):
+                    def _best_func(state, finisher):
+                        # the state replayed in the main process should be the one that was evaluated
+                        self.assertEqual(_cost_func(pickle.loads(state))[0], finisher)
+                    root = parser.parse_string(code)
+                    with optimize.Solutions((root, [1, 2, 3]), 0, 4, processes, _cost_and_finisher, _best_func, batch=batch) as solutions:
+                        best = optimize.lahc(solutions, steps=300, list_length=5, init_margin=0)
+                    self.assertLess(_cost_func(pickle.loads(best))[0], _cost_func((root, None))[0])
+
+    def test_candidates_above_threshold_are_never_best(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for alg in ['anneal', 'lahc', 'dlas']:
+            for queue_length in [1, 4]:
+                with self.subTest(alg=alg, queue_length=queue_length):
+                    def _best_func(state, finisher):
+                        self.assertIsNotNone(finisher)
+                    root = parser.parse_string(code)
+                    with optimize.Solutions((root, None), 0, queue_length, 1, _screened_cost, _best_func) as solutions:
+                        if alg == 'lahc':
+                            optimize.lahc(solutions, steps=200, list_length=5, init_margin=0)
+                        elif alg == 'dlas':
+                            optimize.dlas(solutions, steps=200, list_length=5, init_margin=0)
+                        else:
+                            optimize.anneal(solutions, steps=200, start_temp=1, end_temp=0.1, seed=0)
+
+    def test_estimates_are_never_accepted(self):
+        # with a queue, the current cost can rise above the threshold a
+        # candidate was queued with, before its estimate comes back
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for queue_length in [1, 4, 12]:
+            with self.subTest(queue_length=queue_length):
+                costs = []
+
+                class _Solutions(optimize.Solutions):
+                    def put(self, state, rng, threshold=math.inf, first=False):
+                        costs.append(state.cost)
+                        super().put(state, rng, threshold, first)
+                root = parser.parse_string(code)
+                with _Solutions((root, None), 0, queue_length, 1, _low_estimate_cost, lambda state, finisher: None) as solutions:
+                    optimize.anneal(solutions, steps=300, start_temp=100, end_temp=10, seed=0)
+                self.assertEqual([c for c in costs if c < math.inf and c != int(c)], [])
+
+    def test_islands(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for alg in ['anneal', 'lahc', 'dlas']:
+            with self.subTest(alg=alg):
+                costs = []
+
+                def _best_func(state, finisher):
+                    self.assertEqual(_cost_func(pickle.loads(state))[0], finisher)
+                    costs.append(finisher)
+                root = parser.parse_string(code)
+                if alg == 'lahc':
+                    algorithm, kwargs = optimize.lahc, dict(steps=100, list_length=50, init_margin=0)
+                elif alg == 'dlas':
+                    algorithm, kwargs = optimize.dlas, dict(steps=100, list_length=5, init_margin=0)
+                else:
+                    algorithm, kwargs = optimize.anneal, dict(steps=100, start_temp=1, end_temp=0.1, seed=0)
+                best = optimize.islands((root, None), 0, 2, _cost_and_finisher, _best_func, algorithm, kwargs, migrate=20)
+                self.assertEqual(costs, sorted(costs, reverse=True))  # only improvements are reported
+                self.assertEqual(_cost_func(pickle.loads(best))[0], costs[-1])
+                self.assertLess(costs[-1], _cost_func((root, None))[0])
+
+    def test_resume_continues_exactly(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for alg in ['anneal', 'lahc', 'dlas']:
+            for queue_length in [1, 3]:
+                with self.subTest(alg=alg, queue_length=queue_length), tempfile.TemporaryDirectory() as tmpdir:
+                    path = os.path.join(tmpdir, 'checkpoint')
+
+                    def _run(cost_func, resume):
+                        root = parser.parse_string(code)
+                        with optimize.Solutions((root, None), 0, queue_length, 1, cost_func, lambda x, y: None,
+                                                checkpoint=path, checkpoint_interval=0, resume=resume) as solutions:
+                            if alg == 'lahc':
+                                return optimize.lahc(solutions, steps=200, list_length=50, init_margin=0)
+                            elif alg == 'dlas':
+                                return optimize.dlas(solutions, steps=200, list_length=5, init_margin=0)
+                            else:
+                                return optimize.anneal(solutions, steps=200, start_temp=1, end_temp=0.1, seed=0)
+                    expected = _run(_cost_and_finisher, False)
+                    self.assertFalse(os.path.exists(path))  # a finished optimization doesn't leave a checkpoint
+                    with self.assertRaises(KeyboardInterrupt):
+                        _run(_InterruptedCost(100), False)
+                    self.assertTrue(os.path.exists(path))
+                    self.assertEqual(_run(_cost_and_finisher, True), expected)
+
+    def test_operators_are_counted(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for adaptive in [False, True]:
+            with self.subTest(adaptive=adaptive):
+                root = parser.parse_string(code)
+                with optimize.Solutions((root, None), 0, 1, 1, _cost_and_finisher, lambda x, y: None, adaptive=adaptive) as solutions:
+                    optimize.lahc(solutions, steps=200, list_length=5, init_margin=0)
+                report = solutions.operators.report()
+                self.assertEqual(sum(o['proposed'] for o in report.values()), 200)
+                for o in report.values():
+                    self.assertLessEqual(o['accepted'], o['proposed'])
+
+    def test_workers_are_shared_by_solutions(self):
+        codes = ['--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\n--}\nfor i=1,10 do end', '--{\nc=f(function()return 1--|2 end)\nd=e*e*2\n--}']
+        with optimize.Workers(2) as workers:
+            for offset, code in enumerate(codes):
+                with self.subTest(code=code):
+                    def _best_func(state, finisher):
+                        # the context of this Solutions was set up in the pool processes
+                        self.assertEqual(_cost_func(pickle.loads(state))[0] + offset, finisher)
+                    root = parser.parse_string(code)
+                    with optimize.Solutions((root, None), 0, 4, 2, _offset_cost, _best_func, _set_offset, offset, workers=workers) as solutions:
+                        best = optimize.lahc(solutions, steps=100, list_length=5, init_margin=0)
+                    self.assertLess(_cost_func(pickle.loads(best))[0], _cost_func((root, None))[0])
+
+    def test_stopping_criteria(self):
+        code = '--{\na=x*x+y*2-z/w\nb=(c+d)*(c+d)\nc=f(function()return 1--|2 end)\n--}\nfor i=1,10 do end'
+        for alg in ['anneal', 'lahc', 'dlas']:
+            for criterion in [dict(time_limit=0.5), dict(stall_steps=50), dict(stall_seconds=0.2)]:
+                with self.subTest(alg=alg, **criterion):
+                    root = parser.parse_string(code)
+                    start = time.monotonic()
+                    # with steps=0, the algorithms would iterate forever without the other criteria
+                    with optimize.Solutions((root, None), 0, 1, 1, _cost_and_finisher, lambda x, y: None) as solutions:
+                        if alg == 'lahc':
+                            optimize.lahc(solutions, steps=0, list_length=50, init_margin=0, **criterion)
+                        elif alg == 'dlas':
+                            optimize.dlas(solutions, steps=0, list_length=5, init_margin=0, **criterion)
+                        else:
+                            optimize.anneal(solutions, steps=0, start_temp=1, end_temp=0.1, seed=0, **criterion)
+                    self.assertLess(time.monotonic() - start, 10)
+
+    def test_pool_errors_are_raised(self):
+        root = parser.parse_string('a=1')
+        with self.assertRaises(ValueError):
+            with optimize.Solutions((root, None), 0, 4, 2, _failing_cost, lambda x, y: None) as solutions:
+                optimize.lahc(solutions, steps=10, list_length=5, init_margin=0)
+
+
+class _InterruptedCost:
+    """Cost function that interrupts the optimization after a number of evaluations"""
+
+    def __init__(self, count):
+        self.count = count
+
+    def __call__(self, root_data, threshold):
+        self.count -= 1
+        if self.count < 0:
+            raise KeyboardInterrupt()
+        return _cost_and_finisher(root_data, threshold)
+
+
+_offset = 0
+
+
+def _set_offset(offset):
+    global _offset
+    _offset = offset
+
+
+def _offset_cost(root_data, threshold):
+    cost, _ = _cost_and_finisher(root_data, threshold)
+    return cost + _offset, cost + _offset
+
+
+def _failing_cost(root_data, threshold):
+    raise ValueError("cost function failed")
+
+
+def _screened_cost(root_data, threshold):
+    # mimics a cost function that returns a rough estimate for the rejected
+    # candidates: their finisher is None, so they should never be the best
+    cost, _ = _cost_func(root_data)
+    if cost > threshold:
+        return cost + 1, None
+    return cost, cost
+
+
+def _low_estimate_cost(root_data, threshold):
+    # the lowest estimate allowed for the rejected candidates; it is never an
+    # integer, unlike the exact costs
+    cost, _ = _cost_func(root_data)
+    if cost > threshold:
+        return math.floor(threshold) + 1.5, None
+    return cost, cost
+
+
+def _cost_and_finisher(root_data, threshold):
+    cost, _ = _cost_func(root_data)
+    return cost, cost
+
 
-def _cost_func(root_data):
+def _cost_func(root_data, threshold=math.inf):
     root, _ = root_data
     # slightly more interesting cost function than just string length, so
     # that we see some optimization happening even with these small carts
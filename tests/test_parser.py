@@ -13,6 +13,9 @@ class TestStringLiterals(unittest.TestCase):
             ("'test123\\n'", "test123\n"),
             ("'test123\\t'", "test123\t"),
             ("'test123\\''", "test123'"),
+            ("'\\065\\x41\\97'", "AAa"),
+            ("'a\\z  \n  b'", "ab"),
+            ("'\\a\\b\\v\\\\'", "\a\b\v\\"),
         ]
         for a, b in short_string_literals:
             with self.subTest(parsed=a, expected=b):
@@ -416,6 +419,8 @@ class TestBinaryOperators(unittest.TestCase):
             ('3 or 1 and 2', BinOp(Numeral(3), "or", BinOp(Numeral(1), "and", Numeral(2)))),
             ('2^3^4', BinOp(Numeral(2), "^", BinOp(Numeral(3), "^", Numeral(4)))),
             ('(2^3)^4', BinOp(BinOp(Numeral(2), "^", Numeral(3)), "^", Numeral(4))),
+            ('(1)~=(2)', BinOp(Numeral(1), "~=", Numeral(2))),
+            ('1~2~=3', BinOp(BinOp(Numeral(1), "~", Numeral(2)), "~=", Numeral(3))),
         ]
         for a, expected in cases:
             with self.subTest(parsed=a, expected=expected):
@@ -501,3 +506,17 @@ class TestTableConstructors(unittest.TestCase):
             with self.subTest(parsed=a, expected=expected):
                 got = parser.tableconstructor.parse_string(a, parse_all=True)[0]
                 self.assertEqual(got, expected)
+
+
+class TestLargeCode(unittest.TestCase):
+    def test_long_chain_does_not_recurse(self):
+        got = parser.parse_string('x=' + '+'.join(['1'] * 5000)).stats[0].values[0]
+        terms = 1
+        while type(got) is BinOp:
+            got = got.left
+            terms += 1
+        self.assertEqual(terms, 5000)
+
+    def test_many_statements(self):
+        got = parser.parse_string('x=1\n' * 20000 + 'if x then elseif y then end\n' * 1000)
+        self.assertEqual(len(got.stats), 21000)
@@ -87,3 +87,45 @@ class TestPrinter(unittest.TestCase):
                 self.assertEqual(printed, a)
                 got = parser.parse_string(printed)
                 self.assertEqual(got, expected)
+
+    def test_measure(self):
+        cases = [
+            'a={42,x,0}',
+            'x=1 ..2 y=0xa z=v1 w=1 e=3',
+            'x=5.25 ..a',
+            'goto foo ::foo::',
+            "x='\\n\\t' y=\"'\" z='\\\\'",
+            "f=function()x='a\\'b\\\\c' y=\"\\\"\" end",
+            "f=function()g=function()x='\"\\'\\n' end end",
+            "f=function(...)return 0xff end f=function(x)return x end",
+            "x=normalise''",
+            "a:b(1) x=s:len()",
+        ]
+        for a in cases:
+            for no_load in (False, True):
+                with self.subTest(code=a, no_load=no_load):
+                    root = Hint(parser.parse_string(a))
+                    self.assertEqual(printer.measure(root, no_load=no_load), len(printer.format(root, no_load=no_load)))
+                    root.no_hex = False
+                    root.double_quotes = True
+                    root.measured = None
+                    self.assertEqual(printer.measure(root, no_load=no_load), len(printer.format(root, no_load=no_load)))
+
+    def test_cached_format(self):
+        cases = [
+            'x=1 ..2 y=0xa z=v1 w=1 e=3',
+            "f=function()g=function()x='\"\\'\\n' end end",
+            'if a then b() elseif c then d() else e=1--|2 end',
+            '--{\na=1\nb=2\n--}\nfor i=1,10 do while x do y() end end',
+            'a:b(1) x=s:len()',
+        ]
+        for a in cases:
+            for pretty in (False, True):
+                for no_load in (False, True):
+                    with self.subTest(code=a, pretty=pretty, no_load=no_load):
+                        root = Hint(parser.parse_string(a))
+                        expected = printer.format(root, pretty=pretty, no_load=no_load)
+                        self.assertEqual(printer.format(root, pretty=pretty, no_load=no_load, cached=True), expected)
+                        # the second time comes from the cache
+                        self.assertEqual(printer.format(root, pretty=pretty, no_load=no_load, cached=True), expected)
+                        self.assertEqual(printer.format_bytes(root, pretty=pretty, no_load=no_load, cached=True), expected.encode('latin-1'))
@@ -0,0 +1,33 @@
+import unittest
+
+from pakettic import stats
+
+
+class TestStats(unittest.TestCase):
+    def test_report(self):
+        s = stats.Stats()
+        s.add('get', 0.5)
+        s.add('get', 1.5)
+        s.add('evaluate', 1.0)
+        report = s.report(processes=2)
+        self.assertEqual(report['steps'], 2)
+        self.assertEqual(report['phases']['get'], {'count': 2, 'total': 2.0, 'mean': 1.0})
+        self.assertEqual(report['phases']['compress']['count'], 0)
+        self.assertIn('steps/s', stats.format_report(report))
+
+    def test_timer_collects_only_when_enabled(self):
+        s = stats.Stats()
+        with stats.timer('format'):
+            pass
+        self.assertEqual(s.counts[stats.PHASES.index('format')], 0)
+        stats.current = s
+        try:
+            with stats.timer('format'):
+                pass
+        finally:
+            stats.current = None
+        self.assertEqual(s.counts[stats.PHASES.index('format')], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()